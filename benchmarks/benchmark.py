@@ -0,0 +1,279 @@
+#! /usr/bin/env python3
+
+"""PDF Quality Assessment for Digitisation batches
+
+Johan van der Knijff
+
+Copyright 2024, KB/National Library of the Netherlands
+
+Benchmark script. Generates a synthetic batch of PDFs with PyMuPDF and
+Pillow, and reports the throughput of the main processing stages and of
+a full "pdfquad process" run. Runs entirely offline, so it can be used to
+catch performance regressions before a release.
+
+Usage (from the root of the repository):
+
+python3 benchmarks/benchmark.py
+
+Use the --help option for all available options.
+
+"""
+
+import sys
+import os
+import io
+import base64
+import shutil
+import tempfile
+import time
+import argparse
+import subprocess
+import pymupdf
+from PIL import Image
+from PIL import ImageCms
+
+# Make sure the pdfquad package from this repository is used
+repoDir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, repoDir)
+
+from pdfquad import properties
+from pdfquad import jpegquality
+from pdfquad import filters
+from pdfquad import schematron
+from pdfquad import pdfquad
+
+
+def parseCommandLine():
+    """Parse command line"""
+    parser = argparse.ArgumentParser(description="Benchmark pdfquad on a synthetic batch")
+    parser.add_argument('--pdfs',
+                        action="store",
+                        type=int,
+                        default=10,
+                        help="number of PDFs for each quality level")
+    parser.add_argument('--pages',
+                        action="store",
+                        type=int,
+                        default=20,
+                        help="number of pages per PDF")
+    parser.add_argument('--qualities',
+                        action="store",
+                        default="50,85",
+                        help="comma-separated list of JPEG quality levels")
+    parser.add_argument('--width',
+                        action="store",
+                        type=int,
+                        default=1240,
+                        help="image width (pixels)")
+    parser.add_argument('--height',
+                        action="store",
+                        type=int,
+                        default=1754,
+                        help="image height (pixels)")
+    parser.add_argument('--no-icc',
+                        action="store_true",
+                        dest="noicc",
+                        default=False,
+                        help="don't embed ICC profiles in images")
+    parser.add_argument('--annotations',
+                        action="store_true",
+                        default=False,
+                        help="add a text annotation to each page")
+    parser.add_argument('--javascript',
+                        action="store_true",
+                        default=False,
+                        help="add a JavaScript action to each PDF")
+    parser.add_argument('--ascii85',
+                        action="store_true",
+                        default=False,
+                        help="wrap image streams in ASCII85Decode filter")
+    parser.add_argument('--workers', '-w',
+                        action="store",
+                        type=int,
+                        default=1,
+                        help="number of workers for full pdfquad run")
+    parser.add_argument('--batchdir',
+                        action="store",
+                        default=None,
+                        help="write synthetic batch to this directory and keep it \
+                            (default: temporary directory that is removed afterwards)")
+
+    # Parse arguments
+    args = parser.parse_args()
+
+    return args
+
+
+def makeJPEG(width, height, quality, iccProfile, seed):
+    """Return JPEG image with synthetic content as bytes"""
+    # Gradient with some noise, so the encoder has something to work on
+    gradient = Image.linear_gradient("L").resize((width, height))
+    noise = Image.effect_noise((width, height), 40 + seed % 20)
+    im = Image.merge("RGB", (gradient, noise, gradient.rotate(90)))
+    out = io.BytesIO()
+    options = {"quality": quality, "dpi": (300, 300)}
+    if iccProfile is not None:
+        options["icc_profile"] = iccProfile
+    im.save(out, "JPEG", **options)
+    return out.getvalue()
+
+
+def makePDF(fileOut, noPages, quality, args, iccProfile):
+    """Create synthetic PDF with one JPEG image on each page"""
+    doc = pymupdf.open()
+    for i in range(noPages):
+        jpeg = makeJPEG(args.width, args.height, quality, iccProfile, i)
+        # Page size that corresponds to 300 ppi
+        page = doc.new_page(width=args.width*72/300, height=args.height*72/300)
+        xref = page.insert_image(page.rect, stream=jpeg)
+        if args.ascii85:
+            doc.update_stream(xref, base64.a85encode(jpeg, adobe=True), compress=False)
+            doc.xref_set_key(xref, "Filter", "[/ASCII85Decode/DCTDecode]")
+        if args.annotations:
+            page.add_text_annot((10, 10), "benchmark annotation")
+    if args.javascript:
+        xref = doc.get_new_xref()
+        doc.update_object(xref, "<</S/JavaScript/JS(app.alert\\('pdfquad'\\);)>>")
+        doc.xref_set_key(doc.pdf_catalog(), "OpenAction", "{} 0 R".format(xref))
+    doc.save(fileOut)
+    doc.close()
+
+
+def makeBatch(batchDir, args):
+    """Create synthetic batch, using the directory structure
+    expected by the dbnl-fulltext profile"""
+    if args.noicc:
+        iccProfile = None
+    else:
+        iccProfile = ImageCms.ImageCmsProfile(ImageCms.createProfile("sRGB")).tobytes()
+
+    qualities = [int(q) for q in args.qualities.split(",")]
+    for i in range(args.pdfs):
+        for quality in qualities:
+            pdfDir = os.path.join(batchDir, "doc{}".format(str(i).zfill(4)),
+                                  "300dpi-{}".format(quality))
+            os.makedirs(pdfDir, exist_ok=True)
+            fileOut = os.path.join(pdfDir, "doc{}_01.pdf".format(str(i).zfill(4)))
+            makePDF(fileOut, args.pages, quality, args, iccProfile)
+
+
+def report(stage, elapsed, noItems, itemName, noPages=None, noBytes=None):
+    """Print timing results for one stage"""
+    line = "{:<22}{:>9.3f} s{:>12.1f} {}/s".format(stage, elapsed, noItems/elapsed, itemName)
+    if noPages is not None:
+        line += "{:>10.1f} pages/s".format(noPages/elapsed)
+    if noBytes is not None:
+        line += "{:>8.2f} MB/s".format(noBytes/elapsed/1048576)
+    print(line)
+
+
+def main():
+    """Main function"""
+    args = parseCommandLine()
+
+    if args.batchdir is not None:
+        workDir = os.path.abspath(args.batchdir)
+        os.makedirs(workDir, exist_ok=True)
+    else:
+        workDir = tempfile.mkdtemp(prefix="pdfquad-bench-")
+
+    batchDir = os.path.join(workDir, "batch")
+    outDir = os.path.join(workDir, "out")
+    configDir = os.path.join(workDir, "config")
+    os.makedirs(outDir, exist_ok=True)
+    os.makedirs(configDir, exist_ok=True)
+
+    try:
+        start = time.perf_counter()
+        makeBatch(batchDir, args)
+        print("generated synthetic batch in {:.1f} s".format(time.perf_counter() - start))
+
+        PDFs = list(pdfquad.getFilesFromTree(batchDir, "pdf", True))
+        noPDFs = len(PDFs)
+        noPages = noPDFs * args.pages
+        noBytes = sum(os.path.getsize(PDF) for PDF in PDFs)
+        print("{} PDFs, {} pages, {:.1f} MB\n".format(noPDFs, noPages, noBytes/1048576))
+
+        # Schemas from the packaged dbnl-fulltext profile
+        packageDir = os.path.join(repoDir, "pdfquad")
+        profile = os.path.join(packageDir, "profiles", "dbnl-fulltext.xml")
+        schemas = schematron.readProfile(profile, os.path.join(packageDir, "schemas"))
+        schematron.compileSchemas(schemas)
+
+        # Properties extraction
+        start = time.perf_counter()
+        pdfRecords = [properties.getProperties(PDF) for PDF in PDFs]
+        report("getProperties", time.perf_counter() - start, noPDFs, "PDFs", noPages, noBytes)
+
+        # Conversion of extracted properties to Element objects
+        start = time.perf_counter()
+        propertiesElts = [pdfRecord.toElt() for pdfRecord in pdfRecords]
+        report("toElt", time.perf_counter() - start, noPDFs, "PDFs", noPages)
+
+        # JPEG quality estimation, with memoization disabled
+        images = []
+        for PDF in PDFs:
+            doc = pymupdf.open(PDF)
+            for page in doc:
+                for image in page.get_images(full=False):
+                    stream, codecFilters = filters.decodeStream(doc.xref_stream_raw(image[0]),
+                                                                filters.getFilters(doc, image[0]),
+                                                                filters.getJPEGHeaderLength)
+                    images.append(Image.open(io.BytesIO(stream)))
+            doc.close()
+        start = time.perf_counter()
+        for im in images:
+            jpegquality.computeQualityFromTables.cache_clear()
+            jpegquality.computeJPEGQuality(im)
+        report("computeJPEGQuality", time.perf_counter() - start, len(images), "images")
+
+        # Schema matching
+        start = time.perf_counter()
+        for i in range(100):
+            for PDF in PDFs:
+                schematron.findSchema(PDF, schemas)
+        report("findSchema", time.perf_counter() - start, 100*noPDFs, "PDFs")
+
+        # Schematron validation, with memoization of rule results disabled
+        # and enabled. Schemas are compiled again for each, so no memoized
+        # results are carried over
+        schematron.nativeSchemas.clear()
+        schematron.compileSchemas(schemas)
+        for nativeSchema in schematron.nativeSchemas.values():
+            if nativeSchema is not None:
+                for rulesOfPattern in nativeSchema.patterns:
+                    for rule in rulesOfPattern:
+                        rule.memoFlag = False
+        start = time.perf_counter()
+        for PDF, propertiesElt in zip(PDFs, propertiesElts):
+            schemaMatchFlag, mySchema = schematron.findSchema(PDF, schemas)
+            schematron.validate(mySchema, propertiesElt, False)
+        report("validate (no memo)", time.perf_counter() - start, noPDFs, "PDFs", noPages)
+
+        schematron.nativeSchemas.clear()
+        schematron.compileSchemas(schemas)
+        start = time.perf_counter()
+        for PDF, propertiesElt in zip(PDFs, propertiesElts):
+            schemaMatchFlag, mySchema = schematron.findSchema(PDF, schemas)
+            schematron.validate(mySchema, propertiesElt, False)
+        report("validate", time.perf_counter() - start, noPDFs, "PDFs", noPages)
+
+        # Full run of pdfquad process, using a separate configuration directory
+        env = dict(os.environ)
+        env.pop("LOCALAPPDATA", None)
+        env["XDG_CONFIG_HOME"] = configDir
+        command = [sys.executable, "-m", "pdfquad", "process", "dbnl-fulltext.xml",
+                   batchDir, "--outdir", outDir, "--no-cache",
+                   "--workers", str(args.workers)]
+        start = time.perf_counter()
+        subprocess.run(command, cwd=repoDir, env=env, check=True,
+                       stdout=subprocess.DEVNULL)
+        report("pdfquad process", time.perf_counter() - start, noPDFs, "PDFs", noPages, noBytes)
+
+    finally:
+        if args.batchdir is None:
+            shutil.rmtree(workDir)
+
+
+if __name__ == "__main__":
+    main()
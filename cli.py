@@ -2,7 +2,10 @@
 #
 """CLI wrapper script, ensures that relative imports work correctly in a PyInstaller build"""
 
+import multiprocessing
 from pdfquad.pdfquad import main
 
 if __name__ == '__main__':
+    # Needed for worker processes in frozen Windows executables
+    multiprocessing.freeze_support()
     main()
@@ -0,0 +1,224 @@
+#! /usr/bin/env python3
+
+"""PDF Quality Assessment for Digitisation batches
+
+Johan van der Knijff
+
+Copyright 2024, KB/National Library of the Netherlands
+
+Module with persistent result cache, which makes it possible to re-run a
+batch without re-processing PDFs that haven't changed since the last run
+
+"""
+
+import os
+import time
+import hashlib
+import sqlite3
+import logging
+import threading
+
+# Connection to cache database for this process
+connection = None
+# ID of the process that opened the connection
+connectionPid = None
+# Hash of the settings (software version, profile, schemas, options)
+# that affect the output
+settingsHash = None
+# Flag that indicates whether content hash of PDFs must be checked
+rehashFlag = False
+# Time interval (seconds) at which stored results are committed, and
+# time of last commit
+commitInterval = 0
+lastCommit = 0
+# Connections inherited from a parent process. These must not be used
+# or closed in the child process, so we just keep a reference to them
+inheritedConnections = []
+# Lock that serializes use of the connection, which may be shared by the
+# threads of a process (e.g. for skipping cached PDFs while prefetching)
+lock = threading.Lock()
+
+
+def computeHash(fileIn):
+    """Return SHA-256 hash of file contents"""
+    h = hashlib.sha256()
+    with open(fileIn, 'rb') as f:
+        for chunk in iter(lambda: f.read(1048576), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def getCodeRevision():
+    """Return hash of the source files of the package, which changes whenever
+    the code that produces the output changes (unlike the version number,
+    which is only changed for releases). Returns an empty string if the
+    source files are not available (e.g. in a frozen executable)"""
+    h = hashlib.sha256()
+    packageDir = os.path.dirname(os.path.abspath(__file__))
+    try:
+        sourceFiles = sorted(f for f in os.listdir(packageDir) if f.endswith(".py"))
+        for sourceFile in sourceFiles:
+            h.update(sourceFile.encode('utf-8'))
+            with open(os.path.join(packageDir, sourceFile), 'rb') as f:
+                h.update(f.read())
+    except OSError:
+        return ""
+    if len(sourceFiles) == 0:
+        return ""
+    return h.hexdigest()
+
+
+def computeSettingsHash(version, profile, schemas, options):
+    """Return hash of all settings that affect the output for a PDF: the
+    software version and code revision, the contents of the profile and
+    schema files, and the values of any output-related options"""
+    h = hashlib.sha256()
+    h.update(version.encode('utf-8'))
+    h.update(getCodeRevision().encode('utf-8'))
+    with open(profile, 'rb') as f:
+        h.update(f.read())
+    for schema in schemas:
+        h.update(schema[3].encode('utf-8'))
+        with open(schema[3], 'rb') as f:
+            h.update(f.read())
+    for option in options:
+        h.update(str(option).encode('utf-8'))
+    return h.hexdigest()
+
+
+def openCache(cacheFile, settingsHashIn, rehashFlagIn, commitIntervalIn=0):
+    """Open cache database and create results table if it doesn't exist
+    already. This must be called by each process that uses the cache.
+    Stored results are committed every commitIntervalIn seconds"""
+    global connection, connectionPid, settingsHash, rehashFlag, commitInterval, lastCommit
+
+    if connection is not None and connectionPid != os.getpid():
+        inheritedConnections.append(connection)
+
+    connection = sqlite3.connect(cacheFile, timeout=60, check_same_thread=False)
+    connection.execute("""CREATE TABLE IF NOT EXISTS results (
+                          filePath TEXT NOT NULL,
+                          settingsHash TEXT NOT NULL,
+                          fileSize INTEGER,
+                          modTime INTEGER,
+                          contentHash TEXT,
+                          validationSuccess TEXT,
+                          validationOutcome TEXT,
+                          noPages TEXT,
+                          outXML BLOB,
+                          PRIMARY KEY (filePath, settingsHash))""")
+    connection.commit()
+    connectionPid = os.getpid()
+    settingsHash = settingsHashIn
+    rehashFlag = rehashFlagIn
+    commitInterval = commitIntervalIn
+    lastCommit = time.time()
+
+
+def commit():
+    """Commit stored results"""
+    global lastCommit
+    try:
+        with lock:
+            connection.commit()
+    except sqlite3.Error as e:
+        logging.warning(("while writing to cache: {}").format(str(e)))
+    lastCommit = time.time()
+
+
+def closeCache():
+    """Commit stored results and close cache database"""
+    global connection, connectionPid
+    if connection is not None and connectionPid == os.getpid():
+        commit()
+        connection.close()
+    connection = None
+    connectionPid = None
+
+
+def isEnabled():
+    """Return True if cache was opened by this process"""
+    return connection is not None and connectionPid == os.getpid()
+
+
+def getFileKey(PDF):
+    """Return file size, modification time and (if rehashFlag is True)
+    content hash of PDF"""
+    fileStat = os.stat(PDF)
+    if rehashFlag:
+        contentHash = computeHash(PDF)
+    else:
+        contentHash = None
+    return [fileStat.st_size, fileStat.st_mtime_ns, contentHash]
+
+
+def getResult(PDF, fileKey):
+    """Return cached result for PDF, or None if the cache doesn't contain
+    a result for the current settings and file size, modification time and
+    (if rehashFlag is True) content hash"""
+    fileSize, modTime, contentHash = fileKey
+    try:
+        with lock:
+            row = connection.execute("""SELECT fileSize, modTime, contentHash,
+                                        validationSuccess, validationOutcome,
+                                        noPages, outXML FROM results
+                                        WHERE filePath = ? AND settingsHash = ?""",
+                                     (PDF, settingsHash)).fetchone()
+    except sqlite3.Error as e:
+        logging.warning(("while reading from cache: {}").format(str(e)))
+        return None
+
+    if row is None:
+        return None
+    if row[0] != fileSize or row[1] != modTime:
+        return None
+    if rehashFlag and row[2] != contentHash:
+        return None
+
+    result = {"file": PDF,
+              "validationSuccess": row[3],
+              "validationOutcome": row[4],
+              "noPages": row[5],
+              "output": row[6]}
+
+    return result
+
+
+def hasResult(PDF):
+    """Return True if the cache (probably) contains a result for PDF, based
+    on its file size and modification time. This is used to avoid reading
+    cached PDFs ahead of their processing. With rehashFlag the content hash
+    must be computed anyway, so then False is returned"""
+    if not isEnabled() or rehashFlag:
+        return False
+    try:
+        fileStat = os.stat(PDF)
+        with lock:
+            row = connection.execute("""SELECT fileSize, modTime FROM results
+                                        WHERE filePath = ? AND settingsHash = ?""",
+                                     (PDF, settingsHash)).fetchone()
+    except (OSError, sqlite3.Error):
+        return False
+    return row is not None and row[0] == fileStat.st_size and row[1] == fileStat.st_mtime_ns
+
+
+def storeResult(result, fileKey):
+    """Store result for PDF in cache. Results of the PDF for other settings
+    are removed, so the cache holds at most one result for each PDF. Results
+    are committed at the commit interval, and when the cache is closed"""
+    fileSize, modTime, contentHash = fileKey
+    try:
+        with lock:
+            connection.execute("""DELETE FROM results
+                                  WHERE filePath = ? AND settingsHash != ?""",
+                               (result["file"], settingsHash))
+            connection.execute("""INSERT OR REPLACE INTO results
+                                  VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)""",
+                               (result["file"], settingsHash, fileSize, modTime,
+                                contentHash, result["validationSuccess"],
+                                result["validationOutcome"], result["noPages"],
+                                result["output"]))
+    except sqlite3.Error as e:
+        logging.warning(("while writing to cache: {}").format(str(e)))
+    if time.time() - lastCommit >= commitInterval:
+        commit()
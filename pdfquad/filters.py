@@ -0,0 +1,343 @@
+#! /usr/bin/env python3
+
+"""PDF Quality Assessment for Digitisation batches
+
+Johan van der Knijff
+
+Copyright 2024, KB/National Library of the Netherlands
+
+Module for decoding the filter chains of image streams. Any ASCII85,
+ASCIIHex, LZW and Flate filters that wrap the image codec (e.g. DCTDecode)
+are decoded incrementally from memoryview slices of the raw stream, so
+decoding can stop as soon as the image header is available. Predictors
+(DecodeParms of LZW and Flate filters) are applied as well. Note that LZW
+is decoded in pure Python, which is slow for complete images (i.e. with
+the decode check)
+
+"""
+
+import re
+import zlib
+import base64
+
+# Size of slices of the raw stream that are fed to the decoders
+chunkSize = 65536
+
+# Full names of abbreviated filter names (used in inline images, but
+# sometimes also in stream dictionaries)
+abbreviations = {"A85": "ASCII85Decode",
+                 "AHx": "ASCIIHexDecode",
+                 "LZW": "LZWDecode",
+                 "Fl": "FlateDecode",
+                 "RL": "RunLengthDecode",
+                 "DCT": "DCTDecode",
+                 "CCF": "CCITTFaxDecode"}
+
+whitespace = b"\x00\t\n\x0c\r "
+reName = re.compile(r"/([^\s/\[\]<>()]+)")
+reParms = re.compile(r"<<.*?>>|null")
+# Prefix of ASCII85 data that consists of complete groups
+reA85Groups = re.compile(rb"(?:z|[!-u]{5})*")
+
+
+def getFilters(doc, xref):
+    """Return list of (filter name, decode parameters) tuples for stream
+    object xref, where the decode parameters are the source of the
+    parameter dictionary (or an empty string)"""
+    filterType, filterValue = doc.xref_get_key(xref, "Filter")
+    if filterType == "xref":
+        filterValue = doc.xref_object(int(filterValue.split()[0]), compressed=True)
+    elif filterType not in ("name", "array"):
+        return []
+    names = reName.findall(filterValue)
+
+    parmsType, parmsValue = doc.xref_get_key(xref, "DecodeParms")
+    if parmsType == "dict":
+        parms = [parmsValue]
+    elif parmsType == "array":
+        parms = [value if value != "null" else "" for value in reParms.findall(parmsValue)]
+    else:
+        parms = []
+    parms += [""] * (len(names) - len(parms))
+
+    return list(zip(names, parms))
+
+
+def getParm(parms, key, default):
+    """Return integer value of key in decode parameters parms (the source of
+    the parameter dictionary), or default if parms don't contain key"""
+    match = re.search(r"/" + key + r"\s*([0-9]+)", parms)
+    return default if match is None else int(match.group(1))
+
+
+def iterChunks(buffer):
+    """Yield memoryview slices of buffer"""
+    view = memoryview(buffer)
+    for start in range(0, len(view), chunkSize):
+        yield view[start:start + chunkSize]
+
+
+def decodeASCII85(chunks, parms):
+    """Yield decoded chunks of ASCII85 encoded data"""
+    carry = b""
+    first = True
+    for chunk in chunks:
+        data = carry + bytes(chunk).translate(None, whitespace)
+        if first:
+            if b"<~".startswith(data) and len(data) < 2:
+                # Prefix may be split over chunks
+                carry = data
+                continue
+            if data.startswith(b"<~"):
+                data = data[2:]
+            first = False
+        end = data.find(b"~>")
+        if end >= 0:
+            yield base64.a85decode(data[:end])
+            return
+        groupsEnd = reA85Groups.match(data).end()
+        yield base64.a85decode(data[:groupsEnd])
+        carry = data[groupsEnd:]
+    if len(carry) != 0:
+        yield base64.a85decode(carry)
+
+
+def decodeASCIIHex(chunks, parms):
+    """Yield decoded chunks of ASCIIHex encoded data"""
+    carry = b""
+    for chunk in chunks:
+        data = carry + bytes(chunk).translate(None, whitespace)
+        end = data.find(b">")
+        if end >= 0:
+            data = data[:end]
+            if len(data) % 2 != 0:
+                data += b"0"
+            yield bytes.fromhex(data.decode("ascii"))
+            return
+        pairsEnd = len(data) - len(data) % 2
+        yield bytes.fromhex(data[:pairsEnd].decode("ascii"))
+        carry = data[pairsEnd:]
+    if len(carry) != 0:
+        yield bytes.fromhex((carry + b"0").decode("ascii"))
+
+
+def decodeLZW(chunks, parms):
+    """Yield decoded chunks of LZW encoded data"""
+    earlyChange = getParm(parms, "EarlyChange", 1)
+    initialTable = [bytes([i]) for i in range(256)] + [b"", b""]
+    table = list(initialTable)
+    codeLength = 9
+    previous = None
+    bitBuffer = 0
+    bitCount = 0
+    for chunk in chunks:
+        out = bytearray()
+        for byte in bytes(chunk):
+            bitBuffer = (bitBuffer << 8) | byte
+            bitCount += 8
+            while bitCount >= codeLength:
+                bitCount -= codeLength
+                code = bitBuffer >> bitCount
+                bitBuffer &= (1 << bitCount) - 1
+                if code == 256:
+                    table = list(initialTable)
+                    codeLength = 9
+                    previous = None
+                    continue
+                if code == 257:
+                    yield bytes(out)
+                    return
+                if code < len(table):
+                    entry = table[code]
+                    if previous is not None and len(table) < 4096:
+                        table.append(previous + entry[:1])
+                elif code == len(table) and previous is not None:
+                    entry = previous + previous[:1]
+                    table.append(entry)
+                else:
+                    raise ValueError("invalid LZW code {}".format(code))
+                out += entry
+                previous = entry
+                if len(table) + earlyChange >= (1 << codeLength) and codeLength < 12:
+                    codeLength += 1
+        yield bytes(out)
+
+
+def decodeFlate(chunks, parms):
+    """Yield decoded chunks of Flate (zlib) encoded data"""
+    decompressor = zlib.decompressobj()
+    for chunk in chunks:
+        data = chunk
+        while len(data) != 0 and not decompressor.eof:
+            yield decompressor.decompress(data, chunkSize)
+            data = decompressor.unconsumed_tail
+        if decompressor.eof:
+            return
+    yield decompressor.flush()
+
+
+def unfilterRow(row, previous, filterType, bpp):
+    """Reverse PNG filter filterType of row (bytearray) in place, using the
+    previous (unfiltered) row and bpp bytes per pixel"""
+    length = len(row)
+    if filterType == 0:
+        return
+    elif filterType == 1:
+        for i in range(bpp, length):
+            row[i] = (row[i] + row[i - bpp]) & 0xff
+    elif filterType == 2:
+        row[:] = bytes((a + b) & 0xff for a, b in zip(row, previous))
+    elif filterType == 3:
+        for i in range(length):
+            left = row[i - bpp] if i >= bpp else 0
+            row[i] = (row[i] + ((left + previous[i]) >> 1)) & 0xff
+    elif filterType == 4:
+        for i in range(length):
+            if i >= bpp:
+                left = row[i - bpp]
+                upperLeft = previous[i - bpp]
+            else:
+                left = 0
+                upperLeft = 0
+            up = previous[i]
+            estimate = left + up - upperLeft
+            distLeft = abs(estimate - left)
+            distUp = abs(estimate - up)
+            distUpperLeft = abs(estimate - upperLeft)
+            if distLeft <= distUp and distLeft <= distUpperLeft:
+                predicted = left
+            elif distUp <= distUpperLeft:
+                predicted = up
+            else:
+                predicted = upperLeft
+            row[i] = (row[i] + predicted) & 0xff
+    else:
+        raise ValueError("invalid PNG predictor type {}".format(filterType))
+
+
+def decodePredictor(chunks, parms):
+    """Yield chunks with the predictor in decode parameters parms reversed.
+    Supported are the TIFF predictor (2) for 8 bits per component, and the
+    PNG predictors (10-15), for which each row starts with its filter type"""
+    predictor = getParm(parms, "Predictor", 1)
+    colors = getParm(parms, "Colors", 1)
+    bpc = getParm(parms, "BitsPerComponent", 8)
+    columns = getParm(parms, "Columns", 1)
+    if predictor == 2 and bpc != 8:
+        raise ValueError("unsupported DecodeParms: TIFF predictor with {} bits per component".format(bpc))
+    elif predictor != 2 and not 10 <= predictor <= 15:
+        raise ValueError("unsupported DecodeParms: predictor {}".format(predictor))
+    pngFlag = predictor >= 10
+    bpp = max(1, (colors * bpc + 7) // 8)
+    rowLength = (colors * bpc * columns + 7) // 8
+    if rowLength == 0:
+        raise ValueError("unsupported DecodeParms: {}".format(parms))
+    # Length of row in the encoded data, including the PNG filter type
+    encodedLength = rowLength + pngFlag
+    previous = bytearray(rowLength)
+    buffer = bytearray()
+    final = False
+    while not final:
+        chunk = next(chunks, None)
+        if chunk is None:
+            # Pad last (incomplete) row, which is truncated afterwards
+            final = True
+            if len(buffer) <= pngFlag:
+                return
+            truncatedLength = len(buffer) - pngFlag
+            buffer += bytes(encodedLength - len(buffer))
+        else:
+            buffer += chunk
+        out = bytearray()
+        start = 0
+        while len(buffer) - start >= encodedLength:
+            row = buffer[start + pngFlag:start + encodedLength]
+            if pngFlag:
+                unfilterRow(row, previous, buffer[start], bpp)
+            else:
+                for i in range(colors, rowLength):
+                    row[i] = (row[i] + row[i - colors]) & 0xff
+            out += row
+            previous = row
+            start += encodedLength
+        del buffer[:start]
+        if final:
+            del out[truncatedLength:]
+        yield bytes(out)
+
+
+# Decoders of the filters that can wrap the image codec
+decoders = {"ASCII85Decode": decodeASCII85,
+            "ASCIIHexDecode": decodeASCIIHex,
+            "LZWDecode": decodeLZW,
+            "FlateDecode": decodeFlate}
+# Filters that can have a predictor
+predictorFilters = {"LZWDecode", "FlateDecode"}
+
+
+def splitChain(filterChain):
+    """Split filter chain into the leading filters that can be decoded, and
+    the remaining filters (which normally is just the image codec)"""
+    for i, (name, parms) in enumerate(filterChain):
+        if abbreviations.get(name, name) not in decoders:
+            return filterChain[:i], filterChain[i:]
+    return filterChain, []
+
+
+def getJPEGHeaderLength(data):
+    """Return length of JPEG header (all marker segments up to and including
+    the start of scan segment) at start of data, or None if data doesn't
+    contain the complete header yet. If data don't look like a JPEG, the
+    length of data is returned, as more data won't help to parse them"""
+    if len(data) < 2:
+        return None
+    if data[:2] != b"\xff\xd8":
+        return len(data)
+    position = 2
+    while True:
+        # Skip fill bytes
+        while position < len(data) and data[position] == 0xff and \
+              position + 1 < len(data) and data[position + 1] == 0xff:
+            position += 1
+        if position + 2 > len(data):
+            return None
+        if data[position] != 0xff:
+            return len(data)
+        marker = data[position + 1]
+        if marker == 0x01 or 0xd0 <= marker <= 0xd8:
+            # Markers without segment
+            position += 2
+            continue
+        if position + 4 > len(data):
+            return None
+        segmentEnd = position + 2 + int.from_bytes(data[position + 2:position + 4], "big")
+        if marker == 0xda:
+            return segmentEnd if segmentEnd <= len(data) else None
+        position = segmentEnd
+
+
+def decodeStream(streamRaw, filterChain, headerFunction=None):
+    """Decode all filters in filterChain that wrap the image codec, and
+    return the result together with the list of remaining filters. If
+    headerFunction is not None, decoding stops as soon as headerFunction
+    returns the length of the header for the data decoded so far, and only
+    the header is returned. Unwrapped streams are returned without copying"""
+    wrappers, remaining = splitChain(filterChain)
+    if len(wrappers) == 0:
+        return streamRaw, remaining
+
+    chunks = iterChunks(streamRaw)
+    for name, parms in wrappers:
+        name = abbreviations.get(name, name)
+        chunks = decoders[name](chunks, parms)
+        if name in predictorFilters and getParm(parms, "Predictor", 1) != 1:
+            chunks = decodePredictor(chunks, parms)
+
+    data = bytearray()
+    for chunk in chunks:
+        data += chunk
+        if headerFunction is not None:
+            headerLength = headerFunction(data)
+            if headerLength is not None:
+                return bytes(data[:headerLength]), remaining
+    return bytes(data), remaining
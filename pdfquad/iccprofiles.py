@@ -0,0 +1,102 @@
+#! /usr/bin/env python3
+
+"""PDF Quality Assessment for Digitisation batches
+
+Johan van der Knijff
+
+Copyright 2024, KB/National Library of the Netherlands
+
+Module for reading the name and description of ICC profiles. As all images
+of a scanned book typically use the same profile, parsed profiles are cached
+by a hash of the profile bytes, and ICCBased colour spaces are resolved only
+once per document
+
+"""
+
+import io
+import re
+import hashlib
+import collections
+from PIL import ImageCms
+
+# Maximum number of profiles in cache
+cacheSize = 64
+
+# Name and description of recently parsed profiles, by hash of profile bytes
+profileCache = collections.OrderedDict()
+
+# ICC profile stream of ICCBased colour space (which may also be the base of
+# e.g. an Indexed colour space)
+reICCBased = re.compile(r"/ICCBased\s+([0-9]+)\s+[0-9]+\s+R")
+
+
+def getProfileProperties(icc):
+    """Return name and description of ICC profile icc (bytes). Results are
+    cached across documents, so each profile is parsed only once per worker"""
+    key = hashlib.blake2b(icc, digest_size=16).digest()
+    if key in profileCache:
+        profileCache.move_to_end(key)
+        return profileCache[key]
+    iccProfile = ImageCms.ImageCmsProfile(io.BytesIO(icc))
+    result = (ImageCms.getProfileName(iccProfile).strip(),
+              ImageCms.getProfileDescription(iccProfile).strip())
+    profileCache[key] = result
+    if len(profileCache) > cacheSize:
+        profileCache.popitem(last=False)
+    return result
+
+
+class ProfileError(ValueError):
+    """Raised for an ICC profile of an ICCBased colour space that already
+    failed for an earlier image of the document"""
+    pass
+
+
+class ColourSpaceResolver:
+    """Resolve the ICC profiles of ICCBased colour spaces of the images
+    in one document. Results are cached by colour space and profile object,
+    as these are normally shared by all images. This includes failures, so
+    a broken profile is only read and parsed once"""
+
+    def __init__(self, doc):
+        self.doc = doc
+        self.colourSpaceProfiles = {}
+        self.profileResults = {}
+        self.profileErrors = {}
+
+    def getProfileXref(self, xref):
+        """Return xref of ICC profile stream of colour space of image xref,
+        or None if it doesn't have an ICCBased colour space"""
+        csType, csValue = self.doc.xref_get_key(xref, "ColorSpace")
+        if csType == "xref":
+            csXref = int(csValue.split()[0])
+            if csXref not in self.colourSpaceProfiles:
+                source = self.doc.xref_object(csXref, compressed=True)
+                match = reICCBased.search(source)
+                self.colourSpaceProfiles[csXref] = None if match is None else int(match.group(1))
+            return self.colourSpaceProfiles[csXref]
+        elif csType == "array":
+            match = reICCBased.search(csValue)
+            return None if match is None else int(match.group(1))
+        return None
+
+    def getProfileProperties(self, xref):
+        """Return name and description of the ICC profile of the ICCBased
+        colour space of image xref, or None if it doesn't have one. If the
+        profile already failed for an earlier image, ProfileError is raised
+        with the message of the original error"""
+        profileXref = self.getProfileXref(xref)
+        if profileXref is None:
+            return None
+        if profileXref in self.profileErrors:
+            raise ProfileError(self.profileErrors[profileXref])
+        if profileXref not in self.profileResults:
+            try:
+                icc = self.doc.xref_stream(profileXref)
+                if icc is None:
+                    raise ValueError("ICCBased colour space without profile stream")
+                self.profileResults[profileXref] = getProfileProperties(icc)
+            except Exception as e:
+                self.profileErrors[profileXref] = str(e)
+                raise
+        return self.profileResults[profileXref]
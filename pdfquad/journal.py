@@ -0,0 +1,114 @@
+#! /usr/bin/env python3
+
+"""PDF Quality Assessment for Digitisation batches
+
+Johan van der Knijff
+
+Copyright 2024, KB/National Library of the Netherlands
+
+Module with code for resuming an interrupted batch from its journal
+
+"""
+
+import os
+import csv
+import logging
+from . import shared
+from . import writers
+
+
+def readJournal(journalFile):
+    """Read journal and return list with for each completed PDF the file
+    name, output file and position in output file directly after the
+    output for this PDF (for SQLite output, the row id of its record).
+    An incomplete last line (which may be the result of a crash) is
+    ignored"""
+
+    shared.checkFileExists(journalFile)
+
+    with open(journalFile, 'r', newline='', encoding='utf-8') as f:
+        lines = f.readlines()
+
+    if len(lines) != 0 and not lines[-1].endswith("\n"):
+        lines = lines[:-1]
+
+    entries = []
+    for row in csv.reader(lines):
+        try:
+            entries.append([row[0], row[1], int(row[2])])
+        except (IndexError, ValueError):
+            msg = "invalid entry in journal {}".format(journalFile)
+            shared.errorExit(msg)
+
+    return entries
+
+
+def repairOutput(entries, prefixBatch, outDir, outputFormat="xml"):
+    """Make output files consistent with journal entries. Each output
+    file is truncated directly after the output of its last journaled PDF,
+    all but the last one are terminated (e.g. with a closing tag), and any
+    output files after the last journaled one are removed. An SQLite
+    database is repaired by removing all records after the last journaled
+    one. Returns number of last output file and number of PDFs in it, or
+    None if the journal is empty"""
+
+    writer = writers.outputWriters[outputFormat]
+
+    if outputFormat == "sqlite":
+        if len(entries) == 0:
+            return None
+        shared.checkFileExists(writer.getFileName(prefixBatch, outDir))
+        writer.repair(prefixBatch, outDir, entries[-1][2])
+        return 1, len(entries)
+
+    # Number of PDFs and last position for each output file
+    counts = {}
+    offsets = {}
+    for PDF, fileOut, offset in entries:
+        fName = os.path.basename(fileOut)
+        counts[fName] = counts.get(fName, 0) + 1
+        offsets[fName] = offset
+
+    lastOutFile = 0
+    while os.path.basename(writer.getFileName(prefixBatch, outDir, lastOutFile + 1)) in counts:
+        lastOutFile += 1
+
+    if lastOutFile != len(counts):
+        msg = "journal doesn't match output files with prefix {}".format(prefixBatch)
+        shared.errorExit(msg)
+
+    foot = writer.foot.encode('utf-8')
+
+    for outFileCount in range(1, lastOutFile + 1):
+        fileOut = writer.getFileName(prefixBatch, outDir, outFileCount)
+        shared.checkFileExists(fileOut)
+        offset = offsets[os.path.basename(fileOut)]
+        if os.path.getsize(fileOut) < offset:
+            msg = "output file {} is shorter than recorded in journal".format(fileOut)
+            shared.errorExit(msg)
+
+        with open(fileOut, 'r+b') as f:
+            f.truncate(offset)
+            f.seek(0)
+            data = f.read()
+            if outFileCount < lastOutFile:
+                f.write(foot)
+
+        # Check that output is well-formed
+        if not writer.isWellFormed(data):
+            msg = "output file {} is not well-formed".format(fileOut)
+            shared.errorExit(msg)
+
+    # Remove any output files that were started after the last journaled PDF
+    outFileCount = lastOutFile + 1
+    while os.path.isfile(writer.getFileName(prefixBatch, outDir, outFileCount)):
+        fileOut = writer.getFileName(prefixBatch, outDir, outFileCount)
+        logging.info(("removing output file {}").format(fileOut))
+        os.remove(fileOut)
+        outFileCount += 1
+
+    if lastOutFile == 0:
+        return None
+
+    lastFileOut = writer.getFileName(prefixBatch, outDir, lastOutFile)
+    return lastOutFile, counts[os.path.basename(lastFileOut)]
@@ -0,0 +1,191 @@
+#! /usr/bin/env python3
+
+"""PDF Quality Assessment for Digitisation batches
+
+Johan van der Knijff
+
+Copyright 2024, KB/National Library of the Netherlands
+
+Module for reading properties of JPEG 2000 images from the JP2 header boxes
+(ihdr, colr, res) and the main header of the codestream (SIZ, COD, QCD),
+without decoding any tile data
+
+"""
+
+import struct
+
+jp2Signature = b"\x00\x00\x00\x0cjP  \r\n\x87\n"
+socMarker = b"\xff\x4f"
+
+# Codestream markers
+markerSIZ = 0xff51
+markerCOD = 0xff52
+markerQCD = 0xff5c
+markerSOT = 0xff90
+
+progressionOrders = {0: "LRCP",
+                     1: "RLCP",
+                     2: "RPCL",
+                     3: "PCRL",
+                     4: "CPRL"}
+
+quantizationStyles = {0: "none",
+                      1: "scalar derived",
+                      2: "scalar expounded"}
+
+enumeratedColourSpaces = {12: "CMYK",
+                          16: "sRGB",
+                          17: "greyscale",
+                          18: "sYCC",
+                          20: "e-sRGB",
+                          24: "e-sYCC"}
+
+
+def iterBoxes(data, start, end):
+    """Yield type and start and end of contents of each box in data[start:end].
+    A box with length 0 extends to end"""
+    position = start
+    while position + 8 <= end:
+        length, boxType = struct.unpack_from(">I4s", data, position)
+        headerLength = 8
+        if length == 1:
+            if position + 16 > end:
+                return
+            length = struct.unpack_from(">Q", data, position + 8)[0]
+            headerLength = 16
+        elif length == 0:
+            length = end - position
+        if length < headerLength:
+            raise ValueError("invalid length of JP2 box {}".format(boxType))
+        yield boxType, position + headerLength, min(position + length, end)
+        position += length
+
+
+def findCodestream(data):
+    """Return position of codestream in data, or None if data don't contain
+    the start of the codestream (yet). Raises ValueError if data are not a
+    JP2 file or JPEG 2000 codestream"""
+    if data[:2] == socMarker:
+        return 0
+    if len(data) < len(jp2Signature):
+        return None
+    if data[:len(jp2Signature)] != jp2Signature:
+        raise ValueError("no JP2 signature or codestream")
+    for boxType, start, end in iterBoxes(data, 0, len(data)):
+        if boxType == b"jp2c":
+            return start
+    return None
+
+
+def iterMarkerSegments(data, position):
+    """Yield marker and contents of each marker segment of the main header
+    of the codestream at position. Stops at the first tile-part, or at the
+    end of data"""
+    if data[position:position + 2] != socMarker:
+        raise ValueError("codestream doesn't start with SOC marker")
+    position += 2
+    while position + 4 <= len(data):
+        marker, length = struct.unpack_from(">HH", data, position)
+        if marker == markerSOT:
+            return
+        if position + 2 + length > len(data):
+            return
+        yield marker, data[position + 4:position + 2 + length]
+        position += 2 + length
+
+
+def getHeaderLength(data):
+    """Return length of JP2 header boxes and codestream main header at start
+    of data, or None if data don't contain the complete header yet. If data
+    are not JPEG 2000, the length of data is returned, as more data won't
+    help to parse them"""
+    try:
+        position = findCodestream(data)
+    except ValueError:
+        return len(data)
+    if position is None or data[position:position + 2] != socMarker:
+        return None
+    position += 2
+    while position + 4 <= len(data):
+        marker, length = struct.unpack_from(">HH", data, position)
+        if marker == markerSOT:
+            return position
+        position += 2 + length
+    return None
+
+
+def getResolution(data, start, end):
+    """Return horizontal and vertical resolution (ppi) from resolution box
+    contents, using the capture resolution if available"""
+    boxes = {boxType: (boxStart, boxEnd) for boxType, boxStart, boxEnd in iterBoxes(data, start, end)}
+    for boxType in (b"resc", b"resd"):
+        if boxType in boxes and boxes[boxType][1] - boxes[boxType][0] >= 10:
+            vrN, vrD, hrN, hrD, vrE, hrE = struct.unpack_from(">HHHHbb", data, boxes[boxType][0])
+            if vrD == 0 or hrD == 0:
+                raise ValueError("invalid resolution in JP2 {} box".format(boxType.decode()))
+            # Resolution is in grid points per metre
+            return (round(hrN / hrD * 10**hrE * 0.0254, 2),
+                    round(vrN / vrD * 10**vrE * 0.0254, 2))
+    return None
+
+
+def getProperties(data):
+    """Return dictionary with properties from JP2 header boxes and codestream
+    main header, and embedded ICC profile (or None)"""
+    properties = {}
+    icc = None
+
+    position = findCodestream(data)
+    if position is None:
+        raise ValueError("no codestream found in JP2 file")
+
+    if position != 0:
+        for boxType, start, end in iterBoxes(data, 0, position):
+            if boxType != b"jp2h":
+                continue
+            for subType, subStart, subEnd in iterBoxes(data, start, end):
+                if subType == b"colr" and subEnd - subStart >= 3:
+                    method = data[subStart]
+                    if method == 1 and subEnd - subStart >= 7:
+                        enumCS = struct.unpack_from(">I", data, subStart + 3)[0]
+                        properties["colourSpace"] = enumeratedColourSpaces.get(enumCS, str(enumCS))
+                    elif method in (2, 3) and icc is None:
+                        properties["colourSpace"] = "ICC"
+                        icc = bytes(data[subStart + 3:subEnd])
+                elif subType == b"res ":
+                    resolution = getResolution(data, subStart, subEnd)
+                    if resolution is not None:
+                        properties["ppi_x"], properties["ppi_y"] = resolution
+
+    for marker, segment in iterMarkerSegments(data, position):
+        if marker == markerSIZ:
+            xSiz, ySiz, xOSiz, yOSiz, xTSiz, yTSiz, xTOSiz, yTOSiz, cSiz = \
+                struct.unpack_from(">IIIIIIIIH", segment, 2)
+            bitDepths = {(segment[36 + 3*i] & 0x7f) + 1 for i in range(cSiz)}
+            properties["bpc"] = max(bitDepths)
+            properties["tileWidth"] = xTSiz
+            properties["tileHeight"] = yTSiz
+            properties["noTiles"] = (-(-(xSiz - xTOSiz) // xTSiz)) * (-(-(ySiz - yTOSiz) // yTSiz))
+        elif marker == markerCOD:
+            sCod, progression, layers, mct, levels, xcb, ycb, cbStyle, transformation = \
+                struct.unpack_from(">BBHBBBBBB", segment)
+            properties["progressionOrder"] = progressionOrders.get(progression, str(progression))
+            properties["layers"] = layers
+            properties["decompositionLevels"] = levels
+            properties["codeBlockWidth"] = 2**(xcb + 2)
+            properties["codeBlockHeight"] = 2**(ycb + 2)
+            properties["precincts"] = bool(sCod & 1)
+            properties["transformation"] = "5-3 reversible" if transformation == 1 else "9-7 irreversible"
+        elif marker == markerQCD:
+            quantization = segment[0] & 0x1f
+            properties["quantization"] = quantizationStyles.get(quantization, str(quantization))
+
+    if "bpc" not in properties:
+        raise ValueError("missing SIZ marker segment in codestream")
+    if "transformation" not in properties:
+        raise ValueError("missing COD marker segment in codestream")
+
+    properties["reversible"] = properties["transformation"] == "5-3 reversible" and \
+        properties.get("quantization") == "none"
+
+    return properties, icc
@@ -12,6 +12,7 @@ https://www.bitsgalore.org/2024/10/30/jpeg-quality-estimation-using-simple-least
 """
 import math
 import argparse
+import functools
 from PIL import Image
 
 def parseCommandLine():
@@ -29,6 +30,62 @@ def parseCommandLine():
     return args
 
 
+# Standard JPEG luminance and chrominance quantization tables
+# for 50% quality (ISO/IEC 10918-1 : 1993(E)), Annex K)
+lum_base = [16, 11, 10, 16, 24, 40, 51, 61,
+            12, 12, 14, 19, 26, 58, 60, 55,
+            14, 13, 16, 24, 40, 57, 69, 56,
+            14, 17, 22, 29, 51, 87, 80, 62,
+            18, 22, 37, 56, 68, 109, 103, 77,
+            24, 35, 55, 64, 81, 104, 113, 92,
+            49, 64, 78, 87, 103, 121, 120, 101,
+            72, 92, 95, 98, 112, 100, 103, 99]
+
+chrom_base = [17, 18, 24, 47, 99, 99, 99, 99,
+              18, 21, 26, 66, 99, 99, 99, 99,
+              24, 26, 56, 99, 99, 99, 99, 99,
+              47, 66, 99, 99, 99, 99, 99, 99,
+              99, 99, 99, 99, 99, 99, 99, 99,
+              99, 99, 99, 99, 99, 99, 99, 99,
+              99, 99, 99, 99, 99, 99, 99, 99,
+              99, 99, 99, 99, 99, 99, 99, 99]
+
+
+def computeStandardTables(baseTable, qBitDepth):
+    """Return list with standard quantization tables for all quality
+    levels 1-100, generated from baseTable using Equations 1 and 2
+    in Kornblum (2008). For bit depth 8 all values are capped at 255"""
+
+    tables = []
+
+    for i in range(100):
+        # Quality level
+        Q = i+1
+        # Scaling factor (Eq 1 in Kornblum, 2008)
+        if Q < 50:
+            S = 5000/Q
+        else:
+            S = 200 - 2*Q
+
+        # Compute standard table values from scaling factor
+        # (Eq 2 in Kornblum, 2008)
+        table = [max(math.floor((S*base + 50) / 100), 1) for base in baseTable]
+        # Cap values at 255 if bit depth is 8
+        if qBitDepth == 8:
+            table = [min(value, 255) for value in table]
+        tables.append(table)
+
+    return tables
+
+
+# Standard tables for all quality levels, for 8 and 16 bit quantization
+# tables. These are computed only once at import time
+standardTables = {8: (computeStandardTables(lum_base, 8),
+                      computeStandardTables(chrom_base, 8)),
+                  16: (computeStandardTables(lum_base, 16),
+                       computeStandardTables(chrom_base, 16))}
+
+
 def computeJPEGQuality(image):
     """Estimates JPEG quality using least squares matching between image
     quantization tables and standard tables from the JPEG ISO standard.
@@ -44,110 +101,63 @@ def computeJPEGQuality(image):
     and Nash-Sutcliffe Efficiency measure.
     """
 
-    # Standard JPEG luminance and chrominance quantization tables
-    # for 50% quality (ISO/IEC 10918-1 : 1993(E)), Annex K)
-    lum_base = [16, 11, 10, 16, 24, 40, 51, 61,
-                12, 12, 14, 19, 26, 58, 60, 55,
-                14, 13, 16, 24, 40, 57, 69, 56,
-                14, 17, 22, 29, 51, 87, 80, 62,
-                18, 22, 37, 56, 68, 109, 103, 77,
-                24, 35, 55, 64, 81, 104, 113, 92,
-                49, 64, 78, 87, 103, 121, 120, 101,
-                72, 92, 95, 98, 112, 100, 103, 99]
-
-    chrom_base = [17, 18, 24, 47, 99, 99, 99, 99,
-                  18, 21, 26, 66, 99, 99, 99, 99,
-                  24, 26, 56, 99, 99, 99, 99, 99,
-                  47, 66, 99, 99, 99, 99, 99, 99,
-                  99, 99, 99, 99, 99, 99, 99, 99,
-                  99, 99, 99, 99, 99, 99, 99, 99,
-                  99, 99, 99, 99, 99, 99, 99, 99,
-                  99, 99, 99, 99, 99, 99, 99, 99]
-
     # Image quantization tables
     qdict = image.quantization
     noTables = len(qdict)
 
+    lumTable = tuple(qdict[0])
+    if noTables >= 2:
+        chromTable = tuple(qdict[1])
+    else:
+        chromTable = None
+
+    return computeQualityFromTables(lumTable, chromTable, noTables)
+
+
+@functools.lru_cache(maxsize=256)
+def computeQualityFromTables(lumTable, chromTable, noTables):
+    """Estimates JPEG quality from luminance and (optionally) chrominance
+    quantization tables. Results are memoized, since all images in a
+    digitisation batch typically share identical quantization tables"""
+
     # Default quantization table bit depth
     qBitDepth = 8
 
-    if max(qdict[0]) > 255:
+    if max(lumTable) > 255:
         # Any values greater than 255 indicate bir depth 16 
         qBitDepth = 16
-    if noTables >= 2:
-        if max(qdict[1]) > 255:
+    if chromTable is not None:
+        if max(chromTable) > 255:
             qBitDepth = 16
 
+    lumStandard, chromStandard = standardTables[qBitDepth]
+
     # Calculate mean of all value in quantization tables
-    Tsum = sum(qdict[0])
-    if noTables >= 2:
-        Tsum += sum(qdict[1])
+    Tsum = sum(lumTable)
+    if chromTable is not None:
+        Tsum += sum(chromTable)
     Tmean = Tsum / (noTables*64)
 
-    # List for storing squared error values
-    errors = []
-
-    # List for storing Nash–Sutcliffe Efficiency values
-    nseVals = []
-
-    # Iterate over all quality levels
-    for i in range(100):
-        # Quality level
-        Q = i+1
-        # Scaling factor (Eq 1 in Kornblum, 2008)
-        if Q < 50:
-            S = 5000/Q
-        else:
-            S = 200 - 2*Q
-
-        # Initialize sum of squared differences between image quantization values
-        # and corresponding values from standard q tables for this quality level
-        sumSqErrors = 0
-
-        # Initialize sum of squared differences between image quantization values
-        # and mean image quantization value (needed to calculate Nash Efficiency)
-        sumSqMean = 0
-
-        # Iterate over all values in quantization tables for this quality
-        for j in range(64):
-            # Compute standard luminance table value from scaling factor
-            # (Eq 2 in Kornblum, 2008)
-            Tslum = max(math.floor((S*lum_base[j] + 50) / 100), 1)
-            # Cap Tslum at 255 if bit depth is 8
-            if qBitDepth == 8:
-                Tslum = min(Tslum, 255)
-            # Update sum of squared errors relative to corresponding
-            # image table value
-            sumSqErrors += (qdict[0][j] - Tslum)**2
-
-            # Sum of luminance and chrominance values          
-            Tcombi = qdict[0][j]
-
-            if noTables >= 2:
-                # Compute standard chrominance table value from scaling factor
-                # (Eq 2 in Kornblum, 2008)
-                Tschrom = max(math.floor((S*chrom_base[j] + 50) / 100), 1)
-                # Cap Tschrom at 255 if bit depth is 8
-                if qBitDepth == 8:
-                    Tschrom = min(Tschrom, 255)
-                # Update sum of squared errors relative to corresponding
-                # image table value
-                sumSqErrors  += (qdict[1][j] - Tschrom)**2
-
-                # Update sum of luminance and chrominance values
-                Tcombi += qdict[1][j]
-
-            # Update sumSqMMean
-            sumSqMean += (Tcombi - Tmean)**2
-
-            j += 1
-
-        # Calculate Nash-Sutcliffe Effiency
-        nse = 1 - sumSqErrors/sumSqMean
-
-        # Add calculated statistics to lists
-        errors.append(sumSqErrors)
-        nseVals.append(nse)
+    # Sum of squared differences between image quantization values
+    # and mean image quantization value (needed to calculate Nash Efficiency).
+    # This is the same for all quality levels
+    sumSqMean = 0
+    for j in range(64):
+        # Sum of luminance and chrominance values
+        Tcombi = lumTable[j]
+        if chromTable is not None:
+            Tcombi += chromTable[j]
+        sumSqMean += (Tcombi - Tmean)**2
+
+    # Sums of squared differences between image quantization values
+    # and corresponding values from standard q tables, for all quality levels
+    errors = [sum((T - Ts)**2 for T, Ts in zip(lumTable, Tslum)) for Tslum in lumStandard]
+    if chromTable is not None:
+        errors = [sumSqErrors + sum((T - Ts)**2 for T, Ts in zip(chromTable, Tschrom))
+                  for sumSqErrors, Tschrom in zip(errors, chromStandard)]
+
+    # Nash-Sutcliffe Effiency values for all quality levels
+    nseVals = [1 - sumSqErrors/sumSqMean for sumSqErrors in errors]
 
     # Quality is estimated as level with smallest sum of squared errors
     # Note that this will return the smallest quality level in case
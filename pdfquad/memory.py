@@ -0,0 +1,53 @@
+#! /usr/bin/env python3
+
+"""PDF Quality Assessment for Digitisation batches
+
+Johan van der Knijff
+
+Copyright 2024, KB/National Library of the Netherlands
+
+Module for measuring the peak memory use (resident set size) of the
+current process
+
+"""
+
+import sys
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows
+    resource = None
+
+
+def resetPeakRSS():
+    """Reset peak resident set size of the current process, so that the
+    peak of the next PDF can be measured. This is only possible on Linux.
+    Returns True if the peak was reset"""
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+        return True
+    except OSError:
+        return False
+
+
+def getPeakRSS():
+    """Return peak resident set size of the current process in bytes,
+    or None if it is not available. Unless resetPeakRSS was successful,
+    this is the peak since the start of the process"""
+    try:
+        with open("/proc/self/status", "r") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+
+    if resource is None:
+        return None
+    maxRSS = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Reported in bytes on macOS, and in kilobytes elsewhere
+    if sys.platform == "darwin":
+        return maxRSS
+    return maxRSS * 1024
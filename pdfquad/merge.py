@@ -0,0 +1,267 @@
+#! /usr/bin/env python3
+
+"""PDF Quality Assessment for Digitisation batches
+
+Johan van der Knijff
+
+Copyright 2024, KB/National Library of the Netherlands
+
+Module with code for merging the output of a batch that was processed
+in shards (possibly on different machines) into the output of a single run
+
+"""
+
+import os
+import re
+import csv
+import logging
+import sqlite3
+import contextlib
+from . import shared
+from . import writers
+from . import journal
+from . import timings
+from . import stats
+
+
+def getShardPrefix(prefixBatch, shardNo, noShards):
+    """Return output prefix of shard shardNo of noShards"""
+    return ("{}_shard{}of{}").format(prefixBatch, shardNo, noShards)
+
+
+def getTreeOrderKey(PDF):
+    """Return sort key that orders PDFs in the same way as a sorted
+    directory walk: files in a directory come before its subdirectories,
+    and both are sorted by name"""
+    components = os.path.abspath(PDF).split(os.sep)
+    key = [(1, component) for component in components[:-1]]
+    key.append((0, components[-1]))
+    return key
+
+
+def findShards(prefixBatch, outDir):
+    """Return number of shards of batch in outDir, and exit if the
+    output of any shard is missing"""
+    pattern = re.compile(re.escape(prefixBatch) + r"_shard([0-9]+)of([0-9]+)_journal\.csv$")
+    shards = set()
+    for fName in os.listdir(outDir):
+        match = pattern.match(fName)
+        if match is not None:
+            shards.add((int(match.group(1)), int(match.group(2))))
+
+    if len(shards) == 0:
+        msg = "no shard output with prefix {} found in {}".format(prefixBatch, outDir)
+        shared.errorExit(msg)
+
+    noShards = max(shard[1] for shard in shards)
+    missing = [str(shardNo) for shardNo in range(1, noShards + 1)
+               if (shardNo, noShards) not in shards]
+    if len(missing) != 0 or len(shards) != noShards:
+        msg = "output of shard(s) {} of {} is missing".format(", ".join(missing), noShards)
+        shared.errorExit(msg)
+
+    return noShards
+
+
+def readHeader(csvFile, headers):
+    """Return header of CSV file, and exit if it isn't one of headers"""
+    shared.checkFileExists(csvFile)
+    with open(csvFile, 'r', newline='', encoding='utf-8') as f:
+        header = next(csv.reader(f), None)
+    if header not in headers:
+        msg = "unexpected header in {}".format(csvFile)
+        shared.errorExit(msg)
+    return header
+
+
+def readRows(csvFile, header):
+    """Return dictionary with rows of CSV file, using the first column as key"""
+    shared.checkFileExists(csvFile)
+    rows = {}
+    with open(csvFile, 'r', newline='', encoding='utf-8') as f:
+        reader = csv.reader(f)
+        if next(reader, None) != header:
+            msg = "unexpected header in {}".format(csvFile)
+            shared.errorExit(msg)
+        for row in reader:
+            rows[row[0]] = row
+    return rows
+
+
+def getOutputFormat(fileOut):
+    """Return output format of output file, based on its extension"""
+    extension = os.path.splitext(fileOut)[1][1:]
+    for outputFormat, writer in writers.outputWriters.items():
+        if writer.extension == extension:
+            return outputFormat
+    msg = "unknown output format of {}".format(fileOut)
+    shared.errorExit(msg)
+
+
+def readShard(shardPrefix, outDir, summaryHeader, timingsFlag):
+    """Return list with for each PDF in shard the file name, the format and
+    location of its output in the shard's output files, its summary row and
+    (if timingsFlag is True) its timings row"""
+    journalFile = os.path.join(outDir, ("{}_journal.csv").format(shardPrefix))
+    summaryFile = os.path.join(outDir, ("{}_summary.csv").format(shardPrefix))
+    timingsFile = os.path.join(outDir, ("{}_timings.csv").format(shardPrefix))
+
+    summaryRows = readRows(summaryFile, summaryHeader)
+    if timingsFlag:
+        timingsRows = readRows(timingsFile, timings.getHeader())
+
+    # Output of each PDF starts where the output of the previous PDF in
+    # the same output file ends (or directly after the header). For SQLite
+    # output, the offset is the row id of the PDF's record
+    entries = []
+    lastFileOut = None
+    for PDF, fileOut, offset in journal.readJournal(journalFile):
+        fileOut = os.path.join(outDir, os.path.basename(fileOut))
+        outputFormat = getOutputFormat(fileOut)
+        if fileOut != lastFileOut:
+            if outputFormat == "sqlite":
+                start = 0
+            else:
+                start = len(writers.outputWriters[outputFormat].head.encode('utf-8'))
+            lastFileOut = fileOut
+        if PDF not in summaryRows:
+            msg = "no entry for {} in {}".format(PDF, summaryFile)
+            shared.errorExit(msg)
+        entry = {"file": PDF,
+                 "format": outputFormat,
+                 "location": (shardPrefix, fileOut, start, offset),
+                 "summary": summaryRows[PDF],
+                 "timings": None}
+        if timingsFlag:
+            if PDF not in timingsRows:
+                msg = "no entry for {} in {}".format(PDF, timingsFile)
+                shared.errorExit(msg)
+            entry["timings"] = timingsRows[PDF]
+        entries.append(entry)
+        start = offset
+
+    return entries
+
+
+def readOutput(location, openFiles):
+    """Return output of one PDF from shard output file. Each shard's output
+    files are read in order, so only one output file per shard is kept open"""
+    shardPrefix, fileOut, start, end = location
+    if shardPrefix not in openFiles or openFiles[shardPrefix][0] != fileOut:
+        shared.checkFileExists(fileOut)
+        if shardPrefix in openFiles:
+            openFiles[shardPrefix][1].close()
+        if getOutputFormat(fileOut) == "sqlite":
+            openFiles[shardPrefix] = (fileOut, sqlite3.connect(fileOut))
+        else:
+            openFiles[shardPrefix] = (fileOut, open(fileOut, 'rb'))
+    f = openFiles[shardPrefix][1]
+    if isinstance(f, sqlite3.Connection):
+        row = f.execute("""SELECT record FROM files WHERE id = ?""", (end,)).fetchone()
+        if row is None:
+            msg = "no record {} in {}".format(end, fileOut)
+            shared.errorExit(msg)
+        return (row[0] + "\n").encode('utf-8')
+    f.seek(start)
+    return f.read(end - start)
+
+
+def mergeStats(statsFiles, noPDFs, statsJSONFile, statsCSVFile):
+    """Merge statistics of all shards, and write them to the statistics
+    files of the batch. Exits if they don't cover all noPDFs PDFs"""
+    batchStats = stats.BatchStats()
+    for statsFile in statsFiles:
+        try:
+            batchStats.merge(stats.BatchStats.read(statsFile))
+        except (ValueError, KeyError, TypeError):
+            msg = "cannot read statistics from {}".format(statsFile)
+            shared.errorExit(msg)
+    if batchStats.noPDFs != noPDFs:
+        msg = "statistics of shards cover {} PDFs instead of {}".format(batchStats.noPDFs, noPDFs)
+        shared.errorExit(msg)
+    batchStats.write(statsJSONFile, statsCSVFile)
+
+
+def mergeShards(prefixBatch, outDir, maxPDFs, flushInterval, summaryHeaders):
+    """Merge output of all shards of batch into the output files of a
+    single run, using the same order, output format and splitting of
+    output files.
+    The summary files of all shards must have the same header, which
+    must be one of summaryHeaders"""
+
+    noShards = findShards(prefixBatch, outDir)
+    shardPrefixes = [getShardPrefix(prefixBatch, shardNo, noShards)
+                     for shardNo in range(1, noShards + 1)]
+
+    # Header of first shard's summary file, which depends on the options used
+    summaryHeader = readHeader(os.path.join(outDir, ("{}_summary.csv").format(shardPrefixes[0])),
+                               summaryHeaders)
+    fileOutColumn = summaryHeader.index("fileOut")
+
+    # Timings are merged only if they were reported for all shards
+    timingsFiles = [os.path.join(outDir, ("{}_timings.csv").format(shardPrefix))
+                    for shardPrefix in shardPrefixes]
+    timingsFlag = all(os.path.isfile(timingsFile) for timingsFile in timingsFiles)
+    # Same for the statistics
+    statsFiles = [os.path.join(outDir, ("{}_stats.json").format(shardPrefix))
+                  for shardPrefix in shardPrefixes]
+    statsFlag = all(os.path.isfile(statsFile) for statsFile in statsFiles)
+
+    entries = []
+    for shardPrefix in shardPrefixes:
+        shardEntries = readShard(shardPrefix, outDir, summaryHeader, timingsFlag)
+        logging.info(("shard {}: {} PDFs").format(shardPrefix, len(shardEntries)))
+        entries += shardEntries
+
+    # Restore order of single run. The output of each shard is already
+    # in this order, so the output files of each shard are read sequentially
+    entries.sort(key=lambda entry: getTreeOrderKey(entry["file"]))
+    outputFormats = set(entry["format"] for entry in entries)
+    if len(outputFormats) > 1:
+        msg = "shards have different output formats ({})".format(", ".join(sorted(outputFormats)))
+        shared.errorExit(msg)
+    outputFormat = outputFormats.pop() if len(outputFormats) == 1 else "xml"
+    for i in range(1, len(entries)):
+        if entries[i]["file"] == entries[i-1]["file"]:
+            msg = "{} occurs in more than one shard".format(entries[i]["file"])
+            shared.errorExit(msg)
+
+    summaryFile = os.path.join(outDir, ("{}_summary.csv").format(prefixBatch))
+    timingsFile = os.path.join(outDir, ("{}_timings.csv").format(prefixBatch))
+    journalFile = os.path.join(outDir, ("{}_journal.csv").format(prefixBatch))
+    statsJSONFile = os.path.join(outDir, ("{}_stats.json").format(prefixBatch))
+    statsCSVFile = os.path.join(outDir, ("{}_stats.csv").format(prefixBatch))
+
+    openFiles = {}
+    with contextlib.ExitStack() as stack:
+        stack.callback(lambda: [f.close() for fileOut, f in openFiles.values()])
+        summaryWriter = stack.enter_context(writers.CSVWriter(summaryFile,
+                                                              summaryHeader,
+                                                              flushInterval))
+        outputWriter = stack.enter_context(writers.outputWriters[outputFormat](prefixBatch,
+                                                                               outDir,
+                                                                               maxPDFs,
+                                                                               flushInterval))
+        outputs = [outputWriter, summaryWriter]
+        if timingsFlag:
+            timingsWriter = stack.enter_context(writers.CSVWriter(timingsFile,
+                                                                  timings.getHeader(),
+                                                                  flushInterval))
+            outputs.append(timingsWriter)
+        journalWriter = stack.enter_context(writers.JournalWriter(journalFile,
+                                                                  outputs,
+                                                                  flushInterval))
+
+        for entry in entries:
+            fileOut = outputWriter.write(readOutput(entry["location"], openFiles))
+            summaryRow = entry["summary"]
+            summaryRow[fileOutColumn] = fileOut
+            summaryWriter.write(summaryRow)
+            if timingsFlag:
+                timingsWriter.write(entry["timings"])
+            journalWriter.write(entry["file"], fileOut, outputWriter.tell())
+
+    if statsFlag:
+        mergeStats(statsFiles, len(entries), statsJSONFile, statsCSVFile)
+
+    return len(entries)
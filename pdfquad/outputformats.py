@@ -0,0 +1,100 @@
+#! /usr/bin/env python3
+
+"""PDF Quality Assessment for Digitisation batches
+
+Johan van der Knijff
+
+Copyright 2024, KB/National Library of the Netherlands
+
+Module for serializing the output of a PDF (file element) in the supported
+output formats. The JSON Lines and SQLite formats both use a JSON record
+that mirrors the structure of the XML output
+
+"""
+
+import json
+from lxml import etree
+
+# Supported output formats
+formats = ["xml", "jsonl", "sqlite"]
+
+svrlNamespace = "http://purl.oclc.org/dsdl/svrl"
+
+# Elements that are converted to a list of their child elements
+listTags = {"pages", "annotations", "exceptions", "objectTypes"}
+# Elements that can occur more than once, which are collected in a list
+repeatedTags = {"image", "stage"}
+
+
+def eltToJSON(elt):
+    """Return element as JSON value. Elements without children and attributes
+    become strings. Other elements become objects, with the attributes, the
+    child elements and (for elements without children) the text as "value" """
+    if elt.tag in listTags:
+        return [eltToJSON(child) for child in elt if isinstance(child.tag, str)]
+    attrib = elt.attrib
+    if len(elt) == 0:
+        if len(attrib) == 0:
+            return elt.text or ""
+        value = dict(attrib)
+        if elt.text is not None:
+            value["value"] = elt.text
+        return value
+    value = dict(attrib)
+    for child in elt:
+        tag = child.tag
+        if not isinstance(tag, str):
+            # Comment or processing instruction
+            continue
+        if tag in repeatedTags:
+            value.setdefault(tag, []).append(eltToJSON(child))
+        else:
+            value[tag] = eltToJSON(child)
+    return value
+
+
+def getFailedAssertions(reportElt):
+    """Return list with test, location and text of each failed assertion in
+    Schematron report element"""
+    failedAssertions = []
+    for assertElt in reportElt.iter("{{{}}}failed-assert".format(svrlNamespace)):
+        text = assertElt.findtext("{{{}}}text".format(svrlNamespace), "")
+        failedAssertions.append({"test": assertElt.get("test", ""),
+                                 "location": assertElt.get("location", ""),
+                                 "text": " ".join(text.split())})
+    return failedAssertions
+
+
+def getRecord(pdfElt):
+    """Return JSON record for file element. The Schematron report is reduced
+    to the list of failed assertions"""
+    record = {}
+    for child in pdfElt.iterchildren(tag=etree.Element):
+        if child.tag == "schematronReport":
+            record["failedAssertions"] = getFailedAssertions(child)
+        else:
+            record[child.tag] = eltToJSON(child)
+    return record
+
+
+def serializeRecord(record):
+    """Return JSON record as one line of UTF-8 encoded JSON"""
+    return (json.dumps(record, ensure_ascii=False, separators=(",", ":")) + "\n").encode('utf-8')
+
+
+def serialize(pdfElt, outputFormat):
+    """Return file element serialized for outputFormat"""
+    if outputFormat == "xml":
+        return etree.tostring(pdfElt,
+                              method='xml',
+                              encoding='utf-8',
+                              xml_declaration=False,
+                              pretty_print=True)
+    return serializeRecord(getRecord(pdfElt))
+
+
+def parseRecord(output, outputFormat):
+    """Return JSON record from output that was serialized for outputFormat"""
+    if outputFormat == "xml":
+        return getRecord(etree.fromstring(output))
+    return json.loads(output)
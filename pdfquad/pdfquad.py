@@ -12,16 +12,36 @@ import sys
 import os
 import shutil
 import time
+import signal
+import contextlib
 import argparse
-import csv
 import logging
+import functools
+import multiprocessing
 from lxml import etree
 from . import properties
 from . import schematron
 from . import shared
+from . import cache
+from . import writers
+from . import timings
+from . import memory
+from . import journal
+from . import merge
+from . import sampling
+from . import prefetch
+from . import stats
+from . import outputformats
 
 __version__ = "0.3.0"
 
+# Columns of summary file
+summaryHeader = ["file", "validationSuccess", "validationOutcome", "noPages", "fileOut"]
+# Additional summary columns if pages are sampled
+samplingHeader = ["pageSampling", "noSampledPages"]
+# Format of log messages
+logFormat = '%(asctime)s - %(levelname)s - %(message)s'
+
 # Create parser
 parser = argparse.ArgumentParser(description="PDF QUality Assessment for Digitisation batches")
 
@@ -54,10 +74,145 @@ def parseCommandLine():
                                 action="store",
                                 default=os.getcwd(),
                                 help="output directory")
+    parser_process.add_argument('--flushinterval', '-f',
+                                action="store",
+                                type=float,
+                                default=5,
+                                help="time interval (seconds) at which buffered output \
+                                    is written to the output files")
+    parser_process.add_argument('--sort', '-s',
+                                action="store_true",
+                                default=False,
+                                help="process files in each directory in sorted order")
     parser_process.add_argument('--verbose', '-b',
                                 action="store_true",
                                 default=False,
                                 help="report Schematron report in verbose format")
+    parser_process.add_argument('--decode-check', '-d',
+                                action="store_true",
+                                dest="decodecheck",
+                                default=False,
+                                help="fully decode all JPEG images to detect corrupted \
+                                    image data (slow)")
+    parser_process.add_argument('--timings', '-t',
+                                action="store_true",
+                                default=False,
+                                help="report processing times for each PDF and \
+                                    processing stage")
+    parser_process.add_argument('--workers', '-w',
+                                action="store",
+                                type=int,
+                                default=1,
+                                help="number of worker processes used to process PDFs \
+                                    in parallel")
+    parser_process.add_argument('--resume', '-u',
+                                action="store_true",
+                                default=False,
+                                help="resume interrupted run of batch, using the journal \
+                                    and output files of that run")
+    parser_process.add_argument('--cache', '-i',
+                                action="store_true",
+                                dest="usecache",
+                                default=False,
+                                help="use results cache, so PDFs that haven't changed \
+                                    since an earlier run are not processed again")
+    parser_process.add_argument('--no-cache', '-n',
+                                action="store_false",
+                                dest="usecache",
+                                default=False,
+                                help="don't use results cache, and process all PDFs \
+                                    (default)")
+    parser_process.add_argument('--rehash', '-r',
+                                action="store_true",
+                                default=False,
+                                help="also check content hash of PDFs before using \
+                                    cached results")
+    parser_process.add_argument('--shard', '-a',
+                                action="store",
+                                default=None,
+                                help="only process shard i of N of the batch, specified as i/N; \
+                                    implies --sort (use \"pdfquad merge\" to combine the output \
+                                    of all shards)")
+    parser_process.add_argument('--full-properties', '-l',
+                                action="store_true",
+                                dest="fullproperties",
+                                default=False,
+                                help="extract all properties, including those that aren't \
+                                    used by the schema")
+    parser_process.add_argument('--sample-pages', '-g',
+                                action="store",
+                                dest="samplepages",
+                                default=None,
+                                help="only analyse a sample of the pages of each PDF, specified \
+                                    as a comma-separated list of a page count (e.g. 20), \
+                                    a fraction (e.g. 0.1), firstK, lastK or everyK")
+    parser_process.add_argument('--stream-pages', '-m',
+                                action="store_true",
+                                dest="streampages",
+                                default=False,
+                                help="release MuPDF's resources of each page once it is analysed, \
+                                    so its resource store doesn't grow with the number of pages")
+    parser_process.add_argument('--prefetch', '-e',
+                                action="store",
+                                type=int,
+                                default=0,
+                                help="read up to this number of PDFs ahead on background \
+                                    threads, which helps if the batch is on slow (e.g. network) \
+                                    storage")
+    parser_process.add_argument('--prefetch-budget', '-k',
+                                action="store",
+                                type=int,
+                                dest="prefetchbudget",
+                                default=256,
+                                help="maximum combined size (in MB) of PDFs that are read ahead")
+    parser_process.add_argument('--mmap', '-y',
+                                action="store_true",
+                                default=False,
+                                help="memory-map each PDF, so it is read from disk only once \
+                                    for its size, checksum and parsing")
+    parser_process.add_argument('--checksum', '-c',
+                                action="store",
+                                choices=["md5", "sha256"],
+                                default=None,
+                                help="report checksum of each PDF, computed with this algorithm")
+    parser_process.add_argument('--stats', '-z',
+                                action="store_true",
+                                default=False,
+                                help="write batch-level statistics (validation outcomes, pages \
+                                    per PDF, JPEG quality, resolution, failed assertions) to \
+                                    JSON and CSV files")
+    parser_process.add_argument('--format', '-j',
+                                action="store",
+                                choices=outputformats.formats,
+                                dest="outputformat",
+                                default="xml",
+                                help="format of output files: XML, JSON Lines or an SQLite \
+                                    database")
+    parser_merge = subparsers.add_parser('merge',
+                                         help='merge output of sharded batch')
+    parser_merge.add_argument('batchDir',
+                              action="store",
+                              help="batch directory")
+    parser_merge.add_argument('--maxpdfs', '-x',
+                              action="store",
+                              default=10,
+                              help="maximum number of reported PDFs per output file; for larger numbers \
+                                  output is split across multiple files")
+    parser_merge.add_argument('--prefixout', '-p',
+                              action="store",
+                              default='pq',
+                              help="prefix of output files")
+    parser_merge.add_argument('--outdir', '-o',
+                              action="store",
+                              default=os.getcwd(),
+                              help="directory with output of all shards, merged output \
+                                  is written to the same directory")
+    parser_merge.add_argument('--flushinterval', '-f',
+                              action="store",
+                              type=float,
+                              default=5,
+                              help="time interval (seconds) at which buffered output \
+                                  is written to the output files")
     parser_list = subparsers.add_parser('list',
                                         help='list available profiles and schemas')
     parser_copyps = subparsers.add_parser('copyps',
@@ -74,9 +229,13 @@ def parseCommandLine():
     return args
 
 
-def getFilesFromTree(rootDir, extensionString):
+def getFilesFromTree(rootDir, extensionString, sortFlag=False):
     """Walk down whole directory tree (including all subdirectories) and
-    return list of those files whose extension contains user defined string
+    yield those files whose extension contains user defined string.
+    Files are yielded as soon as they are found, in the same order as
+    os.walk (top-down). If sortFlag is True, the entries within each
+    directory are sorted by name, which makes the order reproducible
+    across file systems.
     NOTE: directory names are disabled here!!
     implementation is case insensitive (all search items converted to
     upper case internally!
@@ -84,39 +243,97 @@ def getFilesFromTree(rootDir, extensionString):
 
     extensionString = extensionString.upper()
 
-    filesList = []
-
-    for dirname, dirnames, filenames in os.walk(rootDir):
-        # Suppress directory names
-        for subdirname in dirnames:
-            thisDirectory = os.path.join(dirname, subdirname)
-
-        for filename in filenames:
-            thisFile = os.path.join(dirname, filename)
-            thisExtension = os.path.splitext(thisFile)[1]
-            thisExtension = thisExtension.upper()
-            if extensionString.strip() == '*' or extensionString in thisExtension:
-                filesList.append(thisFile)
-    return filesList
+    # Stack of directories that remain to be scanned
+    dirsToScan = [rootDir]
 
+    while dirsToScan:
+        dirname = dirsToScan.pop()
+        try:
+            with os.scandir(dirname) as it:
+                entries = list(it)
+        except OSError:
+            # Skip directories that cannot be read, like os.walk does
+            continue
 
-def writeXMLHeader(fileOut):
-    """Write XML header"""
-    xmlHead = "<?xml version='1.0' encoding='UTF-8'?>\n"
-    xmlHead += "<pdfquad>\n"
-    with open(fileOut,"wb") as f:
-        f.write(xmlHead.encode('utf-8'))
+        if sortFlag:
+            entries.sort(key=lambda entry: entry.name)
 
+        subDirs = []
 
-def writeXMLFooter(fileOut):
-    """Write XML footer"""
-    xmlFoot = "</pdfquad>\n"
-    with open(fileOut,"ab") as f:
-        f.write(xmlFoot.encode('utf-8'))
-
-
-def processPDF(PDF, verboseFlag, schemas):
-    """Process one PDF"""
+        for entry in entries:
+            try:
+                isDir = entry.is_dir()
+            except OSError:
+                isDir = False
+            if isDir:
+                # Symbolic links to directories are not followed
+                if not entry.is_symlink():
+                    subDirs.append(entry.path)
+            else:
+                thisExtension = os.path.splitext(entry.name)[1]
+                thisExtension = thisExtension.upper()
+                if extensionString.strip() == '*' or extensionString in thisExtension:
+                    yield entry.path
+
+        # Add subdirectories in reverse order, so they are scanned in listed order
+        dirsToScan.extend(reversed(subDirs))
+
+
+def parseShard(shardString):
+    """Parse shard specification i/N, and return shard number i and
+    number of shards N"""
+    try:
+        shardNo, noShards = [int(value) for value in shardString.split("/")]
+    except ValueError:
+        shardNo, noShards = 0, 0
+    if noShards < 1 or not 1 <= shardNo <= noShards:
+        msg = ("invalid shard {}, expected i/N with 1 <= i <= N".format(shardString))
+        shared.errorExit(msg)
+    return shardNo, noShards
+
+
+def getShard(listPDFs, shardNo, noShards):
+    """Return PDFs in shard shardNo (1-based) of noShards. Going from the
+    largest to the smallest PDF, each PDF is assigned to the shard with the
+    smallest total size so far, which gives shards of about equal size.
+    Ties are resolved by position in listPDFs, so the result only depends on
+    the list and the file sizes. Within the shard, PDFs keep their order"""
+
+    listPDFs = list(listPDFs)
+    sizes = [os.path.getsize(myPDF) for myPDF in listPDFs]
+    totals = [0] * noShards
+    selected = []
+
+    for i in sorted(range(len(listPDFs)), key=lambda i: (-sizes[i], i)):
+        shard = totals.index(min(totals))
+        totals[shard] += sizes[i]
+        if shard == shardNo - 1:
+            selected.append(i)
+
+    return [listPDFs[i] for i in sorted(selected)]
+
+
+def getSamplingColumns(sampleSpec, noPages):
+    """Return values of sampling columns of summary file for PDF with
+    noPages pages. The number of sampled pages follows from the number
+    of pages, so it's also available for cached results"""
+    try:
+        noSampledPages = len(sampling.getSampledPages(sampleSpec, int(noPages)))
+    except ValueError:
+        noSampledPages = "na"
+    return [sampling.specToString(sampleSpec), noSampledPages]
+
+
+def processPDF(PDF, verboseFlag, decodeCheckFlag, schemas, timer=timings.NullTimer(),
+               fullPropertiesFlag=True, sampleSpec=None, streamFlag=False, mmapFlag=False,
+               checksumType=None, data=None):
+    """Process one PDF. If fullPropertiesFlag is False, extraction stages
+    whose properties aren't used by the matching schema are skipped. If
+    sampleSpec is not None, only a sample of the pages is analysed. If
+    streamFlag is True, page resources are released after each page. If
+    mmapFlag is True, the PDF is memory-mapped, and if checksumType is not
+    None, its checksum is computed. If data is not None, the PDF is opened
+    from these (prefetched) data"""
 
     # Create output element for this PDF
     pdfElt = etree.Element("file")
@@ -129,14 +346,25 @@ def processPDF(PDF, verboseFlag, schemas):
     # Select schema based on directory or file name pattern defined in profile
     schemaMatchFlag, mySchema = schematron.findSchema(PDF, schemas)
     
-    # Extract properties
-    propertiesElt = properties.getProperties(PDF)
+    # Optional extraction stages that are needed for validation. All stages
+    # are run if there's no schema match, so the output is still complete
+    if fullPropertiesFlag or not schemaMatchFlag:
+        stages = None
+    else:
+        stages = schematron.getRequiredStages(mySchema)
+
+    # Extract properties, and convert the resulting record to an
+    # Element object once extraction is finished
+    propertiesElt = properties.getProperties(PDF, decodeCheckFlag, timer, stages,
+                                             sampleSpec, streamFlag, data, mmapFlag,
+                                             checksumType).toElt()
 
     # Validate extracted properties against schema
     if schemaMatchFlag:
-        validationSuccess, validationOutcome, reportElt = schematron.validate(mySchema,
-                                                                              propertiesElt,
-                                                                              verboseFlag)
+        with timer.stage("validation"):
+            validationSuccess, validationOutcome, reportElt = schematron.validate(mySchema,
+                                                                                  propertiesElt,
+                                                                                  verboseFlag)
     else:
         # No schema match
         validationOutcome = "Fail"
@@ -163,6 +391,231 @@ def processPDF(PDF, verboseFlag, schemas):
     return pdfElt
 
 
+def processPDFWorker(PDF, verboseFlag, decodeCheckFlag, timingsFlag, schemas,
+                     fullPropertiesFlag=True, sampleSpec=None, streamFlag=False, mmapFlag=False,
+                     checksumType=None, statsFlag=False, outputFormat="xml", data=None):
+    """Process one PDF and return dictionary with summary values and output
+    serialized for outputFormat. Returns None if processing didn't result in
+    any output. This function is also run by the worker processes, so
+    everything it returns is picklable. If statsFlag is True, the values
+    that are aggregated into the batch statistics are added. If data is not
+    None, the PDF is opened from these (prefetched) data"""
+
+    # Use cached result if PDF hasn't changed since it was last processed
+    if cache.isEnabled():
+        fileKey = cache.getFileKey(PDF)
+        result = cache.getResult(PDF, fileKey)
+        if result is not None:
+            logging.info(("file: {} (cached)").format(PDF))
+            result["fromCache"] = True
+            if statsFlag:
+                result["stats"] = stats.getPDFStats(outputformats.parseRecord(result["output"],
+                                                                              outputFormat))
+            return result
+    else:
+        fileKey = None
+
+    logging.info(("file: {}").format(PDF))
+    if timingsFlag:
+        timer = timings.Timer()
+    else:
+        timer = timings.NullTimer()
+        if streamFlag:
+            memory.resetPeakRSS()
+    pdfResult = processPDF(PDF, verboseFlag, decodeCheckFlag, schemas, timer, fullPropertiesFlag,
+                           sampleSpec, streamFlag, mmapFlag, checksumType, data)
+    if len(pdfResult) == 0:
+        return None
+
+    # Add processing times to output
+    if timingsFlag:
+        timer.stop()
+        pdfResult.append(timer.toElt())
+        timingsRow = [PDF] + timer.toRow()
+    else:
+        timingsRow = None
+
+    # With --stream-pages the peak memory use is always reported, so its
+    # dependence on document length can be checked
+    if streamFlag:
+        peakRSS = timer.peakRSS if timingsFlag else memory.getPeakRSS()
+        if peakRSS is not None:
+            logging.info(("file: {} peak memory use: {:.1f} MB").format(PDF, peakRSS / 1048576))
+
+    try:
+        noPages = pdfResult.find('properties/noPages').text
+    except AttributeError:
+        noPages = "na"
+    try:
+        validationSuccess = pdfResult.find('validationSuccess').text
+    except AttributeError:
+        validationSuccess = "na"
+    try:
+        validationOutcome = pdfResult.find('validationOutcome').text
+    except AttributeError:
+        validationOutcome = "na"
+
+    # Serialize output
+    output = outputformats.serialize(pdfResult, outputFormat)
+
+    result = {"file": PDF,
+              "validationSuccess": validationSuccess,
+              "validationOutcome": validationOutcome,
+              "noPages": noPages,
+              "output": output,
+              "fromCache": False,
+              "fileKey": fileKey,
+              "timings": timingsRow}
+
+    if statsFlag:
+        result["stats"] = stats.getPDFStats(outputformats.getRecord(pdfResult))
+
+    return result
+
+
+def readResumeStats(statsJSONFile, noCompleted):
+    """Return statistics of interrupted run, or None if they don't cover
+    exactly the noCompleted PDFs in the journal. If the run was interrupted
+    after the statistics were written, but before the corresponding journal
+    entries, the previous statistics match the journal"""
+    if noCompleted == 0:
+        return None
+    for jsonFile in (statsJSONFile, statsJSONFile + ".prev"):
+        try:
+            batchStats = stats.BatchStats.read(jsonFile)
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            logging.info(("cannot read statistics file {} ({})").format(jsonFile, str(e)))
+            continue
+        if batchStats.noPDFs == noCompleted:
+            return batchStats
+    logging.warning(("statistics of interrupted run don't cover the {} PDFs in the journal, "
+                     "statistics will only cover the remaining PDFs").format(noCompleted))
+    return None
+
+
+def initWorker(schemas, cacheSettings):
+    """Initialize worker process"""
+    # Compile the Schematron validators once for each worker
+    schematron.compileSchemas(schemas)
+    if cacheSettings is not None:
+        cache.openCache(*cacheSettings)
+
+
+def initWorkerProcess(schemas, cacheSettings, logLevel=logging.INFO):
+    """Initialize worker process of pool. Workers inherit the SIGTERM
+    handler of the main process, which raises SystemExit. The pool
+    terminates its workers with SIGTERM, and a worker that exits through
+    SystemExit can then block, so the default handler is restored.
+    Workers that are started with the spawn method (e.g. on Windows and
+    macOS) don't inherit the logging configuration, so it is set up here
+    (this has no effect for forked workers, which do inherit it)"""
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    logging.basicConfig(handlers=[logging.StreamHandler(sys.stdout)],
+                        level=logLevel,
+                        format=logFormat)
+    initWorker(schemas, cacheSettings)
+
+
+def processPrefetched(worker, prefetcher):
+    """Process PDFs from prefetcher in this process, and yield the results.
+    The data of each PDF are released as soon as it is processed"""
+    for PDF, data in prefetcher:
+        result = worker(PDF, data=data)
+        data = None
+        prefetcher.release()
+        yield result
+
+
+def logPrefetchStatistics(prefetcher):
+    """Log time spent waiting for reads versus processing"""
+    noRead, bytesRead, readTime, waitTime, elapsed = prefetcher.getStatistics()
+    logging.info(("prefetch: read {} PDFs ({} MB) in {:.2f} s (all threads); "
+                  "waited {:.2f} s for reads, {:.2f} s processing").format(noRead,
+                 round(bytesRead / 1048576, 1), readTime, waitTime, elapsed - waitTime))
+
+
+def processPDFs(listPDFs, verboseFlag, decodeCheckFlag, timingsFlag, schemas,
+                noWorkers, cacheSettings, fullPropertiesFlag=True, sampleSpec=None,
+                streamFlag=False, prefetchSettings=None, mmapFlag=False, checksumType=None,
+                statsFlag=False, outputFormat="xml"):
+    """Process all PDFs, either serially or using a pool of worker processes,
+    and yield the results in the same order as listPDFs. We use processes
+    rather than threads here, because PyMuPDF is not thread-safe. If
+    cacheSettings is not None, results are looked up in and added to the
+    result cache. If prefetchSettings (number of PDFs, budget in bytes) is
+    not None, PDFs are read ahead on background threads. When processing
+    serially they are then opened from memory. Worker processes open
+    them by path, so the read-ahead only fills the page cache. If mmapFlag
+    is True, PDFs that weren't prefetched are memory-mapped. If checksumType
+    is not None, the checksum of each PDF is computed. If statsFlag is True,
+    each result includes the values for the batch statistics. The output of
+    each PDF is serialized for outputFormat"""
+
+    listPDFs = (os.path.abspath(myPDF) for myPDF in listPDFs)
+    worker = functools.partial(processPDFWorker,
+                               verboseFlag=verboseFlag,
+                               decodeCheckFlag=decodeCheckFlag,
+                               timingsFlag=timingsFlag,
+                               schemas=schemas,
+                               fullPropertiesFlag=fullPropertiesFlag,
+                               sampleSpec=sampleSpec,
+                               streamFlag=streamFlag,
+                               mmapFlag=mmapFlag,
+                               checksumType=checksumType,
+                               statsFlag=statsFlag,
+                               outputFormat=outputFormat)
+
+    if prefetchSettings is not None:
+        # PDFs with a cached result are not read ahead
+        prefetcher = prefetch.Prefetcher(listPDFs, *prefetchSettings,
+                                         keepFlag=noWorkers == 1,
+                                         skipFunction=cache.hasResult)
+    else:
+        prefetcher = None
+
+    try:
+        if noWorkers == 1:
+            initWorker(schemas, cacheSettings)
+            if prefetcher is None:
+                results = map(worker, listPDFs)
+            else:
+                results = processPrefetched(worker, prefetcher)
+            for result in results:
+                if result is not None and not result["fromCache"] and cache.isEnabled():
+                    cache.storeResult(result, result["fileKey"])
+                yield result
+        else:
+            if prefetcher is not None:
+                listPDFs = (PDF for PDF, data in prefetcher)
+            # imap returns results in input order, which keeps the output deterministic.
+            # Chunksize is 1 because processing time varies a lot between PDFs
+            with multiprocessing.Pool(noWorkers,
+                                      initializer=initWorkerProcess,
+                                      initargs=(schemas, cacheSettings,
+                                                logging.getLogger().getEffectiveLevel())) as pool:
+                # Results are only written to the cache by the main process
+                if cacheSettings is not None:
+                    cache.openCache(*cacheSettings)
+                try:
+                    for result in pool.imap(worker, listPDFs, chunksize=1):
+                        if prefetcher is not None:
+                            prefetcher.release()
+                        if result is not None and not result["fromCache"] and cache.isEnabled():
+                            cache.storeResult(result, result["fileKey"])
+                        yield result
+                finally:
+                    # The pool's task thread may be waiting for the prefetcher,
+                    # which would block terminating the pool
+                    if prefetcher is not None:
+                        prefetcher.close()
+    finally:
+        if prefetcher is not None:
+            prefetcher.close()
+            logPrefetchStatistics(prefetcher)
+
+    cache.closeCache()
+
+
 def main():
     """Main function"""
 
@@ -211,7 +664,40 @@ def main():
         prefixOut = args.prefixout
         outDir = os.path.normpath(args.outdir)
         maxPDFs = int(args.maxpdfs)
+        flushInterval = args.flushinterval
         verboseFlag = args.verbose
+        sortFlag = args.sort
+        decodeCheckFlag = args.decodecheck
+        timingsFlag = args.timings
+        noWorkers = args.workers
+        resumeFlag = args.resume
+        cacheFlag = args.usecache
+        rehashFlag = args.rehash
+        shardString = args.shard
+        fullPropertiesFlag = args.fullproperties
+        sampleString = args.samplepages
+        streamFlag = args.streampages
+        noPrefetch = args.prefetch
+        prefetchBudget = args.prefetchbudget
+        mmapFlag = args.mmap
+        checksumType = args.checksum
+        statsFlag = args.stats
+        outputFormat = args.outputformat
+    elif action == "merge":
+        batchDir = os.path.normpath(args.batchDir)
+        outDir = os.path.normpath(args.outdir)
+        shared.checkDirExists(outDir)
+        prefixBatch = ("{}_{}").format(args.prefixout, os.path.basename(batchDir))
+        logging.basicConfig(handlers=[logging.StreamHandler(sys.stdout)],
+                            level=logging.INFO,
+                            format=logFormat)
+        noPDFs = merge.mergeShards(prefixBatch,
+                                   outDir,
+                                   int(args.maxpdfs),
+                                   args.flushinterval,
+                                   [summaryHeader, summaryHeader + samplingHeader])
+        print("merged output of {} PDFs".format(noPDFs))
+        sys.exit()
     elif action == "list":
         schematron.listProfilesSchemas(profilesDir, schemasDir)
     elif action == "copyps":
@@ -235,6 +721,34 @@ def main():
     shared.checkDirExists(batchDir)
     shared.checkDirExists(outDir)
 
+    # Check number of workers
+    if noWorkers < 1:
+        msg = ("number of workers must be 1 or more")
+        shared.errorExit(msg)
+
+    # Check prefetch settings
+    if noPrefetch < 0:
+        msg = ("number of prefetched PDFs must be 0 or more")
+        shared.errorExit(msg)
+    if prefetchBudget < 1:
+        msg = ("prefetch budget must be 1 MB or more")
+        shared.errorExit(msg)
+    if noPrefetch > 0:
+        prefetchSettings = (noPrefetch, prefetchBudget * 1048576)
+    else:
+        prefetchSettings = None
+
+    # Check page sampling specification
+    if sampleString is not None:
+        try:
+            sampleSpec = sampling.parseSampleSpec(sampleString)
+        except ValueError as e:
+            shared.errorExit(str(e))
+        sampleColumns = samplingHeader
+    else:
+        sampleSpec = None
+        sampleColumns = []
+
     # Check if outDir is writable
     if not os.access(outDir, os.W_OK):
         msg = ("directory {} is not writable".format(outDir))
@@ -244,75 +758,146 @@ def main():
     batchDirName = os.path.basename(batchDir)
     # Construct output prefix for this batch
     prefixBatch = ("{}_{}").format(prefixOut, batchDirName)
+
+    # Each shard has its own output files, which are combined by the merge command.
+    # Partitioning needs a reproducible file order on all machines
+    if shardString is not None:
+        shardNo, noShards = parseShard(shardString)
+        prefixBatch = merge.getShardPrefix(prefixBatch, shardNo, noShards)
+        sortFlag = True
     
     # Set up logging
     logging.basicConfig(handlers=[logging.StreamHandler(sys.stdout)],
                         level=logging.INFO,
-                        format='%(asctime)s - %(levelname)s - %(message)s')
+                        format=logFormat)
 
     # Get schema patterns and locations from profile
     schemas = schematron.readProfile(profile, schemasDir)
+    # Compile Schematron validators for all schemas in profile
+    schematron.compileSchemas(schemas)
+
+    # Report extraction stages that are skipped because the schema doesn't use them
+    if not fullPropertiesFlag:
+        for schema in schemas:
+            skipped = set(properties.optionalStages) - schematron.getRequiredStages(schema[3])
+            if len(skipped) != 0:
+                logging.info(("schema {} doesn't use properties from stage(s) {}").format(schema[3],
+                             ", ".join(sorted(skipped))))
+
+    # Result cache settings
+    if not cacheFlag:
+        cacheSettings = None
+    elif timingsFlag:
+        # Cached results would report the processing times of an earlier run
+        logging.info("result cache is not used if timings are reported")
+        cacheSettings = None
+    else:
+        cacheFile = os.path.join(configpath, "cache.sqlite")
+        settingsHash = cache.computeSettingsHash(__version__,
+                                                 profile,
+                                                 schemas,
+                                                 [verboseFlag, decodeCheckFlag,
+                                                  fullPropertiesFlag, sampleSpec,
+                                                  checksumType, outputFormat])
+        cacheSettings = (cacheFile, settingsHash, rehashFlag, flushInterval)
 
     # Summary file with quality check status (pass/fail) and no of pages
     summaryFile = os.path.normpath(("{}_summary.csv").format(prefixBatch))
     summaryFile = os.path.join(outDir, summaryFile)
-    with open(summaryFile, 'w', newline='', encoding='utf-8') as fSum:
-        writer = csv.writer(fSum)
-        writer.writerow(["file", "validationSuccess", "validationOutcome", "noPages", "fileOut"])
 
-    listPDFs = getFilesFromTree(batchDir, "pdf")
+    # Timings file with processing times for each PDF
+    timingsFile = os.path.normpath(("{}_timings.csv").format(prefixBatch))
+    timingsFile = os.path.join(outDir, timingsFile)
+
+    # Journal with completed PDFs, used for resuming interrupted runs
+    journalFile = os.path.normpath(("{}_journal.csv").format(prefixBatch))
+    journalFile = os.path.join(outDir, journalFile)
+
+    # Batch statistics
+    statsJSONFile = os.path.join(outDir, os.path.normpath(("{}_stats.json").format(prefixBatch)))
+    statsCSVFile = os.path.join(outDir, os.path.normpath(("{}_stats.csv").format(prefixBatch)))
+
+    if resumeFlag:
+        # Repair output of interrupted run and skip all completed PDFs
+        journalEntries = journal.readJournal(journalFile)
+        resumeState = journal.repairOutput(journalEntries, prefixBatch, outDir, outputFormat)
+        completedPDFs = set(entry[0] for entry in journalEntries)
+        logging.info(("resuming batch, skipping {} completed PDFs").format(len(completedPDFs)))
+        if statsFlag:
+            batchStats = readResumeStats(statsJSONFile, len(completedPDFs))
+    else:
+        resumeState = None
+        completedPDFs = None
+        batchStats = None
+
+    # Generator that yields PDFs as they are found, so processing
+    # starts before the whole batch directory has been scanned
+    listPDFs = getFilesFromTree(batchDir, "pdf", sortFlag)
+    if shardString is not None:
+        listPDFs = getShard(listPDFs, shardNo, noShards)
+    if resumeFlag:
+        listPDFs = (myPDF for myPDF in listPDFs if os.path.abspath(myPDF) not in completedPDFs)
+
+    # Terminate with SystemExit on SIGTERM, so that output files are closed properly
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(1))
 
     # start clock for statistics
     start = time.time()
     print("pdfquad started: " + time.asctime())
 
-    # Iterate over all PDFs
-    pdfCount = 1
-    outFileCount = 1
-    fileOut = ("{}_{}.xml").format(prefixBatch, str(outFileCount).zfill(3))
-    fileOut = os.path.join(outDir, fileOut)
-    writeXMLHeader(fileOut)
-
-    for myPDF in listPDFs:
-        logging.info(("file: {}").format(myPDF))
-        if pdfCount > maxPDFs:
-            writeXMLFooter(fileOut)
-            outFileCount += 1
-            fileOut = ("{}_{}.xml").format(prefixBatch, str(outFileCount).zfill(3))
-            fileOut = os.path.join(outDir, fileOut)
-            writeXMLHeader(fileOut)
-            pdfCount = 1
-        myPDF = os.path.abspath(myPDF)
-        pdfResult = processPDF(myPDF, verboseFlag, schemas)
-        if len(pdfResult) != 0:
-            try:
-                noPages = pdfResult.find('properties/noPages').text
-            except AttributeError:
-                noPages = "na"
-            try:
-                validationSuccess = pdfResult.find('validationSuccess').text
-            except AttributeError:
-                validationSuccess = "na"
-            try:
-                validationOutcome = pdfResult.find('validationOutcome').text
-            except AttributeError:
-                validationOutcome = "na"
-            with open(summaryFile, 'a', newline='', encoding='utf-8') as fSum:
-                writer = csv.writer(fSum)
-                writer.writerow([myPDF, validationSuccess, validationOutcome, noPages, fileOut])
-            # Convert output to XML and add to output file
-            outXML = etree.tostring(pdfResult,
-                                    method='xml',
-                                    encoding='utf-8',
-                                    xml_declaration=False,
-                                    pretty_print=True)
-
-            with open(fileOut,"ab") as f:
-                f.write(outXML)
-
-            pdfCount += 1
-
-    writeXMLFooter(fileOut)
+    # Iterate over all PDFs. The writers ensure that all output files are
+    # closed properly (including the closing tag of the XML output) if the
+    # processing is interrupted
+    with contextlib.ExitStack() as stack:
+        summaryWriter = stack.enter_context(writers.CSVWriter(summaryFile,
+                                                              summaryHeader + sampleColumns,
+                                                              flushInterval,
+                                                              completedPDFs))
+        outputWriter = stack.enter_context(writers.outputWriters[outputFormat](prefixBatch,
+                                                                               outDir,
+                                                                               maxPDFs,
+                                                                               flushInterval,
+                                                                               resumeState))
+        outputs = [outputWriter, summaryWriter]
+        if timingsFlag:
+            timingsWriter = stack.enter_context(writers.CSVWriter(timingsFile,
+                                                                  timings.getHeader(),
+                                                                  flushInterval,
+                                                                  completedPDFs))
+            outputs.append(timingsWriter)
+        if statsFlag:
+            statsWriter = stack.enter_context(writers.StatsWriter(statsJSONFile,
+                                                                  statsCSVFile,
+                                                                  batchStats))
+            outputs.append(statsWriter)
+        # Journal is closed first, so its last entries are written
+        # before the other outputs are closed
+        journalWriter = stack.enter_context(writers.JournalWriter(journalFile,
+                                                                  outputs,
+                                                                  flushInterval,
+                                                                  resumeFlag))
+
+        for pdfResult in processPDFs(listPDFs, verboseFlag, decodeCheckFlag, timingsFlag,
+                                     schemas, noWorkers, cacheSettings,
+                                     fullPropertiesFlag, sampleSpec, streamFlag,
+                                     prefetchSettings, mmapFlag, checksumType, statsFlag,
+                                     outputFormat):
+            if pdfResult is not None:
+                # Add output to output file
+                fileOut = outputWriter.write(pdfResult["output"])
+                summaryRow = [pdfResult["file"],
+                              pdfResult["validationSuccess"],
+                              pdfResult["validationOutcome"],
+                              pdfResult["noPages"],
+                              fileOut]
+                if sampleSpec is not None:
+                    summaryRow += getSamplingColumns(sampleSpec, pdfResult["noPages"])
+                summaryWriter.write(summaryRow)
+                if timingsFlag:
+                    timingsWriter.write(pdfResult["timings"])
+                if statsFlag:
+                    statsWriter.write(pdfResult["stats"])
+                journalWriter.write(pdfResult["file"], fileOut, outputWriter.tell())
 
     # Timing output
     end = time.time()
@@ -0,0 +1,168 @@
+#! /usr/bin/env python3
+
+"""PDF Quality Assessment for Digitisation batches
+
+Johan van der Knijff
+
+Copyright 2024, KB/National Library of the Netherlands
+
+Module for reading PDFs ahead of their processing on background threads,
+which hides the latency of slow (e.g. network) storage
+
+"""
+
+import os
+import time
+import threading
+import collections
+import concurrent.futures
+
+# Maximum number of read threads
+maxThreads = 4
+# Size of chunks that are read if the data are only read into the page cache
+chunkSize = 1048576
+
+
+class Prefetcher:
+    """Iterator that yields a (PDF, data) tuple for each PDF in listPDFs, in
+    the same order, while background threads read the next PDFs. At most
+    noFiles PDFs with a combined size of at most budget bytes are read ahead
+    or held by the consumer, which must call release() once it is done with
+    a PDF (in the order in which the PDFs were yielded). A single PDF that is
+    larger than the budget is read on its own. If keepFlag is True, data are
+    the contents of the PDF (or None if it couldn't be read, so the error is
+    reported when the PDF is opened). Otherwise the PDFs are only read into
+    the page cache, and data are always None. PDFs for which skipFunction
+    returns True (e.g. because their result is cached) are not read"""
+
+    def __init__(self, listPDFs, noFiles, budget, keepFlag=True, skipFunction=None):
+        self.listPDFs = iter(listPDFs)
+        self.noFiles = noFiles
+        self.budget = budget
+        self.keepFlag = keepFlag
+        self.skipFunction = skipFunction
+        self.executor = concurrent.futures.ThreadPoolExecutor(min(noFiles, maxThreads))
+        self.condition = threading.Condition()
+        # Submitted reads as (PDF, size, future) tuples, in input order
+        self.pending = collections.deque()
+        # Sizes of yielded PDFs that haven't been released yet
+        self.held = collections.deque()
+        # Combined size of pending and held PDFs
+        self.heldBytes = 0
+        # Next PDF and its size, if it didn't fit in the budget yet
+        self.nextPDF = None
+        self.nextSize = 0
+        self.exhausted = False
+        self.closed = False
+        # Statistics
+        self.statsLock = threading.Lock()
+        self.noRead = 0
+        self.bytesRead = 0
+        self.readTime = 0.0
+        self.waitTime = 0.0
+        self.startTime = time.perf_counter()
+
+    def read(self, PDF):
+        """Read PDF, and return its contents if keepFlag is True"""
+        start = time.perf_counter()
+        data = None
+        noBytes = 0
+        try:
+            with open(PDF, 'rb') as f:
+                if self.keepFlag:
+                    data = f.read()
+                    noBytes = len(data)
+                else:
+                    buffer = bytearray(chunkSize)
+                    while True:
+                        n = f.readinto(buffer)
+                        if n == 0:
+                            break
+                        noBytes += n
+        except OSError:
+            pass
+        with self.statsLock:
+            self.noRead += 1
+            self.bytesRead += noBytes
+            self.readTime += time.perf_counter() - start
+        return data
+
+    def fill(self):
+        """Submit reads of the next PDFs for as long as the limits allow.
+        The condition must be acquired by the caller"""
+        while not self.exhausted and not self.closed:
+            noFiles = len(self.pending) + len(self.held)
+            if noFiles >= self.noFiles:
+                return
+            if self.nextPDF is None:
+                try:
+                    self.nextPDF = next(self.listPDFs)
+                except StopIteration:
+                    self.exhausted = True
+                    return
+                if self.skipFunction is not None and self.skipFunction(self.nextPDF):
+                    self.nextSize = None
+                else:
+                    try:
+                        self.nextSize = os.path.getsize(self.nextPDF)
+                    except OSError:
+                        self.nextSize = 0
+            if self.nextSize is None:
+                self.pending.append((self.nextPDF, 0, None))
+            else:
+                if noFiles != 0 and self.heldBytes + self.nextSize > self.budget:
+                    return
+                future = self.executor.submit(self.read, self.nextPDF)
+                self.pending.append((self.nextPDF, self.nextSize, future))
+                self.heldBytes += self.nextSize
+            self.nextPDF = None
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        with self.condition:
+            self.fill()
+            while len(self.pending) == 0:
+                if self.closed or (self.exhausted and self.nextPDF is None):
+                    raise StopIteration
+                # Wait until the consumer releases a PDF
+                self.condition.wait()
+                self.fill()
+            PDF, size, future = self.pending.popleft()
+            self.held.append(size)
+
+        if future is None:
+            return PDF, None
+        start = time.perf_counter()
+        data = future.result()
+        with self.statsLock:
+            self.waitTime += time.perf_counter() - start
+        return PDF, data
+
+    def release(self):
+        """Release the oldest PDF that was yielded, so more PDFs can be read"""
+        with self.condition:
+            self.heldBytes -= self.held.popleft()
+            self.fill()
+            self.condition.notify_all()
+
+    def close(self):
+        """Stop reading, and stop any consumer that waits for a PDF"""
+        with self.condition:
+            self.closed = True
+            # Cancel reads that haven't started yet (shutdown only has a
+            # cancel_futures argument from Python 3.9 on)
+            for PDF, size, future in self.pending:
+                if future is not None:
+                    future.cancel()
+            self.pending.clear()
+            self.condition.notify_all()
+        self.executor.shutdown(wait=True)
+
+    def getStatistics(self):
+        """Return number of PDFs read, bytes read, combined time of all reads,
+        time spent waiting for reads to complete, and elapsed time"""
+        with self.statsLock:
+            return (self.noRead, self.bytesRead, self.readTime, self.waitTime,
+                    time.perf_counter() - self.startTime)
@@ -11,23 +11,233 @@ PDF properties extraction module
 """
 import os
 import io
+import re
+import mmap
+import hashlib
 import logging
-import base64
-from lxml import etree
 import pymupdf
 import PIL
-from PIL import ImageCms
 from . import jpegquality
-
-
-def dictionaryToElt(name, dictionary):
-    """Create Element object from dictionary"""
-    elt = etree.Element(name)
-    for key, value in dictionary.items():
-        child = etree.Element(key)
-        child.text = str(value)
-        elt.append(child)
-    return elt
+from . import timings
+from . import records
+from . import sampling
+from . import watermarks
+from . import filters
+from . import jpeg2000
+from . import iccprofiles
+
+
+# Paths of the exception elements at the document and image stream level
+documentExceptions = ("properties", "exceptions", "exception")
+streamExceptions = ("properties", "pages", "page", "image", "stream", "exceptions", "exception")
+
+# Optional extraction stages, with for each stage the paths of the elements
+# it adds to the properties element
+optionalStages = {"xrefScan": [("properties", "annotations", "annotation"),
+                               ("properties", "containsJavaScript")],
+                  "watermarkScan": [("properties", "pages", "page", "annotations", "annotation")],
+                  "jpegQuality": [("properties", "pages", "page", "image", "stream", "JPEGQuality"),
+                                  ("properties", "pages", "page", "image", "stream", "NSE_JPEGQuality")],
+                  "iccProfile": [("properties", "pages", "page", "image", "stream", "icc_profile_name"),
+                                 ("properties", "pages", "page", "image", "stream", "icc_profile_description"),
+                                 ("properties", "pages", "page", "image", "stream", "colorspace_icc_profile_name"),
+                                 ("properties", "pages", "page", "image", "stream", "colorspace_icc_profile_description")]}
+
+# Path of the exception elements that each optional stage records errors
+# in, and the paths of the elements that show the input it can fail on (or
+# None if it can fail on any input). A schema that checks the exceptions
+# needs the stage, unless it doesn't use any of these elements. E.g. the
+# iccProfile stage only fails on ICC profiles, which don't matter for a
+# schema that doesn't check for their presence
+stageExceptions = {"xrefScan": (documentExceptions, None),
+                   "watermarkScan": (documentExceptions, None),
+                   "jpegQuality": (streamExceptions, None),
+                   "iccProfile": (streamExceptions,
+                                  [("properties", "pages", "page", "image", "stream", "icc_profile"),
+                                   ("properties", "pages", "page", "image", "dict", "colorspace")])}
+
+
+def usesPath(paths, elementPath):
+    """Return True if a path in paths, a set of (path, valueFlag) tuples,
+    refers to the element at elementPath or its descendants, or to the
+    string value of one of its ancestors"""
+    for path, valueFlag in paths:
+        if path[:len(elementPath)] == elementPath or \
+           (valueFlag and elementPath[:len(path)] == path):
+            return True
+    return False
+
+
+def getRequiredStages(paths):
+    """Return set of optional extraction stages that are needed for the
+    elements in paths, a set of (path, valueFlag) tuples as returned by
+    NativeSchema.getPaths. A stage is needed if a path refers to one of its
+    elements, or to the exceptions it can record (see stageExceptions). All
+    stages are needed if any path doesn't start at the properties element"""
+    if any(path[0] != "properties" for path, valueFlag in paths):
+        return set(optionalStages)
+    stages = set()
+    for stage, stagePaths in optionalStages.items():
+        if any(usesPath(paths, stagePath) for stagePath in stagePaths):
+            stages.add(stage)
+    for stage, (exceptionsPath, inputPaths) in stageExceptions.items():
+        if usesPath(paths, exceptionsPath) and \
+           (inputPaths is None or any(usesPath(paths, inputPath) for inputPath in inputPaths)):
+            stages.add(stage)
+    return stages
+
+
+# Regular expressions used for scanning PDF object source
+reName = re.compile(rb"/[^\s/<>\[\]()%{}]*")
+reRef = re.compile(rb"\d+\s+\d+\s+R")
+reToken = re.compile(rb"[^\s/<>\[\]()%{}]+")
+reSpace = re.compile(rb"\s*")
+reStringDelimiter = re.compile(rb"[()\\]")
+reDelimiter = re.compile(rb"[()<>\[\]]")
+
+
+def skipString(src, i):
+    """Return position after literal string that starts at position i"""
+    depth = 0
+    while True:
+        match = reStringDelimiter.search(src, i)
+        if match is None:
+            raise ValueError("unterminated string")
+        i = match.start()
+        c = src[i]
+        if c == 0x5C:
+            # Backslash, skip escaped character
+            i += 2
+            continue
+        if c == 0x28:
+            depth += 1
+        else:
+            depth -= 1
+            if depth == 0:
+                return i + 1
+        i += 1
+
+
+def skipValue(src, i):
+    """Return position after PDF object value that starts at position i"""
+    c = src[i:i+1]
+    if c == b"/":
+        return reName.match(src, i).end()
+    if c == b"(":
+        return skipString(src, i)
+    if src.startswith(b"<<", i) or c == b"[":
+        # Dictionary or array, skip everything up to the matching closing bracket
+        depth = 0
+        while True:
+            match = reDelimiter.search(src, i)
+            if match is None:
+                raise ValueError("unterminated dictionary or array")
+            i = match.start()
+            if src[i] == 0x28:
+                i = skipString(src, i)
+            elif src.startswith(b"<<", i):
+                depth += 1
+                i += 2
+            elif src[i] == 0x5B:
+                depth += 1
+                i += 1
+            elif src.startswith(b">>", i) or src[i] == 0x5D:
+                depth -= 1
+                i += 1 if src[i] == 0x5D else 2
+                if depth == 0:
+                    return i
+            elif src[i] == 0x3C:
+                # Hexadecimal string
+                i = src.index(b">", i) + 1
+            else:
+                raise ValueError("unexpected character in object")
+    if c == b"<":
+        return src.index(b">", i) + 1
+    match = reRef.match(src, i)
+    if match is not None:
+        return match.end()
+    match = reToken.match(src, i)
+    if match is not None:
+        return match.end()
+    raise ValueError("unexpected character in object")
+
+
+def getDictEntries(src, keys):
+    """Return dictionary with values of top-level entries in keys, from
+    (compressed) source of PDF dictionary object as returned by xref_object.
+    Values are returned as raw source bytes. Parsing stops as soon as all
+    keys are found. Returns None if object is not a dictionary"""
+    if not src.startswith(b"<<"):
+        return None
+
+    entries = {}
+    i = 2
+    while len(entries) < len(keys):
+        i = reSpace.match(src, i).end()
+        if src.startswith(b">>", i):
+            break
+        if src[i:i+1] != b"/":
+            raise ValueError("expected name")
+        keyEnd = reName.match(src, i).end()
+        key = src[i+1:keyEnd].decode("latin-1")
+        i = reSpace.match(src, keyEnd).end()
+        valueEnd = skipValue(src, i)
+        if key in keys:
+            entries[key] = src[i:valueEnd]
+        i = valueEnd
+
+    return entries
+
+
+def getNameValue(doc, xref, entries, key):
+    """Return value of key in dictionary entries as it would be returned by
+    xref_get_key. Only name values are read from entries directly, for any
+    other values we fall back to xref_get_key"""
+    try:
+        value = entries[key]
+    except KeyError:
+        return "null"
+    if reName.fullmatch(value) and b"#" not in value:
+        return value.decode("latin-1")
+    return doc.xref_get_key(xref, key)[1]
+
+
+def classifyObjects(doc):
+    """Iterate over all objects in a single pass, and return list with
+    annotation subtypes, flag that indicates presence of JavaScript, and
+    dictionary with number of objects for each Type value. Each object
+    is read only once, and its top-level keys are parsed from its source"""
+
+    annotations = []
+    javaScriptFlag = False
+    objectTypes = {}
+
+    xreflen = doc.xref_length()
+    for xref in range(1, xreflen):
+        src = doc.xref_object(xref, compressed=True).encode("latin-1", errors="replace").strip()
+        # Only look for keys that occur somewhere in the object source
+        keys = [key for key in ["Type", "Subtype", "JS"] if b"/" + key.encode() in src]
+        try:
+            entries = getDictEntries(src, keys)
+        except ValueError:
+            # Couldn't parse object source, fall back to xref_get_key
+            entries = {}
+            for key in keys:
+                value = doc.xref_get_key(xref, key)
+                if value[0] != "null":
+                    entries[key] = value[1].encode("latin-1", errors="replace")
+        if entries is None:
+            continue
+        type = getNameValue(doc, xref, entries, "Type")
+        if type == "/Annot":
+            annotations.append(getNameValue(doc, xref, entries, "Subtype"))
+        if entries.get("JS", b"null") != b"null":
+            javaScriptFlag = True
+        if type == "null":
+            type = "undefined"
+        objectTypes[type] = objectTypes.get(type, 0) + 1
+
+    return annotations, javaScriptFlag, objectTypes
 
 
 def getBPC(image):
@@ -55,234 +265,304 @@ def getBPC(image):
     return bpc
 
 
-def getProperties(PDF):
-    """Extract properties and return result as Element object"""
-
-    # Create element object to store all properties
-    propertiesElt = etree.Element("properties")
-
-    # Element to store exceptions at file level
-    exceptionsFileElt = etree.Element("exceptions")
-
-    # Create and fill descriptive elements
-    fPathElt = etree.Element("filePath")
-    fPathElt.text = PDF
-    fSizeElt = etree.Element("fileSize")
-    fSizeElt.text = str(os.path.getsize(PDF))
+def mapFile(PDF):
+    """Return read-only memoryview of the memory-mapped contents of PDF, or
+    None if it can't be mapped (e.g. because it is empty). The mapping is
+    released once the view (and any document opened from it) is no longer
+    referenced, so it can't be released while MuPDF still uses it"""
+    try:
+        with open(PDF, 'rb') as f:
+            return memoryview(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+    except (OSError, ValueError):
+        return None
+
+
+def computeChecksum(PDF, checksumType, data=None):
+    """Return checksum (hex digest) of type checksumType (md5 or sha256) of PDF.
+    It is computed over data if available, and otherwise over the file"""
+    h = hashlib.new(checksumType)
+    if data is not None:
+        h.update(data)
+    else:
+        with open(PDF, 'rb') as f:
+            for chunk in iter(lambda: f.read(1048576), b""):
+                h.update(chunk)
+    return h.hexdigest()
+
+
+def getProperties(PDF, decodeCheckFlag=False, timer=timings.NullTimer(), stages=None,
+                  sampleSpec=None, streamFlag=False, data=None, mmapFlag=False,
+                  checksumType=None):
+    """Extract properties and return result as PDFRecord object. If
+    decodeCheckFlag is True, all image data are fully decoded to
+    detect any corrupted image streams. Processing times are recorded
+    by timer. Of the optionalStages only those in stages are run, or
+    all of them if stages is None. If sampleSpec is not None, only the
+    pages selected by this page sampling specification are analysed. If
+    streamFlag is True, all MuPDF resources of each page are released
+    once the page is analysed, so MuPDF's resource store doesn't grow with
+    the number of pages (at the cost of some speed). The records of all
+    pages are kept, as validation needs them. If data is not None,
+    the PDF is opened from data (its contents as read by the prefetch
+    module) rather than from file. Otherwise, if mmapFlag is True, the
+    PDF is memory-mapped, so the size, checksum and parsing all use the
+    same buffer, and the file is read only once. If checksumType is not
+    None, a checksum of this type is added to the properties"""
+
+    if stages is None:
+        stages = set(optionalStages)
+
+    if data is None and mmapFlag:
+        data = mapFile(PDF)
+
+    # Create record to store all properties
+    if data is None:
+        fileSize = os.path.getsize(PDF)
+    else:
+        fileSize = len(data)
+    pdfRecord = records.PDFRecord(PDF, fileSize)
 
-    # Add to properies element
-    propertiesElt.append(fPathElt)
-    propertiesElt.append(fSizeElt)
+    if checksumType is not None:
+        try:
+            with timer.stage("checksum"):
+                pdfRecord.checksum = computeChecksum(PDF, checksumType, data)
+            pdfRecord.checksumType = checksumType
+        except Exception as e:
+            pdfRecord.exceptions.append(str(e))
+            logging.warning(("while computing checksum: {}").format(str(e)))
 
     # Parse PDF and check for open password
-    openPasswordElt = etree.Element("openPassword")
     try:
-        doc = pymupdf.open(PDF)
-        rc = doc.authenticate("whatever")
+        with timer.stage("open"):
+            if data is None:
+                doc = pymupdf.open(PDF)
+            else:
+                try:
+                    doc = pymupdf.open(stream=data, filetype="pdf")
+                except Exception:
+                    # Open from file, so errors are reported in the same way
+                    doc = pymupdf.open(PDF)
+            rc = doc.authenticate("whatever")
         if rc == 0:
-            openPasswordElt.text = str(True)
-            propertiesElt.append(openPasswordElt)
+            pdfRecord.openPassword = True
             logging.warning("PDF has open password")
-            return propertiesElt
+            return pdfRecord
         else:
-            openPasswordElt.text = str(False)
-            propertiesElt.append(openPasswordElt)
+            pdfRecord.openPassword = False
     except Exception  as e:
-        ex = etree.SubElement(exceptionsFileElt,'exception')
-        ex.text = str(e)
-        propertiesElt.append(exceptionsFileElt)
+        pdfRecord.exceptions.append(str(e))
         logging.warning(("while opening PDF: {}").format(str(e)))
-        return propertiesElt
+        return pdfRecord
 
-    # Page count
-    pages = doc.page_count
     # Document metadata
-    metadata = doc.metadata
-    metadataElt = dictionaryToElt('meta', metadata)
+    pdfRecord.meta = doc.metadata
 
     # Read pageMode from document catalog (if it exists)
     # pageMode is needed for the thumbnail check
     catXref = doc.pdf_catalog()
     pageMode = doc.xref_get_key(catXref, "PageMode")
-    pageModeElt = etree.Element("PageMode")
     if pageMode[0] == 'null':
-        pageModeElt.text = "undefined"
+        pdfRecord.pageMode = "undefined"
     else:
-        pageModeElt.text = pageMode[1]
+        pdfRecord.pageMode = pageMode[1]
 
     # Check for digital signatures
     # signatureFlag. No signatures for value -1; other values (1,3) indicate signatures.
-    signatureFlag = doc.get_sigflags()
-    signatureElt = etree.Element("signatureFlag")
-    signatureElt.text = str(signatureFlag)
-
-    # Element object for storing annotation types
-    annotsElt =  etree.Element("annotations")
-
-    # JavaScript element
-    javaScriptElt = etree.Element("containsJavaScript")
-    javaScriptElt.text = str(False)
+    pdfRecord.signatureFlag = doc.get_sigflags()
 
     # Iterate over all objects and check for annotations and JavaScript.
     # This doesn't work for Watermark annotations that are wrapped inside
     # stream objects, so these are dealt with separately at the page level.
-    try:
-        xreflen = doc.xref_length()
-        for xref in range(1, xreflen):
-            type = doc.xref_get_key(xref, "Type")[1]
-            subtype = doc.xref_get_key(xref, "Subtype")[1]
-            js = doc.xref_get_key(xref, "JS")
-            if type =="/Annot":
-                annotElt = etree.SubElement(annotsElt,'annotation')
-                annotElt.text = subtype
-            if js != ("null", "null"):
-                javaScriptElt.text = str(True)
-    except Exception as e:
-        ex = etree.SubElement(exceptionsFileElt,'exception')
-        ex.text = str(e)
-        logging.warning(("while iterating over PDF objects: {}").format(str(e)))
+    if "xrefScan" in stages:
+        pdfRecord.annotations = []
+        pdfRecord.javaScript = False
+        try:
+            with timer.stage("xrefScan"):
+                annotations, javaScriptFlag, objectTypes = classifyObjects(doc)
+            pdfRecord.annotations = annotations
+            pdfRecord.javaScript = javaScriptFlag
+            # Only reported as a diagnostic with the timings
+            timer.setObjectTypes(objectTypes)
+        except Exception as e:
+            pdfRecord.exceptions.append(str(e))
+            logging.warning(("while iterating over PDF objects: {}").format(str(e)))
 
     # Check for optional content layers
-    optionalContentElt = etree.Element("containsOptionalContent")
-    optionalContentElt.text = str(False)
     optionalContent = doc.layer_ui_configs()
-    if len(optionalContent) != 0:
-        optionalContentElt.text = str(True)
-
-    # Wrapper element for pages output
-    pagesElt = etree.Element("pages")
-
-    pageNo = 1
-    for page in doc:
-        pageElt = getPageProperties(doc, page, pageNo)
-        # Add page element to pages element
-        pagesElt.append(pageElt)
-        pageNo += 1
-
-    # Add all remaining elements to properties element
-    propertiesElt.append(metadataElt)
-    propertiesElt.append(pageModeElt)
-    propertiesElt.append(signatureElt)
-    propertiesElt.append(optionalContentElt)
-    propertiesElt.append (javaScriptElt)
-    noPagesElt = etree.Element("noPages")
-    noPagesElt.text = str(pages)
-    propertiesElt.append(noPagesElt)
-    propertiesElt.append(pagesElt)
-    propertiesElt.append(annotsElt)
-    propertiesElt.append(exceptionsFileElt)
-
-    return propertiesElt
-
-
-def getPageProperties(doc, page, pageNo):
-    """Extract properties for one page and return result as Element object"""
-
-    # Create element object to store all page level properties
-    pageElt = etree.Element("page")
-    pageElt.attrib["number"] = str(pageNo)
-
-    # Iterate over all images on this page
-    images = page.get_images(full=False)
-    for image in images:
-        imageElt = getImageProperties(doc, image, pageNo)
-        # Add image element to page element
-        pageElt.append(imageElt)
-
-    # Check for watermark annotations, which somehow are exclude from document-level check
-    # Source: https://github.com/pymupdf/PyMuPDF/discussions/1855#discussioncomment-3324039
+    pdfRecord.optionalContent = len(optionalContent) != 0
 
-    # Element object for storing annotation types
-    annotsElt =  etree.Element("annotations")
-    page.clean_contents()
-
-    xref = page.get_contents()[0]  # get xref of resulting /Contents object
-    cont = bytearray(page.read_contents())  # read the contents source as a (modifyable) bytearray
-    if cont.find(b"/Subtype/Watermark") > 0:  # this will confirm a marked-content watermark is present
-        annotElt = etree.SubElement(annotsElt,'annotation')
-        annotElt.text = "/Watermark"
+    if sampleSpec is None:
+        pageIndices = range(doc.page_count)
+    else:
+        pageIndices = sampling.getSampledPages(sampleSpec, doc.page_count)
+        pdfRecord.sampleSpec = sampling.specToString(sampleSpec)
+        pdfRecord.sampledPages = [pageIndex + 1 for pageIndex in pageIndices]
+
+    watermarkScanner = watermarks.WatermarkScanner(doc)
+    colourSpaceResolver = iccprofiles.ColourSpaceResolver(doc)
+    for pageIndex in pageIndices:
+        pageNo = pageIndex + 1
+        with timer.page(pageNo):
+            page = doc.load_page(pageIndex)
+            pdfRecord.addPage(getPageProperties(doc, page, pageNo, decodeCheckFlag, timer, stages,
+                                                watermarkScanner, colourSpaceResolver,
+                                                pdfRecord.exceptions))
+            if streamFlag:
+                # Drop page and empty MuPDF's resource store, which otherwise
+                # keeps resources of earlier pages in memory
+                page = None
+                pymupdf.TOOLS.store_shrink(100)
 
-    pageElt.append(annotsElt)
+    # Page count
+    pdfRecord.noPages = doc.page_count
 
-    return pageElt
+    return pdfRecord
 
 
-def getImageProperties(doc, image, pageNo):
-    """Extract image properties and return result as Element object"""
+def getPageProperties(doc, page, pageNo, decodeCheckFlag=False, timer=timings.NullTimer(),
+                      stages=optionalStages, watermarkScanner=None, colourSpaceResolver=None,
+                      exceptions=None):
+    """Extract properties for one page and return result as PageRecord object.
+    The watermarkScanner and colourSpaceResolver can be shared between the
+    pages of a document. Exceptions while scanning for watermarks are added
+    to exceptions (the document-level exceptions list), if it is not None"""
 
-    # Create element object to store all image level properties
-    imageElt = etree.Element("image")
+    # Create record to store all page level properties
+    pageRecord = records.PageRecord(pageNo)
 
-    # Extract dictionary-level properties
-    propsDictElt = getImageDictProperties(image, pageNo)
-
-    # Check xref and filter values
-    # TODO: in case of multiple Filter values, e.g.:
-    #  /Filter [ /ASCII85Decode /DCTDecode ]
-    # PyMuPDF only returns the first one, which means
-    # check on DCTDecode value will fail! 
-    xref = int(propsDictElt.find('xref').text)
-    filter = propsDictElt.find('filter').text
-
-    # Get raw stream data
-    streamRaw = doc.xref_stream_raw(xref)
-
-    # Decode stream if necessary (TODO: perhaps add support for
-    # AsciiHexDecode, LZWDecode and FlateDecode filters?)
-    if filter == "ASCII85Decode":
-        stream = base64.a85decode(streamRaw, adobe=True)
-    else:
-        stream = streamRaw
+    # Iterate over all images on this page
+    images = page.get_images(full=False)
+    if colourSpaceResolver is None:
+        colourSpaceResolver = iccprofiles.ColourSpaceResolver(doc)
+    for image in images:
+        pageRecord.images.append(getImageProperties(doc, image, pageNo, decodeCheckFlag, timer, stages,
+                                                    colourSpaceResolver))
 
-    # Extract stream properties
-    propsStreamElt = getImageStreamProperties(stream, pageNo)
+    if "watermarkScan" not in stages:
+        return pageRecord
 
-    # Add properties to image element
-    imageElt.append(propsDictElt)
-    imageElt.append(propsStreamElt)
+    # Check for marked-content watermarks, which somehow are excluded from document-level check
+    # Source: https://github.com/pymupdf/PyMuPDF/discussions/1855#discussioncomment-3324039
+    if watermarkScanner is None:
+        watermarkScanner = watermarks.WatermarkScanner(doc)
+    pageRecord.annotations = []
+    try:
+        with timer.stage("watermarkScan"):
+            watermarkFlag = watermarkScanner.hasWatermark(page)
+        if watermarkFlag:
+            pageRecord.annotations.append("/Watermark")
+    except Exception as e:
+        if exceptions is not None:
+            exceptions.append(("page {} while scanning for watermarks: {}").format(str(pageNo), str(e)))
+        logging.warning(("page {} while scanning for watermarks: {}").format(str(pageNo), str(e)))
 
-    return imageElt
+    return pageRecord
 
 
-def getImageDictProperties(image, pageNo):
-    """Extract image dictionary properties and return result as Element object"""
+def getImageProperties(doc, image, pageNo, decodeCheckFlag=False, timer=timings.NullTimer(),
+                       stages=optionalStages, colourSpaceResolver=None):
+    """Extract image properties and return result as ImageRecord object"""
 
-    # Store properties at PDF object dictionary level to a dictionary
-    propsDict = {}
-    propsDict['xref'] = image[0]
-    #propsDict['smask'] = image[1]
-    propsDict['width'] = image[2]
-    propsDict['height'] = image[3]
-    propsDict['bpc'] = image[4]
-    propsDict['colorspace'] = image[5]
-    propsDict['altcolorspace'] = image[6]
-    #propsDict['name'] = image[7]
-    propsDict['filter'] = image[8]
+    xref = image[0]
 
-    # Dictionary to element object
-    propsDictElt = dictionaryToElt('dict', propsDict)
+    with timer.stage("imageRead"):
+        # Get raw stream data and filter chain
+        streamRaw = doc.xref_stream_raw(xref)
+        filterChain = filters.getFilters(doc, xref)
 
-    return propsDictElt
+    # Extract dictionary-level properties
+    imageRecord = records.ImageRecord(getImageDictProperties(image, pageNo, filterChain))
+
+    # Name and description of ICC profile of ICCBased colour space
+    propsColourSpace = {}
+    exceptionsColourSpace = []
+    if "iccProfile" in stages:
+        if colourSpaceResolver is None:
+            colourSpaceResolver = iccprofiles.ColourSpaceResolver(doc)
+        try:
+            with timer.stage("iccProfile"):
+                profileProperties = colourSpaceResolver.getProfileProperties(xref)
+            if profileProperties is not None:
+                propsColourSpace['colorspace_icc_profile_name'] = profileProperties[0]
+                propsColourSpace['colorspace_icc_profile_description'] = profileProperties[1]
+        except Exception as e:
+            exceptionsColourSpace.append(str(e))
+            # Errors of a profile that already failed are only logged once
+            if not isinstance(e, iccprofiles.ProfileError):
+                logging.warning(("page {} while extracting ICC profile properties from colour space: {}").format(str(pageNo), str(e)))
+
+    # Decode any filters that wrap the image codec, e.g. ASCII85Decode in
+    # /Filter [ /ASCII85Decode /DCTDecode ]. For JPEG images (and streams
+    # without codec, which may still contain JPEG data) only the header is
+    # needed, unless the image data are fully decoded. The same applies to
+    # JPEG 2000 images
+    codecFilters = filters.splitChain(filterChain)[1]
+    if decodeCheckFlag:
+        headerFunction = None
+    elif len(codecFilters) == 0 or codecFilters[-1][0] in ("DCTDecode", "DCT"):
+        headerFunction = filters.getJPEGHeaderLength
+    elif codecFilters[-1][0] == "JPXDecode":
+        headerFunction = jpeg2000.getHeaderLength
+    else:
+        headerFunction = None
 
+    try:
+        with timer.stage("imageRead"):
+            stream = filters.decodeStream(streamRaw, filterChain, headerFunction)[0]
+    except Exception as e:
+        imageRecord.streamProps = tuple(propsColourSpace.items())
+        imageRecord.streamExceptions = (str(e),) + tuple(exceptionsColourSpace)
+        logging.warning(("page {} while decoding image stream: {}").format(str(pageNo), str(e)))
+        return imageRecord
 
-def getImageStreamProperties(stream, pageNo):
-    """Extract image stream properties and return result as Element object"""
+    # Extract stream properties
+    propsStream, exceptionsStream = getImageStreamProperties(stream, pageNo, decodeCheckFlag,
+                                                             timer, stages)
+    propsStream.update(propsColourSpace)
+    imageRecord.streamProps = tuple(propsStream.items())
+    imageRecord.streamExceptions = tuple(exceptionsStream + exceptionsColourSpace)
+
+    return imageRecord
+
+
+def getImageDictProperties(image, pageNo, filterChain=()):
+    """Extract image dictionary properties and return values in the
+    order of ImageRecord.dictKeys"""
+
+    # Properties at PDF object dictionary level: xref, width, height,
+    # bpc, colorspace, altcolorspace and filter (smask and name are
+    # not used). PyMuPDF only returns the first filter of a filter
+    # chain, but the last one (the image codec) is the one that matters
+    filter = image[8]
+    if len(filterChain) > 1:
+        filter = filterChain[-1][0]
+    return (image[0], image[2], image[3], image[4], image[5], image[6], filter)
+
+
+def getImageStreamProperties(stream, pageNo, decodeCheckFlag=False, timer=timings.NullTimer(),
+                             stages=optionalStages):
+    """Extract image stream properties and return dictionary with properties
+    and list of exceptions. For JPEG images all properties are read from the
+    marker segments (SOF, DQT, APP0/JFIF, APP2/ICC, APP14/Adobe), which Pillow
+    parses when the image is opened, so the pixel data are only decoded
+    if decodeCheckFlag is True. The same applies to JPEG 2000 images, for
+    which the JP2 header boxes and the codestream main header are parsed
+    by the jpeg2000 module"""
 
     # Dictionary for storing stream properties
     propsStream = {}
-    # Element for storing stream-level exceptions
-    exceptionsStreamElt = etree.Element("exceptions")
+    # List for storing stream-level exceptions
+    exceptionsStream = []
 
     try:
-        im = PIL.Image.open(io.BytesIO(stream))
-        im.load()
+        with timer.stage("imageStream"):
+            im = PIL.Image.open(io.BytesIO(stream))
+            if decodeCheckFlag or im.format not in ("JPEG", "JPEG2000"):
+                im.load()
     except Exception as e:
-        ex = etree.SubElement(exceptionsStreamElt,'exception')
-        ex.text = str(e)
-        propsStreamElt = dictionaryToElt('stream', propsStream)
-        propsStreamElt.append(exceptionsStreamElt)
+        exceptionsStream.append(str(e))
         logging.warning(("page {} while reading image stream: {}").format(str(pageNo), str(e)))
-        return propsStreamElt
+        return propsStream, exceptionsStream
 
     propsStream['format'] = im.format
     width = im.size[0]
@@ -292,19 +572,45 @@ def getImageStreamProperties(stream, pageNo):
     propsStream['mode'] = im.mode
     noComponents = len(im.getbands())
     propsStream['components']= noComponents
-    bitsPerComponent = getBPC(im)
+
+    # Properties from JPEG 2000 header boxes and codestream main header
+    propsJPX = {}
+    if im.format == "JPEG2000":
+        try:
+            with timer.stage("imageStream"):
+                propsJPX, iccJPX = jpeg2000.getProperties(stream)
+            # Report resolution and ICC profile in the same way as for other
+            # formats if Pillow doesn't pick them up
+            if 'ppi_x' in propsJPX and 'dpi' not in im.info:
+                im.info['dpi'] = (propsJPX['ppi_x'], propsJPX['ppi_y'])
+            if iccJPX is not None and 'icc_profile' not in im.info:
+                im.info['icc_profile'] = iccJPX
+        except Exception as e:
+            exceptionsStream.append(str(e))
+            logging.warning(("page {} while reading JPEG 2000 header from image stream: {}").format(str(pageNo), str(e)))
+
+    # Bit depth from codestream for JPEG 2000, as Pillow modes of images
+    # with more than 8 bits per component don't map onto it
+    if 'bpc' in propsJPX:
+        bitsPerComponent = propsJPX['bpc']
+    else:
+        bitsPerComponent = getBPC(im)
     propsStream['bpc'] = bitsPerComponent
 
-    if im.format == "JPEG":
+    for key, value in propsJPX.items():
+        if key not in ('bpc', 'ppi_x', 'ppi_y'):
+            propsStream[key] = value
+
+    if im.format == "JPEG" and "jpegQuality" in stages:
         try:
             # Estimate JPEG quality using least squares matching
             # against standard quantization tables
-            quality, rmsError, nse = jpegquality.computeJPEGQuality(im)
+            with timer.stage("jpegQuality"):
+                quality, rmsError, nse = jpegquality.computeJPEGQuality(im)
             propsStream['JPEGQuality'] = quality
             propsStream['NSE_JPEGQuality'] = nse
         except Exception as e:
-            ex = etree.SubElement(exceptionsStreamElt,'exception')
-            ex.text = str(e)
+            exceptionsStream.append(str(e))
             logging.warning(("page {} while estimating JPEG quality from image stream: {}").format(str(pageNo), str(e)))
 
     for key, value in im.info.items():
@@ -330,17 +636,14 @@ def getImageStreamProperties(stream, pageNo):
     except KeyError:
         pass
 
-    if iccFlag:
+    if iccFlag and "iccProfile" in stages:
         try:
-            iccProfile = ImageCms.ImageCmsProfile(io.BytesIO(icc))
-            propsStream['icc_profile_name'] = ImageCms.getProfileName(iccProfile).strip()
-            propsStream['icc_profile_description'] = ImageCms.getProfileDescription(iccProfile).strip()
+            with timer.stage("iccProfile"):
+                profileName, profileDescription = iccprofiles.getProfileProperties(icc)
+            propsStream['icc_profile_name'] = profileName
+            propsStream['icc_profile_description'] = profileDescription
         except Exception as e:
-            ex = etree.SubElement(exceptionsStreamElt,'exception')
-            ex.text = str(e)
+            exceptionsStream.append(str(e))
             logging.warning(("page {} while extracting ICC profile properties from image stream: {}").format(str(pageNo), str(e)))
 
-    propsStreamElt = dictionaryToElt('stream', propsStream)
-    propsStreamElt.append(exceptionsStreamElt)
-
-    return propsStreamElt
+    return propsStream, exceptionsStream
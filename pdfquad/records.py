@@ -0,0 +1,168 @@
+#! /usr/bin/env python3
+
+"""PDF Quality Assessment for Digitisation batches
+
+Johan van der Knijff
+
+Copyright 2024, KB/National Library of the Netherlands
+
+Module with compact records that hold the extracted properties of a PDF,
+its pages and its images. The properties are only converted to an lxml
+tree (which is much larger) once extraction is finished
+
+"""
+
+from lxml import etree
+
+
+def addChildren(elt, items):
+    """Add child element with text value for each (key, value) pair in items"""
+    for key, value in items:
+        etree.SubElement(elt, key).text = str(value)
+
+
+def addExceptions(elt, exceptions):
+    """Add exceptions element with child element for each exception"""
+    exceptionsElt = etree.SubElement(elt, "exceptions")
+    for exception in exceptions:
+        etree.SubElement(exceptionsElt, "exception").text = exception
+
+
+class ImageRecord:
+    """Properties of one image: the values from the image dictionary,
+    properties from the image stream as a tuple of (key, value) pairs, and
+    exceptions raised while reading the image stream"""
+
+    __slots__ = ("dictValues", "streamProps", "streamExceptions")
+
+    dictKeys = ("xref", "width", "height", "bpc", "colorspace", "altcolorspace", "filter")
+
+    def __init__(self, dictValues, streamProps=(), streamExceptions=()):
+        self.dictValues = tuple(dictValues)
+        self.streamProps = tuple(streamProps)
+        self.streamExceptions = tuple(streamExceptions)
+
+    def getDictValue(self, key):
+        """Return value of image dictionary property key"""
+        return self.dictValues[self.dictKeys.index(key)]
+
+    def addElt(self, parentElt):
+        """Add image element to parentElt"""
+        imageElt = etree.SubElement(parentElt, "image")
+        addChildren(etree.SubElement(imageElt, "dict"), zip(self.dictKeys, self.dictValues))
+        streamElt = etree.SubElement(imageElt, "stream")
+        addChildren(streamElt, self.streamProps)
+        addExceptions(streamElt, self.streamExceptions)
+
+
+class PageRecord:
+    """Properties of one page: page number, image records and annotation
+    subtypes"""
+
+    __slots__ = ("number", "images", "annotations")
+
+    def __init__(self, number):
+        self.number = number
+        self.images = []
+        # Annotations are None if the page contents weren't scanned
+        self.annotations = None
+
+    def addElt(self, parentElt):
+        """Add page element to parentElt"""
+        pageElt = etree.SubElement(parentElt, "page")
+        pageElt.attrib["number"] = str(self.number)
+        for image in self.images:
+            image.addElt(pageElt)
+        if self.annotations is not None:
+            annotsElt = etree.SubElement(pageElt, "annotations")
+            for subtype in self.annotations:
+                etree.SubElement(annotsElt, "annotation").text = subtype
+
+
+class PDFRecord:
+    """Properties of one PDF. Properties that weren't extracted (e.g.
+    because the PDF couldn't be opened, or because the extraction stage
+    was skipped) are None, and are left out of the properties element.
+    Identical image stream properties (which are common for scanned books)
+    are stored only once"""
+
+    __slots__ = ("filePath", "fileSize", "openPassword", "meta", "pageMode",
+                 "signatureFlag", "optionalContent", "javaScript", "noPages",
+                 "pages", "annotations", "exceptions",
+                 "streamPropsTable", "sampleSpec", "sampledPages", "checksumType",
+                 "checksum")
+
+    def __init__(self, filePath, fileSize):
+        self.filePath = filePath
+        self.fileSize = fileSize
+        self.openPassword = None
+        self.meta = None
+        self.pageMode = None
+        self.signatureFlag = None
+        self.optionalContent = None
+        self.javaScript = None
+        self.noPages = None
+        self.pages = []
+        self.annotations = None
+        self.exceptions = []
+        self.streamPropsTable = {}
+        # Page sampling specification and numbers of sampled pages,
+        # which are None if all pages were analysed
+        self.sampleSpec = None
+        self.sampledPages = None
+        # Checksum of file, which is None if it wasn't computed
+        self.checksumType = None
+        self.checksum = None
+
+    def addPage(self, page):
+        """Add page record, sharing image stream properties with any
+        earlier images that have the same properties"""
+        for image in page.images:
+            image.streamProps = self.streamPropsTable.setdefault(image.streamProps,
+                                                                 image.streamProps)
+        self.pages.append(page)
+
+    def isComplete(self):
+        """Return True if document-level properties were extracted"""
+        return self.noPages is not None
+
+    def toElt(self):
+        """Return properties as Element object"""
+        propertiesElt = etree.Element("properties")
+        addChildren(propertiesElt, [("filePath", self.filePath),
+                                    ("fileSize", self.fileSize)])
+        if self.checksum is not None:
+            checksumElt = etree.SubElement(propertiesElt, "checksum")
+            checksumElt.attrib["algorithm"] = self.checksumType
+            checksumElt.text = self.checksum
+        if self.openPassword is not None:
+            addChildren(propertiesElt, [("openPassword", self.openPassword)])
+
+        if not self.isComplete():
+            # PDF couldn't be opened, or has open password
+            if len(self.exceptions) != 0:
+                addExceptions(propertiesElt, self.exceptions)
+            return propertiesElt
+
+        addChildren(etree.SubElement(propertiesElt, "meta"), self.meta.items())
+        addChildren(propertiesElt, [("PageMode", self.pageMode),
+                                    ("signatureFlag", self.signatureFlag),
+                                    ("containsOptionalContent", self.optionalContent)])
+        if self.javaScript is not None:
+            addChildren(propertiesElt, [("containsJavaScript", self.javaScript)])
+        addChildren(propertiesElt, [("noPages", self.noPages)])
+        if self.sampledPages is not None:
+            samplingElt = etree.SubElement(propertiesElt, "pageSampling")
+            addChildren(samplingElt, [("spec", self.sampleSpec),
+                                      ("noSampledPages", len(self.sampledPages)),
+                                      ("sampledPages", " ".join(str(pageNo) for pageNo in self.sampledPages))])
+        pagesElt = etree.SubElement(propertiesElt, "pages")
+        for page in self.pages:
+            page.addElt(pagesElt)
+        if self.annotations is not None:
+            annotsElt = etree.SubElement(propertiesElt, "annotations")
+            for subtype in self.annotations:
+                etree.SubElement(annotsElt, "annotation").text = subtype
+        addExceptions(propertiesElt, self.exceptions)
+
+        return propertiesElt
@@ -0,0 +1,553 @@
+#! /usr/bin/env python3
+
+"""PDF Quality Assessment for Digitisation batches
+
+Johan van der Knijff
+
+Copyright 2024, KB/National Library of the Netherlands
+
+Native rule engine for Schematron schemas. Schemas that only use rules with
+simple context paths and asserts with simple XPath tests (paths, count(),
+text() predicates, comparisons, and, or) are translated into Python
+predicates, which are evaluated directly on the extracted properties. This
+avoids the XSLT transformation that is otherwise needed for each PDF. The
+resulting report is identical to the SVRL report of the isoschematron
+validator. Schemas that use anything else are left to isoschematron
+
+"""
+
+import re
+import copy
+import math
+import operator
+from lxml import etree
+
+# Namespaces of Schematron schemas and SVRL reports
+nsSch = "http://purl.oclc.org/dsdl/schematron"
+nsSvrl = "http://purl.oclc.org/dsdl/svrl"
+
+# Tokens of supported XPath subset
+reToken = re.compile(r"""\s*(?:
+                         (?P<number>\d+(?:\.\d*)?|\.\d+)|
+                         (?P<string>'[^']*'|"[^"]*")|
+                         (?P<operator>!=|<=|>=|=|<|>|\(|\)|\[|\]|/|-)|
+                         (?P<name>[A-Za-z_][A-Za-z0-9_.-]*)
+                         )""", re.VERBOSE)
+
+# Number format of XPath number() function
+reNumber = re.compile(r"\s*-?(?:\d+(?:\.\d*)?|\.\d+)\s*$")
+
+# Context of supported rules: element names separated by slashes
+reContext = re.compile(r"//[A-Za-z_][A-Za-z0-9_.-]*(?:/[A-Za-z_][A-Za-z0-9_.-]*)*$")
+
+
+class UnsupportedError(Exception):
+    """Raised if a schema uses anything that isn't supported by the
+    native rule engine"""
+    pass
+
+
+def numberValue(string):
+    """Convert string to number, following the XPath number() function"""
+    if string.isascii() and string.isdigit():
+        return float(string)
+    if reNumber.match(string):
+        return float(string)
+    return math.nan
+
+
+def stringValue(node):
+    """Return string value of element or text node"""
+    if isinstance(node, str):
+        return node
+    if len(node) == 0:
+        return node.text or ""
+    return "".join(node.itertext())
+
+
+def toNumber(value):
+    """Convert value to number, following the XPath number() function"""
+    if isinstance(value, list):
+        value = stringValue(value[0]) if len(value) != 0 else ""
+    if isinstance(value, bool):
+        return 1.0 if value else 0.0
+    if isinstance(value, float):
+        return value
+    return numberValue(value)
+
+
+def toBoolean(value):
+    """Convert value to boolean, following the XPath boolean() function"""
+    if isinstance(value, (list, str)):
+        return len(value) != 0
+    if isinstance(value, float):
+        return not (value == 0 or math.isnan(value))
+    return value
+
+
+operators = {"=": operator.eq,
+             "!=": operator.ne,
+             "<": operator.lt,
+             "<=": operator.le,
+             ">": operator.gt,
+             ">=": operator.ge}
+
+# Operators with their operands swapped
+swappedOperators = {"=": "=", "!=": "!=", "<": ">", "<=": ">=", ">": "<", ">=": "<="}
+
+
+def compareAtomic(op, a, b):
+    """Compare two values that are not node-sets, following XPath 1.0"""
+    if op in ("=", "!="):
+        if isinstance(a, bool) or isinstance(b, bool):
+            return operators[op](toBoolean(a), toBoolean(b))
+        if isinstance(a, float) or isinstance(b, float):
+            return operators[op](toNumber(a), toNumber(b))
+        return operators[op](a, b)
+    return operators[op](toNumber(a), toNumber(b))
+
+
+def compare(op, a, b):
+    """Compare two values, following XPath 1.0: a comparison that involves
+    a node-set is true if it is true for any node in the node-set"""
+    if isinstance(a, list) and isinstance(b, list):
+        valuesB = [stringValue(node) for node in b]
+        return any(compareAtomic(op, stringValue(nodeA), valueB)
+                   for nodeA in a for valueB in valuesB)
+    if isinstance(a, list):
+        if isinstance(b, bool):
+            return compareAtomic(op, toBoolean(a), b)
+        return any(compareAtomic(op, stringValue(node), b) for node in a)
+    if isinstance(b, list):
+        if isinstance(a, bool):
+            return compareAtomic(op, a, toBoolean(b))
+        return any(compareAtomic(op, a, stringValue(node)) for node in b)
+    return compareAtomic(op, a, b)
+
+
+def compileComparison(op, left, right):
+    """Return function for comparison of typed functions left and right.
+    The common cases of a node-set compared to a number or string are
+    handled without any run-time type checks"""
+    leftType, leftFunction = left
+    rightType, rightFunction = right
+    function = operators[op]
+
+    if leftType != "nodeset" and rightType == "nodeset":
+        # Swap operands, so the node-set is always on the left
+        return compileComparison(swappedOperators[op], right, left)
+
+    if leftType == "number" and rightType == "number":
+        return lambda elt: function(leftFunction(elt), rightFunction(elt))
+
+    if leftType == "nodeset" and (rightType == "number" or
+                                  (rightType == "string" and op not in ("=", "!="))):
+        if rightType == "string":
+            rightNumber = lambda elt: numberValue(rightFunction(elt))
+        else:
+            rightNumber = rightFunction
+        return lambda elt: any(function(numberValue(stringValue(node)), rightNumber(elt))
+                               for node in leftFunction(elt))
+
+    if leftType == "nodeset" and rightType == "string":
+        return lambda elt: any(function(stringValue(node), rightFunction(elt))
+                               for node in leftFunction(elt))
+
+    return lambda elt: compare(op, leftFunction(elt), rightFunction(elt))
+
+
+def compileBoolean(typed):
+    """Return function that returns the boolean value of typed function"""
+    valueType, function = typed
+    if valueType == "boolean":
+        return function
+    if valueType in ("nodeset", "string"):
+        return lambda elt: len(function(elt)) != 0
+    return lambda elt: toBoolean(function(elt))
+
+
+class Parser:
+    """Recursive descent parser that translates an XPath expression into a
+    function that evaluates it for a context element. Parse methods return
+    (type, function) tuples, where type is the XPath type of the result
+    (nodeset, number, string or boolean). Node-sets are represented as
+    lists of elements or text strings. All element paths in the expression
+    are collected in paths, as [path, valueFlag] lists, where path is a tuple
+    of element names relative to the context, and valueFlag indicates
+    whether the string values of the elements are used"""
+
+    def __init__(self, expression):
+        self.tokens = []
+        position = 0
+        expression = expression.rstrip()
+        while position < len(expression):
+            match = reToken.match(expression, position)
+            if match is None or match.end() == position:
+                raise UnsupportedError("unsupported expression {}".format(expression))
+            kind = match.lastgroup
+            self.tokens.append((kind, match.group(kind)))
+            position = match.end()
+        self.position = 0
+        self.expression = expression
+        self.paths = []
+        # Path of the context of the path that is being parsed
+        self.prefix = ()
+        # Entry in paths for each function that evaluates a path
+        self.pathEntries = {}
+
+    def peek(self):
+        """Return next token, or (None, None) at end of expression"""
+        if self.position < len(self.tokens):
+            return self.tokens[self.position]
+        return None, None
+
+    def next(self):
+        """Return next token and advance"""
+        token = self.peek()
+        self.position += 1
+        return token
+
+    def expect(self, value):
+        """Advance past operator value, or raise UnsupportedError"""
+        if self.next() != ("operator", value):
+            raise UnsupportedError("unsupported expression {}".format(self.expression))
+
+    def parse(self):
+        """Return function that returns boolean value of complete expression"""
+        typed = self.parseOr()
+        if self.peek() != (None, None):
+            raise UnsupportedError("unsupported expression {}".format(self.expression))
+        return compileBoolean(typed)
+
+    def parseOr(self):
+        """or-expression"""
+        operands = [self.parseAnd()]
+        while self.peek() == ("name", "or"):
+            self.next()
+            operands.append(self.parseAnd())
+        if len(operands) == 1:
+            return operands[0]
+        functions = [compileBoolean(operand) for operand in operands]
+        return "boolean", lambda elt: any(function(elt) for function in functions)
+
+    def parseAnd(self):
+        """and-expression"""
+        operands = [self.parseComparison()]
+        while self.peek() == ("name", "and"):
+            self.next()
+            operands.append(self.parseComparison())
+        if len(operands) == 1:
+            return operands[0]
+        functions = [compileBoolean(operand) for operand in operands]
+        return "boolean", lambda elt: all(function(elt) for function in functions)
+
+    def parseComparison(self):
+        """Equality or relational expression"""
+        left = self.parsePrimary()
+        kind, value = self.peek()
+        if kind == "operator" and value in operators:
+            self.next()
+            right = self.parsePrimary()
+            for operand in (left, right):
+                if operand[1] in self.pathEntries:
+                    self.pathEntries[operand[1]][1] = True
+            return "boolean", compileComparison(value, left, right)
+        return left
+
+    def parsePrimary(self):
+        """Parenthesized expression, literal, count() function or path"""
+        kind, value = self.peek()
+        if (kind, value) == ("operator", "("):
+            self.next()
+            typed = self.parseOr()
+            self.expect(")")
+            return typed
+        if kind == "number":
+            self.next()
+            number = float(value)
+            return "number", lambda elt: number
+        if (kind, value) == ("operator", "-"):
+            self.next()
+            kind, value = self.next()
+            if kind != "number":
+                raise UnsupportedError("unsupported expression {}".format(self.expression))
+            number = -float(value)
+            return "number", lambda elt: number
+        if kind == "string":
+            self.next()
+            string = value[1:-1]
+            return "string", lambda elt: string
+        if kind == "name" and value == "count":
+            self.next()
+            self.expect("(")
+            path = self.parsePath()
+            self.expect(")")
+            return "number", lambda elt: float(len(path(elt)))
+        if kind == "name":
+            return "nodeset", self.parsePath()
+        raise UnsupportedError("unsupported expression {}".format(self.expression))
+
+    def parsePath(self):
+        """Relative location path of child element steps, optionally
+        followed by a text() step. Each step can have one predicate.
+        Returns function that returns the resulting node-set"""
+        steps = []
+        path = self.prefix
+        valueFlag = False
+        while True:
+            kind, name = self.next()
+            if kind != "name" or name in ("and", "or", "count"):
+                raise UnsupportedError("unsupported expression {}".format(self.expression))
+            if name == "text":
+                # text() step, this must be the last step
+                self.expect("(")
+                self.expect(")")
+                steps.append(("text", None))
+                valueFlag = True
+                break
+            path += (name,)
+            predicate = None
+            if self.peek() == ("operator", "["):
+                self.next()
+                prefix = self.prefix
+                self.prefix = path
+                predicate = compileBoolean(self.parseOr())
+                self.prefix = prefix
+                self.expect("]")
+            steps.append((name, predicate))
+            if self.peek() != ("operator", "/"):
+                break
+            self.next()
+
+        entry = [path, valueFlag]
+        self.paths.append(entry)
+
+        if len(steps) == 1 and steps[0][0] != "text" and steps[0][1] is None:
+            name = steps[0][0]
+            function = lambda elt: list(elt.iterchildren(name))
+            self.pathEntries[function] = entry
+            return function
+
+        def evaluate(elt):
+            nodes = [elt]
+            for name, predicate in steps:
+                if name == "text":
+                    nodes = [text for node in nodes
+                             for text in [node.text] + [child.tail for child in node]
+                             if text]
+                    break
+                nodes = [child for node in nodes for child in node.iterchildren(name)]
+                if predicate is not None:
+                    nodes = [node for node in nodes if predicate(node)]
+            return nodes
+
+        self.pathEntries[evaluate] = entry
+        return evaluate
+
+
+def getLocation(elt):
+    """Return location of element in the same notation as the SVRL
+    report of isoschematron (schematron-get-full-path mode)"""
+    steps = []
+    while elt is not None:
+        name = elt.tag
+        previous = sum(1 for sibling in elt.itersiblings(name, preceding=True))
+        if previous > 0 or next(elt.itersiblings(name), None) is not None:
+            steps.append("/{}[{}]".format(name, previous + 1))
+        else:
+            steps.append("/" + name)
+        elt = elt.getparent()
+    return "".join(reversed(steps))
+
+
+def isRepeated(elt):
+    """Return True if element or one of its ancestors has a sibling with the
+    same name, i.e. the element is part of a repeated structure"""
+    while elt is not None:
+        name = elt.tag
+        if next(elt.itersiblings(name), None) is not None or \
+           next(elt.itersiblings(name, preceding=True), None) is not None:
+            return True
+        elt = elt.getparent()
+    return False
+
+
+class Rule:
+    """Compiled rule, with context path (as list of element names), list
+    of (test, text, predicate) tuples for its asserts, and set of paths
+    of all elements used by the rule (see Parser)"""
+
+    # Maximum total size (bytes) of the keys of memoized results
+    maxResultBytes = 1048576
+    # Memoization is switched off for a rule if none of its first
+    # minLookups lookups was a hit
+    minLookups = 64
+
+    def __init__(self, ruleElt):
+        if set(ruleElt.attrib) != {"context"}:
+            raise UnsupportedError("unsupported rule attributes")
+        self.context = ruleElt.attrib["context"]
+        if not reContext.match(self.context):
+            raise UnsupportedError("unsupported rule context {}".format(self.context))
+        self.path = self.context[2:].split("/")
+        self.asserts = []
+        # Paths of all elements used by the rule, as (path, valueFlag) tuples
+        self.paths = {(tuple(self.path), False)}
+        for child in ruleElt:
+            if child.tag is etree.Comment:
+                continue
+            if child.tag != "{%s}assert" % nsSch or set(child.attrib) != {"test"} or len(child) != 0:
+                raise UnsupportedError("unsupported rule content")
+            test = " ".join(child.attrib["test"].split())
+            parser = Parser(test)
+            self.asserts.append((test, child.text, parser.parse()))
+            for path, valueFlag in parser.paths:
+                self.paths.add((tuple(self.path) + path, valueFlag))
+        self.results = {}
+        self.resultBytes = 0
+        self.noLookups = 0
+        self.noHits = 0
+        self.memoFlag = True
+
+    def matches(self, elt):
+        """Return True if element matches rule context"""
+        for name in reversed(self.path):
+            if elt is None or elt.tag != name:
+                return False
+            elt = elt.getparent()
+        return True
+
+    def getFailedAsserts(self, elt):
+        """Return list of (test, text) tuples of asserts that fail for element.
+        Supported tests only depend on the subtree of the element, so results
+        are memoized by its serialization. This is the same for e.g. the image
+        streams of all pages of a scanned book. Elements that occur only once
+        in the document (e.g. the root) aren't memoized, as serializing them
+        costs more than it saves. Contexts that contain identifying values
+        (e.g. the page number) never repeat, so memoization is switched off
+        for rules that don't get any hits"""
+        if not self.memoFlag or not isRepeated(elt):
+            return self.evaluate(elt)
+        key = etree.tostring(elt, with_tail=False)
+        self.noLookups += 1
+        try:
+            failedAsserts = self.results[key]
+            self.noHits += 1
+            return failedAsserts
+        except KeyError:
+            pass
+        failedAsserts = self.evaluate(elt)
+        if self.noHits == 0 and self.noLookups >= self.minLookups:
+            self.memoFlag = False
+            self.results.clear()
+            return failedAsserts
+        if self.resultBytes + len(key) > self.maxResultBytes:
+            self.results.clear()
+            self.resultBytes = 0
+        self.results[key] = failedAsserts
+        self.resultBytes += len(key)
+        return failedAsserts
+
+    def evaluate(self, elt):
+        """Return list of (test, text) tuples of asserts that fail for element"""
+        return [(test, text) for test, text, predicate in self.asserts
+                if not predicate(elt)]
+
+
+class NativeSchema:
+    """Schema that is validated with the native rule engine. The report
+    header and active-pattern elements are taken from reportFrame, the
+    isoschematron report for a document that doesn't match any rule"""
+
+    def __init__(self, schemaElt, reportFrame):
+        # Elements that aren't supported anywhere in the schema
+        for elt in schemaElt.iter():
+            if elt.tag is etree.Comment:
+                continue
+            if elt.tag not in ("{%s}schema" % nsSch, "{%s}pattern" % nsSch,
+                               "{%s}title" % nsSch, "{%s}rule" % nsSch,
+                               "{%s}assert" % nsSch):
+                raise UnsupportedError("unsupported element {}".format(elt.tag))
+
+        self.patterns = []
+        for patternElt in schemaElt.iterfind("{%s}pattern" % nsSch):
+            if len(patternElt.attrib) != 0:
+                raise UnsupportedError("unsupported pattern attributes")
+            self.patterns.append([Rule(ruleElt) for ruleElt in
+                                  patternElt.iterfind("{%s}rule" % nsSch)])
+
+        self.reportFrame = reportFrame
+        activePatterns = reportFrame.findall("{%s}active-pattern" % nsSvrl)
+        if len(activePatterns) != len(self.patterns) or len(reportFrame) != len(self.patterns) + 1:
+            raise UnsupportedError("unexpected report structure")
+
+        # Rules for each element name, for quick lookup
+        self.rulesByName = []
+        for rules in self.patterns:
+            rulesByName = {}
+            for rule in rules:
+                rulesByName.setdefault(rule.path[-1], []).append(rule)
+            self.rulesByName.append(rulesByName)
+
+    def getPaths(self):
+        """Return set of (path, valueFlag) tuples for all elements used by
+        the schema, with paths relative to the document root. Contexts
+        match anywhere in the document, so the root is assumed to be the
+        first element of each context"""
+        return set().union(*[rule.paths for rules in self.patterns for rule in rules])
+
+    def validate(self, propertiesElt, verboseFlag=True):
+        """Validate properties element, and return validation result (True
+        if all asserts passed) and SVRL report with failed-assert elements.
+        If verboseFlag is True, the report also contains fired-rule elements.
+        Otherwise the report is identical to the isoschematron report after
+        removal of all fired-rule elements"""
+        report = copy.deepcopy(self.reportFrame)
+        validationResult = True
+
+        # Children of report. Fired rules that are left out are represented
+        # by None, as they affect the whitespace of the other children
+        children = []
+        patternNo = 0
+        for child in report:
+            children.append(child)
+            if child.tag != "{%s}active-pattern" % nsSvrl:
+                continue
+            rulesByName = self.rulesByName[patternNo]
+            patternNo += 1
+            # Traverse elements in document order. Only the first matching
+            # rule in a pattern fires for each element
+            for elt in propertiesElt.iter(*rulesByName):
+                for rule in rulesByName[elt.tag]:
+                    if rule.matches(elt):
+                        if verboseFlag:
+                            firedRuleElt = etree.Element("{%s}fired-rule" % nsSvrl)
+                            firedRuleElt.attrib["context"] = rule.context
+                            children.append(firedRuleElt)
+                        else:
+                            children.append(None)
+                        for test, text in rule.getFailedAsserts(elt):
+                            children.append(self.failedAssert(test, text, elt))
+                            validationResult = False
+                        break
+
+        for child in children:
+            if child is not None:
+                child.tail = "\n  "
+        if children[-1] is not None:
+            children[-1].tail = "\n"
+        report[:] = [child for child in children if child is not None]
+
+        return validationResult, report
+
+    @staticmethod
+    def failedAssert(test, text, elt):
+        """Return failed-assert element"""
+        failedAssertElt = etree.Element("{%s}failed-assert" % nsSvrl)
+        failedAssertElt.attrib["test"] = test
+        failedAssertElt.attrib["location"] = getLocation(elt)
+        failedAssertElt.text = "\n    "
+        textElt = etree.SubElement(failedAssertElt, "{%s}text" % nsSvrl)
+        textElt.text = text
+        textElt.tail = "\n  "
+        return failedAssertElt
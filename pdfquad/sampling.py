@@ -0,0 +1,78 @@
+#! /usr/bin/env python3
+
+"""PDF Quality Assessment for Digitisation batches
+
+Johan van der Knijff
+
+Copyright 2024, KB/National Library of the Netherlands
+
+Module with code for selecting a sample of the pages of a PDF, which
+is used to speed up the analysis of PDFs with very many pages
+
+"""
+
+import re
+import math
+
+# Sampling terms: fixed count, fraction, and first, last or every k-th pages
+reCount = re.compile(r"^[0-9]+$")
+reFraction = re.compile(r"^(0?\.[0-9]+|1\.0*)$")
+reKeyword = re.compile(r"^(first|last|every)([0-9]+)$")
+
+
+def parseSampleSpec(specString):
+    """Parse page sampling specification, which is a comma-separated list
+    of terms, and return it as a tuple of (kind, value) tuples. Raises
+    ValueError if the specification is not valid"""
+    terms = []
+    for term in specString.lower().replace(" ", "").split(","):
+        keywordMatch = reKeyword.match(term)
+        if reCount.match(term):
+            terms.append(("count", int(term)))
+        elif reFraction.match(term):
+            terms.append(("fraction", float(term)))
+        elif keywordMatch is not None:
+            terms.append((keywordMatch.group(1), int(keywordMatch.group(2))))
+        else:
+            raise ValueError("invalid page sampling term '{}'".format(term))
+        if terms[-1][1] <= 0:
+            raise ValueError("page sampling term '{}' must be larger than 0".format(term))
+    return tuple(terms)
+
+
+def specToString(spec):
+    """Return page sampling specification as string"""
+    strings = []
+    for kind, value in spec:
+        if kind in ("count", "fraction"):
+            strings.append(str(value))
+        else:
+            strings.append(("{}{}").format(kind, value))
+    return ",".join(strings)
+
+
+def getStratifiedPages(noSamples, noPages):
+    """Return indices of noSamples pages, with one page from the middle
+    of each of noSamples equally sized parts of the document"""
+    noSamples = min(noSamples, noPages)
+    return {(2 * i + 1) * noPages // (2 * noSamples) for i in range(noSamples)}
+
+
+def getSampledPages(spec, noPages):
+    """Return sorted list with (zero-based) indices of the pages that are
+    selected by page sampling specification spec, for a PDF with noPages
+    pages. The selection only depends on the number of pages, so repeated
+    runs sample the same pages"""
+    pages = set()
+    for kind, value in spec:
+        if kind == "count":
+            pages.update(getStratifiedPages(value, noPages))
+        elif kind == "fraction":
+            pages.update(getStratifiedPages(math.ceil(value * noPages), noPages))
+        elif kind == "first":
+            pages.update(range(min(value, noPages)))
+        elif kind == "last":
+            pages.update(range(max(noPages - value, 0), noPages))
+        elif kind == "every":
+            pages.update(range(0, noPages, value))
+    return sorted(pages)
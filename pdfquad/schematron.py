@@ -16,6 +16,16 @@ import logging
 from lxml import isoschematron
 from lxml import etree
 from . import shared
+from . import rules
+from . import properties
+
+# Compiled Schematron validators, keyed by schema path
+compiledSchemas = {}
+# Schemas compiled for the native rule engine (or None for schemas
+# that can only be validated with isoschematron), keyed by schema path
+nativeSchemas = {}
+# Optional extraction stages needed for each schema, keyed by schema path
+requiredStages = {}
 
 
 def listProfilesSchemas(profilesDir, schemasDir):
@@ -105,6 +115,70 @@ def readProfile(profile, schemasDir):
     return listOut
 
 
+def compileSchemas(schemas):
+    """Compile Schematron validators for all schemas in list returned
+    by readProfile, and store them in the compiledSchemas and nativeSchemas
+    caches. This is also used as initializer for the worker processes,
+    as compiled validators cannot be passed between processes"""
+    for schema in schemas:
+        getNativeSchema(schema[3])
+
+
+def getSchematron(schema):
+    """Return compiled Schematron validator for schema from the
+    compiledSchemas cache, compile it first if not cached yet"""
+    try:
+        schematron = compiledSchemas[schema]
+    except KeyError:
+        mySchemaElt = readAsLXMLElt(schema)
+        schematron = isoschematron.Schematron(mySchemaElt,
+                                              store_report=True)
+        compiledSchemas[schema] = schematron
+
+    return schematron
+
+
+def getNativeSchema(schema):
+    """Return schema compiled for the native rule engine from the
+    nativeSchemas cache, compile it first if not cached yet. Returns
+    None if the schema uses anything the native rule engine doesn't
+    support"""
+    try:
+        nativeSchema = nativeSchemas[schema]
+    except KeyError:
+        schematron = getSchematron(schema)
+        try:
+            # The report for an empty document provides the report header
+            schematron.validate(etree.Element("pdfquad"))
+            reportFrame = etree.fromstring(str(schematron.validation_report))
+            nativeSchema = rules.NativeSchema(readAsLXMLElt(schema).getroot(), reportFrame)
+        except rules.UnsupportedError as e:
+            logging.info(("schema {} is validated with isoschematron: {}").format(schema, str(e)))
+            nativeSchema = None
+        nativeSchemas[schema] = nativeSchema
+
+    return nativeSchema
+
+
+def getRequiredStages(schema):
+    """Return set of optional extraction stages (see properties.optionalStages)
+    that are needed to validate against schema. These are derived from
+    the element paths used by the schema's rules, which is only possible
+    for schemas that are validated with the native rule engine. For all
+    other schemas all stages are needed"""
+    try:
+        stages = requiredStages[schema]
+    except KeyError:
+        nativeSchema = getNativeSchema(schema)
+        if nativeSchema is None:
+            stages = set(properties.optionalStages)
+        else:
+            stages = properties.getRequiredStages(nativeSchema.getPaths())
+        requiredStages[schema] = stages
+
+    return stages
+
+
 def readAsLXMLElt(xmlFile):
     """Parse XML file with lxml and return result as element object
     (not the same as Elementtree object!)
@@ -192,19 +266,21 @@ def validate(schema, propertiesElt, verboseFlag):
 
     # Element used to store validation report
     reportElt = etree.Element("schematronReport")
-    # Get schema as lxml.etree element
-    mySchemaElt = readAsLXMLElt(schema)
-    # Start Schematron magic ...
-    schematron = isoschematron.Schematron(mySchemaElt,
-                                          store_report=True)
+    # Use native rule engine if schema allows it, and the compiled
+    # Schematron validator otherwise
+    nativeSchema = getNativeSchema(schema)
+    schematron = getSchematron(schema)
 
     try:
         # Validate properties element against schema
-        validationResult = schematron.validate(propertiesElt)
+        if nativeSchema is not None:
+            validationResult, report = nativeSchema.validate(propertiesElt, verboseFlag)
+        else:
+            validationResult = schematron.validate(propertiesElt)
+            report = schematron.validation_report
         # Set status to "Fail" if properties didn't pass validation
         if not validationResult:
             validationOutcome = "Fail"
-        report = schematron.validation_report
         validationSuccess = True
 
     except Exception:
@@ -213,7 +289,8 @@ def validate(schema, propertiesElt, verboseFlag):
 
     try:
         # Re-parse Schematron report
-        report = etree.fromstring(str(report))
+        if nativeSchema is None:
+            report = etree.fromstring(str(report))
         # Make report less verbose
         if not verboseFlag:
             report = summariseSchematron(report)
@@ -0,0 +1,285 @@
+#! /usr/bin/env python3
+
+"""PDF Quality Assessment for Digitisation batches
+
+Johan van der Knijff
+
+Copyright 2024, KB/National Library of the Netherlands
+
+Module for aggregating batch-level statistics (validation outcomes, pages
+per PDF, JPEG quality and resolution distributions and failed assertions)
+while a batch is processed. Memory use doesn't depend on the number of PDFs
+
+"""
+
+import os
+import csv
+import json
+import collections
+
+# Maximum number of distinct values in a histogram. Any further values
+# are counted in the "other" bin
+maxBins = 1000
+otherBin = "other"
+# Group of statistics of all PDFs in the CSV file
+allGroup = "(all)"
+
+
+def getPageBin(noPages):
+    """Return histogram bin for noPages, using bins that double in size"""
+    if noPages < 1:
+        return "0"
+    lower = 1 << (noPages.bit_length() - 1)
+    upper = 2 * lower - 1
+    if lower == upper:
+        return str(lower)
+    return ("{}-{}").format(lower, upper)
+
+
+def getBinKey(binName):
+    """Return sort key for histogram bin"""
+    try:
+        return (0, float(binName.split("-")[0].split("x")[0]), binName)
+    except ValueError:
+        return (1, 0.0, binName)
+
+
+def getPDFStats(record):
+    """Return dictionary with the values of one PDF (JSON record of its
+    output) that are aggregated into the batch statistics"""
+    properties = record.get("properties", {})
+    pdfStats = {"file": properties.get("filePath"),
+                "schema": os.path.basename(record.get("schema", "undefined")),
+                "validationOutcome": record.get("validationOutcome", "na"),
+                "validationSuccess": record.get("validationSuccess", "na"),
+                "noPages": None,
+                "JPEGQuality": collections.Counter(),
+                "ppi": collections.Counter(),
+                "ppiMin": None,
+                "ppiMax": None,
+                "failedAssertions": collections.Counter()}
+
+    try:
+        pdfStats["noPages"] = int(properties.get("noPages"))
+    except (TypeError, ValueError):
+        pass
+
+    for page in properties.get("pages", []):
+        for image in page.get("image", []):
+            stream = image.get("stream", {})
+            try:
+                pdfStats["JPEGQuality"][str(round(float(stream.get("JPEGQuality"))))] += 1
+            except (TypeError, ValueError):
+                pass
+            try:
+                ppiX = round(float(stream.get("ppi_x")))
+                ppiY = round(float(stream.get("ppi_y")))
+            except (TypeError, ValueError):
+                continue
+            if ppiX == ppiY:
+                pdfStats["ppi"][str(ppiX)] += 1
+            else:
+                pdfStats["ppi"][("{}x{}").format(ppiX, ppiY)] += 1
+            ppi = min(ppiX, ppiY)
+            if pdfStats["ppiMin"] is None or ppi < pdfStats["ppiMin"]:
+                pdfStats["ppiMin"] = ppi
+            if pdfStats["ppiMax"] is None or ppi > pdfStats["ppiMax"]:
+                pdfStats["ppiMax"] = ppi
+
+    for failedAssertion in record.get("failedAssertions", []):
+        text = failedAssertion["text"]
+        if text == "":
+            text = failedAssertion["test"]
+        pdfStats["failedAssertions"][text] += 1
+
+    return pdfStats
+
+
+def updateExtreme(values, name, value, fileName):
+    """Update minimum or maximum (name) in values, together with the file in
+    which it occurs. Ties go to the first file name in sort order, so the
+    result doesn't depend on the order in which PDFs are added"""
+    current = values[name]
+    if value is None:
+        return
+    if current is None or (value < current if name == "min" else value > current) or \
+            (value == current and fileName is not None and
+             (values[name + "File"] is None or fileName < values[name + "File"])):
+        values[name] = value
+        values[name + "File"] = fileName
+
+
+def addToHistogram(histogram, counts):
+    """Add counts to histogram, keeping the number of bins bounded"""
+    for binName, count in counts.items():
+        if binName not in histogram and len(histogram) >= maxBins:
+            binName = otherBin
+        histogram[binName] = histogram.get(binName, 0) + count
+
+
+class GroupStats:
+    """Statistics of a group of PDFs (all PDFs, or those of one schema)"""
+
+    def __init__(self, values=None):
+        self.values = {"noPDFs": 0,
+                       "validationOutcome": {},
+                       "validationSuccess": {},
+                       "noPages": {"total": 0, "min": None, "max": None, "histogram": {}},
+                       "JPEGQuality": {"noImages": 0, "sum": 0, "min": None, "max": None,
+                                       "histogram": {}},
+                       "ppi": {"noImages": 0, "min": None, "minFile": None,
+                               "max": None, "maxFile": None, "histogram": {}},
+                       "failedAssertions": {}}
+        if values is not None:
+            self.merge(values)
+
+    def add(self, pdfStats):
+        """Add values of one PDF"""
+        values = self.values
+        values["noPDFs"] += 1
+        addToHistogram(values["validationOutcome"], {pdfStats["validationOutcome"]: 1})
+        addToHistogram(values["validationSuccess"], {pdfStats["validationSuccess"]: 1})
+
+        noPages = pdfStats["noPages"]
+        if noPages is not None:
+            pages = values["noPages"]
+            pages["total"] += noPages
+            pages["min"] = noPages if pages["min"] is None else min(pages["min"], noPages)
+            pages["max"] = noPages if pages["max"] is None else max(pages["max"], noPages)
+            addToHistogram(pages["histogram"], {getPageBin(noPages): 1})
+
+        quality = values["JPEGQuality"]
+        for binName, count in pdfStats["JPEGQuality"].items():
+            q = int(binName)
+            quality["noImages"] += count
+            quality["sum"] += q * count
+            quality["min"] = q if quality["min"] is None else min(quality["min"], q)
+            quality["max"] = q if quality["max"] is None else max(quality["max"], q)
+        addToHistogram(quality["histogram"], pdfStats["JPEGQuality"])
+
+        ppi = values["ppi"]
+        ppi["noImages"] += sum(pdfStats["ppi"].values())
+        addToHistogram(ppi["histogram"], pdfStats["ppi"])
+        updateExtreme(ppi, "min", pdfStats["ppiMin"], pdfStats["file"])
+        updateExtreme(ppi, "max", pdfStats["ppiMax"], pdfStats["file"])
+
+        assertions = values["failedAssertions"]
+        for text, count in pdfStats["failedAssertions"].items():
+            if text not in assertions and len(assertions) >= maxBins:
+                text = otherBin
+            assertion = assertions.setdefault(text, {"occurrences": 0, "noPDFs": 0})
+            assertion["occurrences"] += count
+            assertion["noPDFs"] += 1
+
+    def merge(self, other):
+        """Merge values of other group (in the format of self.values)"""
+        values = self.values
+        values["noPDFs"] += other["noPDFs"]
+        for key in ("validationOutcome", "validationSuccess"):
+            addToHistogram(values[key], other[key])
+        for key in ("noPages", "JPEGQuality", "ppi"):
+            for name, value in other[key].items():
+                if name == "histogram":
+                    addToHistogram(values[key]["histogram"], value)
+                elif name in ("min", "max"):
+                    if key == "ppi":
+                        updateExtreme(values[key], name, value, other[key][name + "File"])
+                    elif value is not None and (values[key][name] is None or
+                                                (value < values[key][name] if name == "min"
+                                                 else value > values[key][name])):
+                        values[key][name] = value
+                elif name in ("total", "sum", "noImages"):
+                    values[key][name] += value
+        for text, assertion in other["failedAssertions"].items():
+            if text not in values["failedAssertions"] and len(values["failedAssertions"]) >= maxBins:
+                text = otherBin
+            merged = values["failedAssertions"].setdefault(text, {"occurrences": 0, "noPDFs": 0})
+            merged["occurrences"] += assertion["occurrences"]
+            merged["noPDFs"] += assertion["noPDFs"]
+
+    def toDict(self):
+        """Return values, with means added"""
+        values = json.loads(json.dumps(self.values))
+        for key in ("noPages", "JPEGQuality", "ppi"):
+            values[key]["histogram"] = dict(sorted(values[key]["histogram"].items(),
+                                                   key=lambda item: getBinKey(item[0])))
+        for key in ("validationOutcome", "validationSuccess", "failedAssertions"):
+            values[key] = dict(sorted(values[key].items()))
+        noPDFs = values["noPages"]["histogram"] and sum(values["noPages"]["histogram"].values())
+        values["noPages"]["mean"] = round(values["noPages"]["total"] / noPDFs, 2) if noPDFs else None
+        noImages = values["JPEGQuality"]["noImages"]
+        values["JPEGQuality"]["mean"] = round(values["JPEGQuality"]["sum"] / noImages, 2) if noImages else None
+        return values
+
+    def toRows(self, group):
+        """Return values as (group, statistic, key, value) rows"""
+        values = self.toDict()
+        rows = [[group, "noPDFs", "", values["noPDFs"]]]
+        for key in ("validationOutcome", "validationSuccess"):
+            for name, count in values[key].items():
+                rows.append([group, key, name, count])
+        for key in ("noPages", "JPEGQuality", "ppi"):
+            for name, value in values[key].items():
+                if name != "histogram":
+                    rows.append([group, key, name, "" if value is None else value])
+            for binName, count in values[key]["histogram"].items():
+                rows.append([group, key + "Histogram", binName, count])
+        for text, assertion in values["failedAssertions"].items():
+            rows.append([group, "failedAssertionOccurrences", text, assertion["occurrences"]])
+            rows.append([group, "failedAssertionPDFs", text, assertion["noPDFs"]])
+        return rows
+
+
+class BatchStats:
+    """Statistics of all PDFs of a batch, and of the PDFs of each schema"""
+
+    csvHeader = ["group", "statistic", "key", "value"]
+
+    def __init__(self):
+        self.all = GroupStats()
+        self.schemas = {}
+
+    @property
+    def noPDFs(self):
+        return self.all.values["noPDFs"]
+
+    def add(self, pdfStats):
+        """Add values of one PDF, as returned by getPDFStats"""
+        self.all.add(pdfStats)
+        self.schemas.setdefault(pdfStats["schema"], GroupStats()).add(pdfStats)
+
+    def merge(self, other):
+        """Merge statistics of other batch (e.g. another shard)"""
+        self.all.merge(other.all.values)
+        for schema, groupStats in other.schemas.items():
+            self.schemas.setdefault(schema, GroupStats()).merge(groupStats.values)
+
+    def toDict(self):
+        """Return statistics as dictionary"""
+        return {"all": self.all.toDict(),
+                "schemas": {schema: self.schemas[schema].toDict() for schema in sorted(self.schemas)}}
+
+    @classmethod
+    def read(cls, jsonFile):
+        """Return statistics from JSON file"""
+        with open(jsonFile, 'r', encoding='utf-8') as f:
+            values = json.load(f)
+        batchStats = cls()
+        batchStats.all = GroupStats(values["all"])
+        for schema, schemaValues in values["schemas"].items():
+            batchStats.schemas[schema] = GroupStats(schemaValues)
+        return batchStats
+
+    def write(self, jsonFile, csvFile):
+        """Write statistics to JSON and CSV file. Each file is replaced at
+        once, so it is always complete"""
+        with open(jsonFile + ".tmp", 'w', encoding='utf-8') as f:
+            json.dump(self.toDict(), f, indent=2)
+        os.replace(jsonFile + ".tmp", jsonFile)
+        with open(csvFile + ".tmp", 'w', newline='', encoding='utf-8') as f:
+            writer = csv.writer(f)
+            writer.writerow(self.csvHeader)
+            writer.writerows(self.all.toRows(allGroup))
+            for schema in sorted(self.schemas):
+                writer.writerows(self.schemas[schema].toRows(schema))
+        os.replace(csvFile + ".tmp", csvFile)
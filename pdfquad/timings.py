@@ -0,0 +1,156 @@
+#! /usr/bin/env python3
+
+"""PDF Quality Assessment for Digitisation batches
+
+Johan van der Knijff
+
+Copyright 2024, KB/National Library of the Netherlands
+
+Module for recording wall clock and CPU time of processing stages, peak
+memory use and the number of PDF objects of each type
+
+"""
+
+import time
+import contextlib
+from lxml import etree
+from . import memory
+
+# Processing stages, in the order in which they are reported
+stages = ["checksum",
+          "open",
+          "xrefScan",
+          "imageRead",
+          "imageStream",
+          "jpegQuality",
+          "iccProfile",
+          "watermarkScan",
+          "validation"]
+
+
+class Timer:
+    """Record wall clock and CPU time for each processing stage of one
+    PDF, the time of each page, the total time, the peak memory use and
+    the number of objects of each type"""
+
+    def __init__(self):
+        memory.resetPeakRSS()
+        self.peakRSS = None
+        self.wall = dict.fromkeys(stages, 0.0)
+        self.cpu = dict.fromkeys(stages, 0.0)
+        self.pages = []
+        self.wallStart = time.perf_counter()
+        self.cpuStart = time.process_time()
+        self.wallTotal = 0.0
+        self.cpuTotal = 0.0
+        self.objectTypes = None
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        """Context manager that adds time spent inside it to stage name"""
+        wallStart = time.perf_counter()
+        cpuStart = time.process_time()
+        try:
+            yield
+        finally:
+            self.wall[name] += time.perf_counter() - wallStart
+            self.cpu[name] += time.process_time() - cpuStart
+
+    @contextlib.contextmanager
+    def page(self, pageNo):
+        """Context manager that records time spent inside it for page pageNo"""
+        wallStart = time.perf_counter()
+        cpuStart = time.process_time()
+        try:
+            yield
+        finally:
+            self.pages.append([pageNo,
+                               time.perf_counter() - wallStart,
+                               time.process_time() - cpuStart])
+
+    def setObjectTypes(self, objectTypes):
+        """Record number of objects for each Type value, as counted by the
+        xrefScan stage"""
+        self.objectTypes = objectTypes
+
+    def stop(self):
+        """Stop clock for total time"""
+        self.wallTotal = time.perf_counter() - self.wallStart
+        self.cpuTotal = time.process_time() - self.cpuStart
+        self.peakRSS = memory.getPeakRSS()
+
+    def toElt(self):
+        """Return recorded times as Element object"""
+        timingsElt = etree.Element("timings")
+        for name in stages:
+            stageElt = etree.SubElement(timingsElt, "stage")
+            stageElt.attrib["name"] = name
+            stageElt.attrib["wall"] = formatTime(self.wall[name])
+            stageElt.attrib["cpu"] = formatTime(self.cpu[name])
+        totalElt = etree.SubElement(timingsElt, "total")
+        totalElt.attrib["wall"] = formatTime(self.wallTotal)
+        totalElt.attrib["cpu"] = formatTime(self.cpuTotal)
+        memoryElt = etree.SubElement(timingsElt, "memory")
+        memoryElt.attrib["peakRSS"] = formatBytes(self.peakRSS)
+        if self.objectTypes is not None:
+            objectTypesElt = etree.SubElement(timingsElt, "objectTypes")
+            for type in sorted(self.objectTypes):
+                objectTypeElt = etree.SubElement(objectTypesElt, "objectType")
+                objectTypeElt.attrib["type"] = type
+                objectTypeElt.text = str(self.objectTypes[type])
+        pagesElt = etree.SubElement(timingsElt, "pages")
+        for pageNo, wall, cpu in self.pages:
+            pageElt = etree.SubElement(pagesElt, "page")
+            pageElt.attrib["number"] = str(pageNo)
+            pageElt.attrib["wall"] = formatTime(wall)
+            pageElt.attrib["cpu"] = formatTime(cpu)
+        return timingsElt
+
+    def toRow(self):
+        """Return recorded times as list of values for the timings file"""
+        row = []
+        for name in stages:
+            row.append(formatTime(self.wall[name]))
+            row.append(formatTime(self.cpu[name]))
+        row.append(formatTime(self.wallTotal))
+        row.append(formatTime(self.cpuTotal))
+        row.append(len(self.pages))
+        row.append(formatBytes(self.peakRSS))
+        return row
+
+
+class NullTimer:
+    """Timer that doesn't record anything, used if timings are disabled"""
+
+    nullContext = contextlib.nullcontext()
+
+    def stage(self, name):
+        return self.nullContext
+
+    def page(self, pageNo):
+        return self.nullContext
+
+    def setObjectTypes(self, objectTypes):
+        pass
+
+
+def formatTime(seconds):
+    """Return time in seconds as string"""
+    return "{:.6f}".format(seconds)
+
+
+def formatBytes(noBytes):
+    """Return number of bytes as string, or "na" if not available"""
+    if noBytes is None:
+        return "na"
+    return str(noBytes)
+
+
+def getHeader():
+    """Return header row of timings file"""
+    header = ["file"]
+    for name in stages:
+        header.append(name + "_wall")
+        header.append(name + "_cpu")
+    header += ["total_wall", "total_cpu", "noPages", "peakRSS"]
+    return header
@@ -0,0 +1,282 @@
+#! /usr/bin/env python3
+
+"""PDF Quality Assessment for Digitisation batches
+
+Johan van der Knijff
+
+Copyright 2024, KB/National Library of the Netherlands
+
+Module for detecting marked-content watermarks in page content streams and
+the form XObjects they invoke. These are marked-content sequences (BDC) or
+points (DP) with a property list that has a Subtype Watermark entry. The
+content streams are only read, so unlike page.clean_contents() this doesn't
+modify the document
+
+"""
+
+import re
+
+# Tokens of content streams. Strings are handled separately, as they can
+# contain nested parentheses
+reToken = re.compile(rb"""[\x00\t\n\x0c\r ]+|%[^\r\n]*
+                          |(?P<dictOpen><<)|(?P<dictClose>>>)
+                          |(?P<hexString><[^>]*>?)
+                          |(?P<string>\()
+                          |(?P<name>/[^\x00\t\n\x0c\r ()<>\[\]{}/%]*)
+                          |(?P<arrayOpen>\[)|(?P<arrayClose>\])
+                          |(?P<regular>[^\x00\t\n\x0c\r ()<>\[\]{}/%]+)
+                          |(?P<other>.)""", re.VERBOSE | re.DOTALL)
+reStringChars = re.compile(rb"[()\\]")
+reNameEscape = re.compile(rb"#([0-9a-fA-F]{2})")
+# End of inline image data
+reInlineImageEnd = re.compile(rb"[\x00\t\n\x0c\r ]EI(?=[\x00\t\n\x0c\r ()<>\[\]{}/%]|$)")
+# Indirect references in a dictionary
+reReference = re.compile(r"/([^\s/<>\[\]()]+)\s*([0-9]+)\s+[0-9]+\s+R")
+reNumber = re.compile(rb"^[+-]?([0-9]+\.?[0-9]*|\.[0-9]+)$")
+
+# Marker of watermark property lists. Any content stream that contains a
+# watermark property list must contain this, or a name with # escapes
+watermarkMarker = b"Watermark"
+
+
+def decodeName(token):
+    """Return name token without slash, and with # escapes decoded"""
+    return reNameEscape.sub(lambda match: bytes([int(match.group(1), 16)]), token[1:])
+
+
+def skipString(data, position):
+    """Return position directly after literal string that starts at position"""
+    depth = 0
+    while True:
+        match = reStringChars.search(data, position)
+        if match is None:
+            return len(data)
+        char = match.group()
+        position = match.end()
+        if char == b"\\":
+            position += 1
+        elif char == b"(":
+            depth += 1
+        else:
+            depth -= 1
+            if depth == 0:
+                return position
+
+
+class ContentParser:
+    """Minimal parser for content streams, which calls handler with the
+    operator and operands of each BDC, DP and Do operator. Names are bytes
+    objects, dictionaries are dicts, and all other operands are None. A page's
+    content streams are fed to the parser one at a time, as they only
+    split at token boundaries"""
+
+    def __init__(self, handler):
+        self.handler = handler
+        self.operands = []
+        # Open dictionaries and arrays
+        self.containers = []
+        # Key in each open dictionary that awaits its value
+        self.keys = []
+
+    def addValue(self, value):
+        """Add value to innermost open dictionary or array, or to operands"""
+        if len(self.containers) == 0:
+            self.operands.append(value)
+            return
+        container = self.containers[-1]
+        if isinstance(container, list):
+            container.append(value)
+        elif self.keys[-1] is None:
+            self.keys[-1] = value
+        else:
+            container[self.keys[-1]] = value
+            self.keys[-1] = None
+
+    def feed(self, data):
+        """Parse one content stream"""
+        position = 0
+        end = len(data)
+        while position < end:
+            match = reToken.match(data, position)
+            position = match.end()
+            kind = match.lastgroup
+            if kind is None:
+                continue
+            elif kind == "name":
+                self.addValue(decodeName(match.group()))
+            elif kind == "string":
+                position = skipString(data, match.start())
+                self.addValue(None)
+            elif kind == "dictOpen" or kind == "arrayOpen":
+                self.containers.append({} if kind == "dictOpen" else [])
+                self.keys.append(None)
+            elif kind == "dictClose" or kind == "arrayClose":
+                if len(self.containers) != 0:
+                    self.keys.pop()
+                    self.addValue(self.containers.pop())
+            elif kind == "regular":
+                token = match.group()
+                if len(self.containers) != 0 or reNumber.match(token) or \
+                   token in (b"true", b"false", b"null"):
+                    self.addValue(None)
+                    continue
+                if token in (b"BDC", b"DP") and len(self.operands) >= 2:
+                    self.handler(token, self.operands[-2:])
+                elif token == b"Do" and len(self.operands) >= 1:
+                    self.handler(token, self.operands[-1:])
+                elif token == b"ID":
+                    # Skip binary data of inline image
+                    match = reInlineImageEnd.search(data, position)
+                    position = end if match is None else match.end()
+                self.operands = []
+            else:
+                self.addValue(None)
+
+
+class WatermarkScanner:
+    """Detect watermarks in the pages of one document. Results for form
+    XObjects are cached, as these are often shared by many pages"""
+
+    def __init__(self, doc):
+        self.doc = doc
+        # Result for each form XObject, by (xref of form, xref of the object
+        # whose resources it uses)
+        self.formResults = {}
+        # Flag for each XObject that indicates whether it is a form XObject
+        self.formFlags = {}
+        # Flag for each form XObject that indicates whether it has resources
+        self.formResourcesFlags = {}
+
+    def getResourcesOwner(self, xref):
+        """Return xref of object that holds the resources of page xref,
+        which may be inherited from an ancestor in the page tree"""
+        visited = set()
+        while xref not in visited:
+            visited.add(xref)
+            if self.doc.xref_get_key(xref, "Resources")[0] != "null":
+                return xref
+            parentType, parent = self.doc.xref_get_key(xref, "Parent")
+            if parentType != "xref":
+                break
+            xref = int(parent.split()[0])
+        return None
+
+    def getDictSource(self, xref, path):
+        """Return source of dictionary at path of object xref, or an empty
+        string if there is no dictionary at path"""
+        valueType, value = self.doc.xref_get_key(xref, path)
+        if valueType == "xref":
+            return self.doc.xref_object(int(value.split()[0]), compressed=True)
+        elif valueType == "dict":
+            return value
+        return ""
+
+    def getReferences(self, xref, path):
+        """Return dictionary with name and xref of all indirect references
+        in dictionary at path of object xref"""
+        source = self.getDictSource(xref, path)
+        return {name: int(refXref) for name, refXref in reReference.findall(source)}
+
+    def getForms(self, ownerXref):
+        """Return dictionary with name (as bytes) and xref of all form
+        XObjects in the resources of object ownerXref"""
+        if ownerXref is None:
+            return {}
+        forms = {}
+        for name, xref in self.getReferences(ownerXref, "Resources/XObject").items():
+            if xref not in self.formFlags:
+                self.formFlags[xref] = self.doc.xref_get_key(xref, "Subtype") == ("name", "/Form")
+            if self.formFlags[xref]:
+                forms[name.encode("latin-1")] = xref
+        return forms
+
+    def isWatermarkProperty(self, ownerXref, name):
+        """Return True if named property list in the resources of object
+        ownerXref has Subtype Watermark"""
+        if ownerXref is None:
+            return False
+        path = ("Resources/Properties/{}/Subtype").format(name.decode("latin-1"))
+        return self.doc.xref_get_key(ownerXref, path) == ("name", "/Watermark")
+
+    def hasWatermarkProperties(self, ownerXref):
+        """Return True if any named property list in the resources of object
+        ownerXref has Subtype Watermark"""
+        if ownerXref is None:
+            return False
+        # Property lists can be direct objects, or indirect references
+        if "/Watermark" in self.getDictSource(ownerXref, "Resources/Properties"):
+            return True
+        for name in self.getReferences(ownerXref, "Resources/Properties"):
+            if self.isWatermarkProperty(ownerXref, name.encode("latin-1")):
+                return True
+        return False
+
+    def scanStreams(self, xrefs, ownerXref, visited):
+        """Return True if content streams xrefs, or any form XObject they
+        invoke with the Do operator, contain a watermark. Each stream is read
+        once, and only parsed if a quick search shows it could contain a
+        watermark or invoke a form XObject"""
+        streams = [data for data in (self.doc.xref_stream(xref) for xref in xrefs)
+                   if data is not None]
+        namedFlag = self.hasWatermarkProperties(ownerXref)
+        forms = self.getForms(ownerXref)
+        candidate = False
+        for data in streams:
+            if watermarkMarker in data or b"#" in data or \
+               (namedFlag and (b"BDC" in data or b"DP" in data)) or \
+               (len(forms) != 0 and b"Do" in data):
+                candidate = True
+                break
+        if not candidate:
+            return False
+
+        found = []
+        invoked = []
+
+        def handler(operator, operands):
+            properties = operands[-1]
+            if operator == b"Do":
+                if isinstance(properties, bytes) and properties in forms and \
+                   properties not in invoked:
+                    invoked.append(properties)
+            elif isinstance(properties, dict):
+                if properties.get(b"Subtype") == watermarkMarker:
+                    found.append(operator)
+            elif isinstance(properties, bytes):
+                if self.isWatermarkProperty(ownerXref, properties):
+                    found.append(operator)
+
+        parser = ContentParser(handler)
+        for data in streams:
+            parser.feed(data)
+            if len(found) != 0:
+                return True
+
+        for name in invoked:
+            xref = forms[name]
+            if xref in visited:
+                continue
+            visited.add(xref)
+            # A form without resources can have a different result for
+            # each object that invokes it
+            formOwnerXref = self.getFormResourcesOwner(xref, ownerXref)
+            key = (xref, formOwnerXref)
+            if key not in self.formResults:
+                self.formResults[key] = self.scanStreams([xref], formOwnerXref, visited)
+            if self.formResults[key]:
+                return True
+        return False
+
+    def getFormResourcesOwner(self, xref, ownerXref):
+        """Return xref of object that holds the resources of form XObject
+        xref. Forms without resources use those of object ownerXref"""
+        if xref not in self.formResourcesFlags:
+            self.formResourcesFlags[xref] = self.doc.xref_get_key(xref, "Resources")[0] != "null"
+        if self.formResourcesFlags[xref]:
+            return xref
+        return ownerXref
+
+    def hasWatermark(self, page):
+        """Return True if page contains a marked-content watermark"""
+        ownerXref = self.getResourcesOwner(page.xref)
+        return self.scanStreams(page.get_contents(), ownerXref, set())
@@ -0,0 +1,453 @@
+#! /usr/bin/env python3
+
+"""PDF Quality Assessment for Digitisation batches
+
+Johan van der Knijff
+
+Copyright 2024, KB/National Library of the Netherlands
+
+Module with writers for batch output. The writers keep their output files
+open while a batch is processed, and flush them at a fixed time interval.
+The output of each PDF is written as XML, JSON Lines or SQLite
+
+"""
+
+import os
+import csv
+import json
+import time
+import sqlite3
+from lxml import etree
+from . import stats
+
+# Size of write buffers (bytes)
+bufferSize = 1048576
+
+
+def getOutFileName(prefixBatch, outDir, outFileCount, extension="xml"):
+    """Return name of output file with number outFileCount"""
+    fileOut = ("{}_{}.{}").format(prefixBatch, str(outFileCount).zfill(3), extension)
+    return os.path.join(outDir, fileOut)
+
+
+class XMLWriter:
+    """Write serialized file elements to XML output files, using a new
+    output file after every maxPDFs elements"""
+
+    extension = "xml"
+    head = "<?xml version='1.0' encoding='UTF-8'?>\n<pdfquad>\n"
+    foot = "</pdfquad>\n"
+
+    def __init__(self, prefixBatch, outDir, maxPDFs, flushInterval, resumeState=None):
+        self.prefixBatch = prefixBatch
+        self.outDir = outDir
+        self.maxPDFs = maxPDFs
+        self.flushInterval = flushInterval
+        self.lastFlush = time.time()
+        self.outFileCount = 0
+        self.pdfCount = 0
+        self.fileOut = None
+        self.f = None
+        if resumeState is None:
+            self.openOutFile()
+        else:
+            # Continue writing to existing (unterminated) output file
+            self.outFileCount, self.pdfCount = resumeState
+            self.fileOut = self.getFileName(prefixBatch, outDir, self.outFileCount)
+            self.f = open(self.fileOut, "ab", buffering=bufferSize)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, excType, excValue, traceback):
+        self.close()
+
+    @classmethod
+    def getFileName(cls, prefixBatch, outDir, outFileCount):
+        """Return name of output file with number outFileCount"""
+        return getOutFileName(prefixBatch, outDir, outFileCount, cls.extension)
+
+    @classmethod
+    def isWellFormed(cls, data):
+        """Return True if data (an unterminated output file) are well-formed"""
+        try:
+            etree.fromstring(data + cls.foot.encode('utf-8'))
+        except etree.XMLSyntaxError:
+            return False
+        return True
+
+    def openOutFile(self):
+        """Close current output file (if any) and open the next one"""
+        self.closeOutFile()
+        self.outFileCount += 1
+        self.pdfCount = 0
+        self.fileOut = self.getFileName(self.prefixBatch, self.outDir, self.outFileCount)
+        self.f = open(self.fileOut, "wb", buffering=bufferSize)
+        self.f.write(self.head.encode('utf-8'))
+
+    def closeOutFile(self):
+        """Write footer to current output file and close it"""
+        if self.f is not None:
+            self.f.write(self.foot.encode('utf-8'))
+            self.f.close()
+            self.f = None
+
+    def nextFileOut(self):
+        """Return name of the output file that the next element will be
+        written to"""
+        if self.pdfCount >= self.maxPDFs:
+            self.openOutFile()
+        return self.fileOut
+
+    def write(self, output):
+        """Write serialized element to output, and return name of the
+        output file it was written to"""
+        fileOut = self.nextFileOut()
+        self.f.write(output)
+        self.pdfCount += 1
+        if time.time() - self.lastFlush >= self.flushInterval:
+            self.flush()
+        return fileOut
+
+    def tell(self):
+        """Return current position in output file"""
+        return self.f.tell()
+
+    def flush(self):
+        """Flush write buffer"""
+        if self.f is not None:
+            self.f.flush()
+        self.lastFlush = time.time()
+
+    def sync(self):
+        """Flush write buffer and force write to disk"""
+        if self.f is not None:
+            self.flush()
+            os.fsync(self.f.fileno())
+
+    def close(self):
+        """Close output, which ensures the current output file
+        is always terminated by a closing pdfquad tag"""
+        self.closeOutFile()
+
+
+class JSONLWriter(XMLWriter):
+    """Write JSON records to JSON Lines output files (one record per line),
+    using a new output file after every maxPDFs records"""
+
+    extension = "jsonl"
+    head = ""
+    foot = ""
+
+    @classmethod
+    def isWellFormed(cls, data):
+        """Return True if each line of data is a JSON record"""
+        try:
+            for line in data.splitlines():
+                json.loads(line)
+        except ValueError:
+            return False
+        return True
+
+
+class SQLiteWriter:
+    """Write JSON records to an SQLite database, with tables for the files,
+    their document-level properties, pages, images, image properties and
+    failed assertions. Values are stored with numeric affinity, so numbers
+    can be compared as numbers. Records are committed when the output is
+    synced, and the position of a record is its row id in the files table"""
+
+    extension = "sqlite"
+    schema = """CREATE TABLE IF NOT EXISTS files (id INTEGER PRIMARY KEY,
+                                                  filePath TEXT,
+                                                  fileSize NUMERIC,
+                                                  noPages NUMERIC,
+                                                  schema TEXT,
+                                                  validationSuccess TEXT,
+                                                  validationOutcome TEXT,
+                                                  record TEXT);
+                CREATE TABLE IF NOT EXISTS properties (fileId INTEGER,
+                                                       name TEXT,
+                                                       value NUMERIC);
+                CREATE TABLE IF NOT EXISTS pages (fileId INTEGER,
+                                                  pageNo INTEGER,
+                                                  noImages INTEGER,
+                                                  annotations TEXT);
+                CREATE TABLE IF NOT EXISTS images (id INTEGER PRIMARY KEY,
+                                                   fileId INTEGER,
+                                                   pageNo INTEGER,
+                                                   imageNo INTEGER);
+                CREATE TABLE IF NOT EXISTS imageProperties (imageId INTEGER,
+                                                            source TEXT,
+                                                            name TEXT,
+                                                            value NUMERIC);
+                CREATE TABLE IF NOT EXISTS failedAssertions (fileId INTEGER,
+                                                             test TEXT,
+                                                             location TEXT,
+                                                             text TEXT);
+                CREATE INDEX IF NOT EXISTS filesPath ON files (filePath);
+                CREATE INDEX IF NOT EXISTS filesOutcome ON files (validationOutcome);
+                CREATE INDEX IF NOT EXISTS propertiesFile ON properties (fileId);
+                CREATE INDEX IF NOT EXISTS propertiesValue ON properties (name, value);
+                CREATE INDEX IF NOT EXISTS pagesFile ON pages (fileId, pageNo);
+                CREATE INDEX IF NOT EXISTS imagesFile ON images (fileId, pageNo);
+                CREATE INDEX IF NOT EXISTS imagePropertiesImage ON imageProperties (imageId);
+                CREATE INDEX IF NOT EXISTS imagePropertiesValue ON imageProperties (name, value);
+                CREATE INDEX IF NOT EXISTS failedAssertionsFile ON failedAssertions (fileId);
+                CREATE INDEX IF NOT EXISTS failedAssertionsText ON failedAssertions (text);"""
+
+    def __init__(self, prefixBatch, outDir, maxPDFs, flushInterval, resumeState=None):
+        self.fileOut = self.getFileName(prefixBatch, outDir)
+        self.flushInterval = flushInterval
+        self.lastFlush = time.time()
+        self.lastId = 0
+        if resumeState is None:
+            # Also remove any rollback journal, which would otherwise be
+            # applied to the new database
+            for fName in (self.fileOut, self.fileOut + "-journal"):
+                if os.path.isfile(fName):
+                    os.remove(fName)
+        self.connection = sqlite3.connect(self.fileOut)
+        self.connection.executescript(self.schema)
+        self.connection.commit()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, excType, excValue, traceback):
+        self.close()
+
+    @classmethod
+    def getFileName(cls, prefixBatch, outDir, outFileCount=None):
+        """Return name of database file"""
+        return os.path.join(outDir, ("{}.{}").format(prefixBatch, cls.extension))
+
+    @staticmethod
+    def iterProperties(properties):
+        """Yield name and value of each document-level property"""
+        for key, value in properties.items():
+            if key == "pages":
+                continue
+            if isinstance(value, dict):
+                for subKey, subValue in value.items():
+                    yield key if subKey == "value" else key + "/" + subKey, subValue
+            elif isinstance(value, list):
+                for item in value:
+                    yield key, item
+            else:
+                yield key, value
+
+    @staticmethod
+    def iterImageProperties(image):
+        """Yield source (dict or stream), name and value of each image property"""
+        for source in ("dict", "stream"):
+            for name, value in image.get(source, {}).items():
+                if isinstance(value, list):
+                    for item in value:
+                        yield source, name, item
+                else:
+                    yield source, name, value
+
+    def write(self, output):
+        """Write JSON record (serialized) to database, and return name of
+        the database file"""
+        record = json.loads(output)
+        properties = record.get("properties", {})
+        cursor = self.connection.execute("""INSERT INTO files VALUES (NULL, ?, ?, ?, ?, ?, ?, ?)""",
+                                         (properties.get("filePath"), properties.get("fileSize"),
+                                          properties.get("noPages"), record.get("schema"),
+                                          record.get("validationSuccess"),
+                                          record.get("validationOutcome"),
+                                          output.decode('utf-8').rstrip("\n")))
+        fileId = cursor.lastrowid
+        self.connection.executemany("""INSERT INTO properties VALUES (?, ?, ?)""",
+                                    [(fileId, name, value) for name, value in
+                                     self.iterProperties(properties)])
+        for page in properties.get("pages", []):
+            pageNo = page.get("number")
+            images = page.get("image", [])
+            annotations = page.get("annotations")
+            self.connection.execute("""INSERT INTO pages VALUES (?, ?, ?, ?)""",
+                                    (fileId, pageNo, len(images),
+                                     None if annotations is None else " ".join(annotations)))
+            for imageNo, image in enumerate(images, start=1):
+                cursor = self.connection.execute("""INSERT INTO images VALUES (NULL, ?, ?, ?)""",
+                                                 (fileId, pageNo, imageNo))
+                imageId = cursor.lastrowid
+                self.connection.executemany("""INSERT INTO imageProperties VALUES (?, ?, ?, ?)""",
+                                            [(imageId, source, name, value) for source, name, value in
+                                             self.iterImageProperties(image)])
+        self.connection.executemany("""INSERT INTO failedAssertions VALUES (?, ?, ?, ?)""",
+                                    [(fileId, failedAssertion["test"], failedAssertion["location"],
+                                      failedAssertion["text"]) for failedAssertion in
+                                     record.get("failedAssertions", [])])
+        self.lastId = fileId
+        if time.time() - self.lastFlush >= self.flushInterval:
+            self.flush()
+        return self.fileOut
+
+    def tell(self):
+        """Return row id of last record"""
+        return self.lastId
+
+    def flush(self):
+        """Commit records"""
+        self.connection.commit()
+        self.lastFlush = time.time()
+
+    def sync(self):
+        """Commit records, which writes them to disk"""
+        self.flush()
+
+    def close(self):
+        """Commit records and close database"""
+        self.connection.commit()
+        self.connection.close()
+
+    @classmethod
+    def repair(cls, prefixBatch, outDir, lastId):
+        """Remove all records after row id lastId"""
+        connection = sqlite3.connect(cls.getFileName(prefixBatch, outDir))
+        connection.execute("""DELETE FROM imageProperties WHERE imageId IN
+                              (SELECT id FROM images WHERE fileId > ?)""", (lastId,))
+        for table in ("properties", "pages", "images", "failedAssertions"):
+            connection.execute(("DELETE FROM {} WHERE fileId > ?").format(table), (lastId,))
+        connection.execute("""DELETE FROM files WHERE id > ?""", (lastId,))
+        connection.commit()
+        connection.close()
+
+
+# Writer for each output format
+outputWriters = {"xml": XMLWriter,
+                 "jsonl": JSONLWriter,
+                 "sqlite": SQLiteWriter}
+
+
+class CSVWriter:
+    """Write rows to comma-delimited text file. If resumeFiles is not None,
+    only rows of an existing file whose first column is in resumeFiles are
+    kept, and new rows are appended to these"""
+
+    def __init__(self, fileOut, header, flushInterval, resumeFiles=None):
+        self.fileOut = fileOut
+        self.flushInterval = flushInterval
+        self.lastFlush = time.time()
+        rows = [header]
+        if resumeFiles is not None and os.path.isfile(fileOut):
+            with open(fileOut, 'r', newline='', encoding='utf-8') as f:
+                for row in csv.reader(f):
+                    if len(row) == len(header) and row[0] in resumeFiles:
+                        rows.append(row)
+        self.f = open(fileOut, 'w', newline='', encoding='utf-8', buffering=bufferSize)
+        self.writer = csv.writer(self.f)
+        self.writer.writerows(rows)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, excType, excValue, traceback):
+        self.close()
+
+    def write(self, row):
+        """Write one row"""
+        self.writer.writerow(row)
+        if time.time() - self.lastFlush >= self.flushInterval:
+            self.flush()
+
+    def flush(self):
+        """Flush write buffer"""
+        self.f.flush()
+        self.lastFlush = time.time()
+
+    def sync(self):
+        """Flush write buffer and force write to disk"""
+        self.flush()
+        os.fsync(self.f.fileno())
+
+    def close(self):
+        """Close file"""
+        if not self.f.closed:
+            self.f.close()
+
+
+class StatsWriter:
+    """Aggregate batch statistics, and write them to a JSON and a CSV file
+    each time the outputs are synced, so the statistics always cover the
+    PDFs in the journal. If batchStats is not None, the statistics of a
+    previous (interrupted) run are continued"""
+
+    def __init__(self, jsonFile, csvFile, batchStats=None):
+        self.jsonFile = jsonFile
+        self.csvFile = csvFile
+        self.batchStats = stats.BatchStats() if batchStats is None else batchStats
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, excType, excValue, traceback):
+        self.close()
+
+    def write(self, pdfStats):
+        """Add statistics of one PDF"""
+        self.batchStats.add(pdfStats)
+
+    def sync(self):
+        """Write current statistics to disk. The previous statistics are kept
+        in a separate file until the run is finished, as a crash may happen
+        before the journal entries of the latest PDFs are written"""
+        if os.path.isfile(self.jsonFile):
+            os.replace(self.jsonFile, self.jsonFile + ".prev")
+        self.batchStats.write(self.jsonFile, self.csvFile)
+
+    def close(self):
+        """Write final statistics"""
+        self.sync()
+        if os.path.isfile(self.jsonFile + ".prev"):
+            os.remove(self.jsonFile + ".prev")
+
+
+class JournalWriter:
+    """Append-only journal of completed PDFs, with for each PDF the XML
+    output file and the position in that file directly after its output.
+    Entries are only written after all other outputs are written to disk,
+    so the journal never refers to output that could be lost in a crash"""
+
+    def __init__(self, journalFile, outputs, flushInterval, resumeFlag=False):
+        self.journalFile = journalFile
+        self.outputs = outputs
+        self.flushInterval = flushInterval
+        self.lastFlush = time.time()
+        self.pending = []
+        if resumeFlag and os.path.isfile(journalFile):
+            self.f = open(journalFile, 'a', newline='', encoding='utf-8')
+        else:
+            self.f = open(journalFile, 'w', newline='', encoding='utf-8')
+        self.writer = csv.writer(self.f)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, excType, excValue, traceback):
+        self.close()
+
+    def write(self, PDF, fileOut, offset):
+        """Add entry for PDF"""
+        self.pending.append([PDF, fileOut, offset])
+        if time.time() - self.lastFlush >= self.flushInterval:
+            self.flush()
+
+    def flush(self):
+        """Write all outputs to disk, and then write pending entries"""
+        for output in self.outputs:
+            output.sync()
+        self.writer.writerows(self.pending)
+        self.pending = []
+        self.f.flush()
+        os.fsync(self.f.fileno())
+        self.lastFlush = time.time()
+
+    def close(self):
+        """Write pending entries and close journal"""
+        if not self.f.closed:
+            self.flush()
+            self.f.close()
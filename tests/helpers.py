@@ -0,0 +1,156 @@
+#! /usr/bin/env python3
+
+"""PDF Quality Assessment for Digitisation batches
+
+Johan van der Knijff
+
+Copyright 2024, KB/National Library of the Netherlands
+
+Helper functions for the tests, which create small synthetic PDFs and
+run pdfquad
+
+"""
+
+import io
+import os
+import sys
+import sqlite3
+import subprocess
+import pymupdf
+from PIL import Image
+from PIL import ImageCms
+from pdfquad import schematron
+
+packageDir = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "pdfquad")
+
+# Valid ICC profile
+sRGBProfile = ImageCms.ImageCmsProfile(ImageCms.createProfile("sRGB")).tobytes()
+
+
+def readSchemas(profile="dbnl-fulltext.xml"):
+    """Return schemas of profile included with pdfquad"""
+    return schematron.readProfile(os.path.join(packageDir, "profiles", profile),
+                                  os.path.join(packageDir, "schemas"))
+
+
+def makeJPEG(width=300, height=400, quality=85, iccProfile=sRGBProfile, seed=0):
+    """Return JPEG image with synthetic content as bytes"""
+    gradient = Image.linear_gradient("L").resize((width, height))
+    noise = Image.effect_noise((width, height), 40 + seed % 20)
+    im = Image.merge("RGB", (gradient, noise, gradient.rotate(90)))
+    out = io.BytesIO()
+    options = {"quality": quality, "dpi": (300, 300)}
+    if iccProfile is not None:
+        options["icc_profile"] = iccProfile
+    im.save(out, "JPEG", **options)
+    return out.getvalue()
+
+
+def makePDF(fileOut, noPages=1, **jpegOptions):
+    """Create PDF with one JPEG image on each page, at 300 ppi"""
+    os.makedirs(os.path.dirname(fileOut), exist_ok=True)
+    doc = pymupdf.open()
+    for i in range(noPages):
+        jpeg = makeJPEG(seed=i, **jpegOptions)
+        im = Image.open(io.BytesIO(jpeg))
+        page = doc.new_page(width=im.width*72/300, height=im.height*72/300)
+        page.insert_image(page.rect, stream=jpeg)
+    doc.save(fileOut)
+    doc.close()
+    return fileOut
+
+
+def makeBatch(batchDir, noPDFs=10):
+    """Create batch with PDFs of varying sizes in the directories of the
+    dbnl-fulltext profile, some of which fail validation"""
+    PDFs = []
+    for i in range(noPDFs):
+        pdfDir = os.path.join(batchDir, "doc{}".format(i % 3), "300dpi-{}".format([85, 50][i % 2]))
+        PDFs.append(makePDF(os.path.join(pdfDir, "doc{}.pdf".format(i)),
+                            noPages=1 + i % 3, quality=[85, 50, 30][i % 3]))
+    return PDFs
+
+
+def runPdfquad(args, configDir, killAfter=None):
+    """Run pdfquad with command line arguments args, using configuration
+    directory configDir. If killAfter is not None, the run is killed
+    (SIGKILL) once the journal has killAfter entries, directly after all
+    other outputs of the next PDF were written to disk"""
+    env = dict(os.environ, XDG_CONFIG_HOME=configDir,
+               PYTHONPATH=os.path.dirname(packageDir))
+    env.pop("LOCALAPPDATA", None)
+    if killAfter is None:
+        command = [sys.executable, "-m", "pdfquad"] + args
+    else:
+        command = [sys.executable, "-c", killScript, str(killAfter)] + args
+    return subprocess.run(command, env=env, capture_output=True)
+
+
+def getPeakRSS(PDF, streamFlag=True):
+    """Return peak memory use (bytes) of a new Python process that processes
+    PDF with the dbnl-fulltext profile, or None if it is not available"""
+    env = dict(os.environ, PYTHONPATH=os.path.dirname(packageDir))
+    command = [sys.executable, "-c", peakRSSScript, PDF, str(streamFlag)]
+    output = subprocess.run(command, env=env, capture_output=True, check=True).stdout
+    peakRSS = output.decode().strip()
+    return None if peakRSS == "None" else int(peakRSS)
+
+
+# Script that processes the PDF in its first argument, and prints the
+# peak memory use
+peakRSSScript = """
+import os
+import sys
+from pdfquad import pdfquad
+from pdfquad import memory
+from pdfquad import schematron
+
+packageDir = os.path.dirname(pdfquad.__file__)
+schemas = schematron.readProfile(os.path.join(packageDir, "profiles", "dbnl-fulltext.xml"),
+                                 os.path.join(packageDir, "schemas"))
+pdfquad.processPDF(sys.argv[1], False, False, schemas, streamFlag=sys.argv[2] == "True")
+print(memory.getPeakRSS())
+"""
+
+
+# Script that runs pdfquad, and kills it once the journal has the number of
+# entries in its first argument
+killScript = """
+import os
+import sys
+import signal
+from pdfquad import pdfquad
+from pdfquad import writers
+
+killAfter = int(sys.argv.pop(1))
+flush = writers.JournalWriter.flush
+
+def killingFlush(self):
+    self.noWritten = getattr(self, "noWritten", 0)
+    if self.noWritten + len(self.pending) > killAfter:
+        for output in self.outputs:
+            output.sync()
+        os.kill(os.getpid(), signal.SIGKILL)
+    self.noWritten += len(self.pending)
+    flush(self)
+
+writers.JournalWriter.flush = killingFlush
+pdfquad.main()
+"""
+
+
+def readOutputs(outDir):
+    """Return dictionary with name and contents of all files in outDir, with
+    any occurrences of outDir replaced. SQLite databases are dumped as SQL"""
+    outputs = {}
+    for name in sorted(os.listdir(outDir)):
+        path = os.path.join(outDir, name)
+        if name.endswith(".sqlite"):
+            connection = sqlite3.connect(path)
+            contents = "\n".join(connection.iterdump())
+            connection.close()
+        else:
+            with open(path, 'r', encoding='utf-8') as f:
+                contents = f.read()
+        outputs[name] = contents.replace(outDir, "outDir")
+    return outputs
@@ -0,0 +1,181 @@
+#! /usr/bin/env python3
+
+"""PDF Quality Assessment for Digitisation batches
+
+Johan van der Knijff
+
+Copyright 2024, KB/National Library of the Netherlands
+
+Tests for the incremental decoding of the filters that wrap the image
+codec. Small chunk sizes are used, so the chunk boundaries fall inside
+the encoded groups, codes and rows
+
+"""
+
+import io
+import zlib
+import base64
+import random
+import pytest
+from PIL import Image
+from pdfquad import filters
+from helpers import makeJPEG
+
+chunkSizes = [1, 2, 3, 4, 5, 7, 13, 64, 65536]
+
+# Data with runs of zero bytes (encoded as z in ASCII85) and other values
+plain = (bytes(range(256)) + bytes(8) + b"pdfquad" + bytes(4) + b"\xff" * 9) * 5 + b"end"
+
+
+def encodeLZW(data, earlyChange=1):
+    """Return LZW encoded data. The table is cleared when it is full"""
+    bits = []
+    codeLength = 9
+
+    def emit(code):
+        bits.append(format(code, "0{}b".format(codeLength)))
+
+    initialTable = {bytes([i]): i for i in range(256)}
+    table = dict(initialTable)
+    nextCode = 258
+    emit(256)
+    current = b""
+    for byte in data:
+        candidate = current + bytes([byte])
+        if candidate in table:
+            current = candidate
+            continue
+        emit(table[current])
+        table[candidate] = nextCode
+        nextCode += 1
+        if nextCode + earlyChange > (1 << codeLength):
+            if codeLength == 12:
+                emit(256)
+                table = dict(initialTable)
+                nextCode = 258
+                codeLength = 9
+            else:
+                codeLength += 1
+        current = bytes([byte])
+    emit(table[current])
+    if nextCode + earlyChange >= (1 << codeLength) and codeLength < 12:
+        codeLength += 1
+    emit(257)
+    bits = "".join(bits)
+    bits += "0" * (-len(bits) % 8)
+    return int(bits, 2).to_bytes(len(bits) // 8, "big")
+
+
+def encodeTIFFPredictor(data, colors, columns):
+    """Return data with TIFF predictor (horizontal differencing) applied"""
+    rowLength = colors * columns
+    out = bytearray()
+    for start in range(0, len(data), rowLength):
+        row = data[start:start + rowLength]
+        out += bytes([row[i] if i < colors else (row[i] - row[i - colors]) & 0xff
+                      for i in range(len(row))])
+    return bytes(out)
+
+
+def getPNGData(im):
+    """Return zlib data (concatenated IDAT chunks, with the PNG predictor
+    applied by the encoder) of image im"""
+    out = io.BytesIO()
+    im.save(out, "PNG")
+    png = out.getvalue()
+    position = 8
+    data = b""
+    while position < len(png):
+        length = int.from_bytes(png[position:position + 4], "big")
+        if png[position + 4:position + 8] == b"IDAT":
+            data += png[position + 8:position + 8 + length]
+        position += length + 12
+    return data
+
+
+def decode(monkeypatch, chunkSize, streamRaw, filterChain, headerFunction=None):
+    """Return decoded stream, using chunkSize"""
+    monkeypatch.setattr(filters, "chunkSize", chunkSize)
+    data, remaining = filters.decodeStream(streamRaw, filterChain, headerFunction)
+    assert remaining == []
+    return data
+
+
+@pytest.mark.parametrize("chunkSize", chunkSizes)
+def testASCII85(monkeypatch, chunkSize):
+    encoded = base64.a85encode(plain, adobe=True, wrapcol=11)
+    assert b"z" in encoded
+    assert decode(monkeypatch, chunkSize, encoded, [("ASCII85Decode", "")]) == plain
+    assert decode(monkeypatch, chunkSize, encoded[2:], [("A85", "")]) == plain
+    # Group that is carried into the next chunk and followed by z
+    encoded = b"<~" + base64.a85encode(b"abcd") + b"zz" + base64.a85encode(b"xyz") + b"~>"
+    assert decode(monkeypatch, chunkSize, encoded, [("A85", "")]) == b"abcd" + bytes(8) + b"xyz"
+
+
+@pytest.mark.parametrize("chunkSize", chunkSizes)
+def testASCIIHex(monkeypatch, chunkSize):
+    encoded = b" \n".join(plain[i:i + 10].hex().encode() for i in range(0, len(plain), 10)) + b">"
+    assert decode(monkeypatch, chunkSize, encoded, [("ASCIIHexDecode", "")]) == plain
+    # Odd number of digits, with implicit trailing zero
+    assert decode(monkeypatch, chunkSize, b"70 64 6>ignored", [("AHx", "")]) == b"pd`"
+
+
+@pytest.mark.parametrize("chunkSize", chunkSizes)
+@pytest.mark.parametrize("earlyChange", [0, 1])
+def testLZW(monkeypatch, chunkSize, earlyChange):
+    # Random data fill the table, so it is cleared
+    data = random.Random(0).randbytes(12000) + plain * 20
+    encoded = encodeLZW(data, earlyChange)
+    parms = "<</EarlyChange {}>>".format(earlyChange)
+    assert decode(monkeypatch, chunkSize, encoded, [("LZWDecode", parms)]) == data
+
+
+@pytest.mark.parametrize("chunkSize", chunkSizes)
+def testFlate(monkeypatch, chunkSize):
+    data = plain * 200
+    assert decode(monkeypatch, chunkSize, zlib.compress(data), [("FlateDecode", "")]) == data
+    # Flate stream inside ASCII85
+    encoded = base64.a85encode(zlib.compress(data), adobe=True)
+    assert decode(monkeypatch, chunkSize, encoded, [("A85", ""), ("Fl", "")]) == data
+
+
+@pytest.mark.parametrize("chunkSize", chunkSizes)
+def testPNGPredictor(monkeypatch, chunkSize):
+    gradient = Image.linear_gradient("L").resize((37, 23))
+    noise = Image.effect_noise((37, 23), 60)
+    for im in [Image.merge("RGB", (gradient, noise, gradient.rotate(90))), noise]:
+        parms = "<</Predictor 15/Colors {}/BitsPerComponent 8/Columns 37>>".format(len(im.getbands()))
+        assert decode(monkeypatch, chunkSize, getPNGData(im), [("FlateDecode", parms)]) == im.tobytes()
+
+
+@pytest.mark.parametrize("chunkSize", chunkSizes)
+def testTIFFPredictor(monkeypatch, chunkSize):
+    data = plain[:-3] * 3
+    parms = "<</Predictor 2/Colors 3/Columns 11>>"
+    encoded = zlib.compress(encodeTIFFPredictor(data, 3, 11))
+    assert decode(monkeypatch, chunkSize, encoded, [("FlateDecode", parms)]) == data
+    encoded = encodeLZW(encodeTIFFPredictor(data, 3, 11))
+    assert decode(monkeypatch, chunkSize, encoded, [("LZWDecode", parms)]) == data
+
+
+def testUnsupportedPredictor():
+    with pytest.raises(ValueError, match="unsupported DecodeParms"):
+        filters.decodeStream(zlib.compress(plain), [("FlateDecode", "<</Predictor 2/BitsPerComponent 16>>")])
+    with pytest.raises(ValueError, match="unsupported DecodeParms"):
+        filters.decodeStream(zlib.compress(plain), [("FlateDecode", "<</Predictor 5>>")])
+
+
+@pytest.mark.parametrize("chunkSize", chunkSizes)
+def testJPEGHeader(monkeypatch, chunkSize):
+    """Only the JPEG header is decoded if headerFunction is used"""
+    jpeg = makeJPEG()
+    headerLength = filters.getJPEGHeaderLength(jpeg)
+    assert headerLength < len(jpeg)
+    encoded = base64.a85encode(zlib.compress(jpeg), adobe=True)
+    filterChain = [("ASCII85Decode", ""), ("FlateDecode", ""), ("DCTDecode", "")]
+    monkeypatch.setattr(filters, "chunkSize", chunkSize)
+    data, remaining = filters.decodeStream(encoded, filterChain, filters.getJPEGHeaderLength)
+    assert data == jpeg[:headerLength]
+    assert remaining == [("DCTDecode", "")]
+    data, remaining = filters.decodeStream(encoded, filterChain)
+    assert data == jpeg
@@ -0,0 +1,53 @@
+#! /usr/bin/env python3
+
+"""PDF Quality Assessment for Digitisation batches
+
+Johan van der Knijff
+
+Copyright 2024, KB/National Library of the Netherlands
+
+Tests for processing a batch in shards and merging their output, which
+must result in the same output as a single run with --sort
+
+"""
+
+import os
+import pytest
+from pdfquad.outputformats import formats
+from helpers import makeBatch, runPdfquad, readOutputs
+
+
+@pytest.fixture(scope="module")
+def batch(tmp_path_factory):
+    """Batch directory and configuration directory"""
+    tmpDir = str(tmp_path_factory.mktemp("merge"))
+    batchDir = os.path.join(tmpDir, "batch")
+    configDir = os.path.join(tmpDir, "config")
+    os.mkdir(configDir)
+    makeBatch(batchDir, 11)
+    return batchDir, configDir
+
+
+@pytest.mark.parametrize("outputFormat", formats)
+@pytest.mark.parametrize("noShards", [1, 3])
+def testMerge(batch, tmp_path, outputFormat, noShards):
+    batchDir, configDir = batch
+    args = ["process", "dbnl-fulltext.xml", batchDir, "-x", "4", "-z", "-j", outputFormat]
+
+    expectedDir = os.path.join(str(tmp_path), "expected")
+    os.mkdir(expectedDir)
+    process = runPdfquad(args + ["-o", expectedDir, "-s"], configDir)
+    assert process.returncode == 0, process.stderr
+
+    outDir = os.path.join(str(tmp_path), "shards")
+    os.mkdir(outDir)
+    for shard in range(1, noShards + 1):
+        process = runPdfquad(args + ["-o", outDir, "-a", "{}/{}".format(shard, noShards)], configDir)
+        assert process.returncode == 0, process.stderr
+    process = runPdfquad(["merge", batchDir, "-o", outDir, "-x", "4"], configDir)
+    assert process.returncode == 0, process.stderr
+
+    merged = {name: contents for name, contents in readOutputs(outDir).items()
+              if "_shard" not in name}
+    assert "pq_batch_summary.csv" in merged and "pq_batch_stats.json" in merged
+    assert merged == readOutputs(expectedDir)
@@ -0,0 +1,45 @@
+#! /usr/bin/env python3
+
+"""PDF Quality Assessment for Digitisation batches
+
+Johan van der Knijff
+
+Copyright 2024, KB/National Library of the Netherlands
+
+Tests for reading PDFs ahead on background threads
+
+"""
+
+import os
+import concurrent.futures
+from pdfquad import prefetch
+from helpers import makePDF
+
+
+def testPrefetch(tmp_path):
+    """PDFs are yielded in input order, with their contents"""
+    PDFs = [makePDF(os.path.join(str(tmp_path), "doc{}.pdf".format(i))) for i in range(5)]
+    prefetcher = prefetch.Prefetcher(PDFs, 2, 1 << 30)
+    result = []
+    for PDF, data in prefetcher:
+        with open(PDF, 'rb') as f:
+            assert data == f.read()
+        result.append(PDF)
+        prefetcher.release()
+    prefetcher.close()
+    assert result == PDFs
+
+
+def testCloseCancelsPendingReads(tmp_path, monkeypatch):
+    """Closing stops the iteration, also if reads are pending. This doesn't
+    need the cancel_futures argument of shutdown, which Python 3.8 lacks"""
+    shutdown = concurrent.futures.ThreadPoolExecutor.shutdown
+    def shutdown38(self, wait=True):
+        shutdown(self, wait)
+    monkeypatch.setattr(concurrent.futures.ThreadPoolExecutor, "shutdown", shutdown38)
+
+    PDFs = [makePDF(os.path.join(str(tmp_path), "doc{}.pdf".format(i))) for i in range(10)]
+    prefetcher = prefetch.Prefetcher(PDFs, 8, 1 << 30)
+    assert next(prefetcher)[0] == PDFs[0]
+    prefetcher.close()
+    assert list(prefetcher) == []
@@ -0,0 +1,163 @@
+#! /usr/bin/env python3
+
+"""PDF Quality Assessment for Digitisation batches
+
+Johan van der Knijff
+
+Copyright 2024, KB/National Library of the Netherlands
+
+Tests for the extraction of properties, and for skipping extraction
+stages that a schema doesn't need
+
+"""
+
+import os
+import pytest
+import pymupdf
+from pdfquad import pdfquad
+from pdfquad import properties
+from pdfquad import schematron
+from pdfquad import timings
+from pdfquad import iccprofiles
+from helpers import makePDF, readSchemas, getPeakRSS
+
+
+def getExceptions(pdfElt):
+    """Return texts of all exception elements in output of PDF"""
+    return [elt.text for elt in pdfElt.iter("exception")]
+
+
+def testIncludedSchemasNeedAllStages():
+    """The included DBNL schemas check for exceptions at the document and
+    image stream level, and for the presence of ICC profiles, so every
+    optional stage can record exceptions that they check"""
+    for schema in readSchemas():
+        assert schematron.getRequiredStages(schema[3]) == set(properties.optionalStages)
+
+
+def testKBRSchemasSkipICCProfileStage(tmp_path):
+    """The included KBR schemas don't check for ICC profiles, so the
+    iccProfile stage is skipped, and its properties are left out"""
+    schemas = readSchemas("kbr.xml")
+    for schema in schemas:
+        assert schematron.getRequiredStages(schema[3]) == \
+            set(properties.optionalStages) - {"iccProfile"}
+
+    PDF = makePDF(os.path.join(str(tmp_path), "scan_85.pdf"))
+    for fullPropertiesFlag, expectedFlag in ((True, True), (False, False)):
+        pdfElt = pdfquad.processPDF(PDF, False, False, schemas,
+                                    fullPropertiesFlag=fullPropertiesFlag)
+        stream = pdfElt.find("properties/pages/page/image/stream")
+        assert (stream.find("icc_profile_name") is not None) == expectedFlag
+        assert stream.find("JPEGQuality") is not None
+
+
+def testExceptionPathsNeedStages():
+    """A path that ends at the exception elements of a level needs all
+    stages that can record exceptions at that level for the elements the
+    schema uses"""
+    stream = ("properties", "pages", "page", "image", "stream")
+    exceptions = (stream + ("exceptions", "exception"), False)
+    assert properties.getRequiredStages({exceptions}) == {"jpegQuality"}
+    assert properties.getRequiredStages({exceptions, (stream + ("icc_profile",), False)}) == \
+        {"jpegQuality", "iccProfile"}
+    assert properties.getRequiredStages({(properties.documentExceptions, False)}) == \
+        {"xrefScan", "watermarkScan"}
+    assert properties.getRequiredStages({(stream + ("width",), True)}) == set()
+
+
+def testCorruptICCProfileFails(tmp_path):
+    """A PDF with a corrupt ICC profile fails validation, also if the stages
+    that aren't used by the schema are skipped"""
+    batchDir = os.path.join(str(tmp_path), "300dpi-85")
+    goodPDF = makePDF(os.path.join(batchDir, "good.pdf"))
+    badPDF = makePDF(os.path.join(batchDir, "bad.pdf"), iccProfile=b"garbage" * 40)
+    schemas = readSchemas()
+
+    for fullPropertiesFlag in (True, False):
+        pdfElt = pdfquad.processPDF(goodPDF, False, False, schemas,
+                                    fullPropertiesFlag=fullPropertiesFlag)
+        assert pdfElt.findtext("validationOutcome") == "Pass"
+        assert getExceptions(pdfElt) == []
+
+        pdfElt = pdfquad.processPDF(badPDF, False, False, schemas,
+                                    fullPropertiesFlag=fullPropertiesFlag)
+        assert pdfElt.findtext("validationOutcome") == "Fail"
+        assert getExceptions(pdfElt) == ["cannot open profile from string"]
+        stream = pdfElt.find("properties/pages/page/image/stream")
+        assert stream.find("icc_profile_name") is None
+        failedTexts = [" ".join(elt.text.split()) for elt in
+                       pdfElt.iter("{http://purl.oclc.org/dsdl/svrl}text")]
+        assert failedTexts == ["Properties extraction at stream level resulted in one or more exceptions"]
+
+
+def testObjectTypesInTimings(tmp_path):
+    """The number of objects of each type is reported in the timings, and
+    matches the Type values that MuPDF reports for all objects"""
+    PDF = makePDF(os.path.join(str(tmp_path), "objects.pdf"), noPages=3)
+    doc = pymupdf.open(PDF)
+    doc[0].add_text_annot((10, 10), "note")
+    doc[1].add_text_annot((10, 10), "note")
+    doc.saveIncr()
+    expected = {}
+    for xref in range(1, doc.xref_length()):
+        if doc.xref_object(xref).startswith("<<"):
+            type = doc.xref_get_key(xref, "Type")[1]
+            if type == "null":
+                type = "undefined"
+            expected[type] = expected.get(type, 0) + 1
+    doc.close()
+    assert expected["/Page"] == 3
+    # Text annotations come with a Popup annotation
+    assert expected["/Annot"] == 4
+
+    timer = timings.Timer()
+    pdfRecord = properties.getProperties(PDF, timer=timer)
+    assert sorted(pdfRecord.annotations) == ["/Popup", "/Popup", "/Text", "/Text"]
+    timer.stop()
+    objectTypes = {elt.get("type"): int(elt.text) for elt in
+                   timer.toElt().iterfind("objectTypes/objectType")}
+    assert objectTypes == expected
+
+    # Not part of the properties
+    assert pdfRecord.toElt().find(".//objectTypes") is None
+
+
+def testStreamPagesPeakMemory(tmp_path):
+    """With streamFlag, the peak memory use only grows with the number of
+    pages by the (small) records of the extracted properties of each page"""
+    pdfDir = os.path.join(str(tmp_path), "300dpi-85")
+    shortPDF = makePDF(os.path.join(pdfDir, "short.pdf"), noPages=5, width=100, height=100)
+    longPDF = makePDF(os.path.join(pdfDir, "long.pdf"), noPages=505, width=100, height=100)
+    shortPeakRSS = getPeakRSS(shortPDF)
+    longPeakRSS = getPeakRSS(longPDF)
+    if shortPeakRSS is None or longPeakRSS is None:
+        pytest.skip("peak memory use not available")
+    assert longPeakRSS - shortPeakRSS < 500 * 32768
+
+
+def testBrokenColourSpaceProfileParsedOnce(tmp_path, monkeypatch, caplog):
+    """A broken ICC profile of an ICCBased colour space that is shared by all
+    images is parsed and logged only once, but reported for each image"""
+    PDF = makePDF(os.path.join(str(tmp_path), "iccbased.pdf"), noPages=3, iccProfile=None)
+    doc = pymupdf.open(PDF)
+    profileXref = doc.get_new_xref()
+    doc.update_object(profileXref, "<</N 3>>")
+    doc.update_stream(profileXref, b"garbage" * 40)
+    for page in doc:
+        for image in page.get_images():
+            doc.xref_set_key(image[0], "ColorSpace", "[/ICCBased {} 0 R]".format(profileXref))
+    doc.saveIncr()
+    doc.close()
+
+    noCalls = []
+    getProfileProperties = iccprofiles.getProfileProperties
+    def countingGetProfileProperties(icc):
+        noCalls.append(icc)
+        return getProfileProperties(icc)
+    monkeypatch.setattr(iccprofiles, "getProfileProperties", countingGetProfileProperties)
+
+    pdfElt = properties.getProperties(PDF).toElt()
+    assert getExceptions(pdfElt) == ["cannot open profile from string"] * 3
+    assert len(noCalls) == 1
+    assert len([record for record in caplog.records if "colour space" in record.getMessage()]) == 1
@@ -0,0 +1,57 @@
+#! /usr/bin/env python3
+
+"""PDF Quality Assessment for Digitisation batches
+
+Johan van der Knijff
+
+Copyright 2024, KB/National Library of the Netherlands
+
+Tests for resuming runs that were killed, which must result in the same
+output as an uninterrupted run
+
+"""
+
+import os
+import pytest
+from pdfquad.outputformats import formats
+from helpers import makeBatch, runPdfquad, readOutputs
+
+
+@pytest.fixture(scope="module")
+def batch(tmp_path_factory):
+    """Batch directory, configuration directory and output of an
+    uninterrupted run for each output format"""
+    tmpDir = str(tmp_path_factory.mktemp("resume"))
+    batchDir = os.path.join(tmpDir, "batch")
+    configDir = os.path.join(tmpDir, "config")
+    os.mkdir(configDir)
+    makeBatch(batchDir)
+    expected = {}
+    for outputFormat in formats:
+        outDir = os.path.join(tmpDir, "expected-" + outputFormat)
+        os.mkdir(outDir)
+        process = runPdfquad(["process", "dbnl-fulltext.xml", batchDir, "-o", outDir,
+                              "-x", "3", "-s", "-z", "-j", outputFormat], configDir)
+        assert process.returncode == 0, process.stderr
+        expected[outputFormat] = readOutputs(outDir)
+    return batchDir, configDir, expected
+
+
+@pytest.mark.parametrize("outputFormat", formats)
+@pytest.mark.parametrize("killAfter", [0, 2, 3, 7])
+def testResume(batch, tmp_path, outputFormat, killAfter):
+    """Kill run after killAfter journal entries (with the output of the next
+    PDF already written), and resume it"""
+    batchDir, configDir, expected = batch
+    outDir = str(tmp_path)
+    args = ["process", "dbnl-fulltext.xml", batchDir, "-o", outDir,
+            "-x", "3", "-s", "-z", "-f", "0", "-j", outputFormat]
+
+    process = runPdfquad(args, configDir, killAfter)
+    assert process.returncode != 0
+    with open(os.path.join(outDir, "pq_batch_journal.csv"), 'r', encoding='utf-8') as f:
+        assert len(f.readlines()) == killAfter
+
+    process = runPdfquad(args + ["-u"], configDir)
+    assert process.returncode == 0, process.stderr
+    assert readOutputs(outDir) == expected[outputFormat]
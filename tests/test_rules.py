@@ -0,0 +1,91 @@
+#! /usr/bin/env python3
+
+"""PDF Quality Assessment for Digitisation batches
+
+Johan van der Knijff
+
+Copyright 2024, KB/National Library of the Netherlands
+
+Tests for the native rule engine, which are compared against the
+isoschematron validator
+
+"""
+
+import os
+from lxml import etree
+from pdfquad import rules
+from pdfquad import properties
+from pdfquad import schematron
+from helpers import makePDF, readSchemas
+
+
+def makeBatch(batchDir):
+    """Create PDFs that pass and fail various asserts of the included schemas,
+    and return list of (PDF, schema) tuples"""
+    schemas = {schema[2]: schema[3] for schema in readSchemas()}
+    PDFs = []
+    for quality in (85, 50):
+        pdfDir = os.path.join(batchDir, "300dpi-{}".format(quality))
+        schema = schemas["pi-{}".format(quality)]
+        for name, options in [("ok", {}),
+                              ("pages", {"noPages": 3}),
+                              ("lowquality", {"quality": 30}),
+                              ("highquality", {"quality": 95, "noPages": 2}),
+                              ("noicc", {"iccProfile": None}),
+                              ("badicc", {"iccProfile": b"garbage" * 40})]:
+            options.setdefault("quality", quality)
+            PDFs.append((makePDF(os.path.join(pdfDir, name + ".pdf"), **options), schema))
+    return PDFs
+
+
+def newNativeSchema(schema):
+    """Return newly compiled native schema, so memoized results of other
+    tests aren't used"""
+    schematron.getNativeSchema(schema)
+    validator = schematron.getSchematron(schema)
+    validator.validate(etree.Element("pdfquad"))
+    reportFrame = etree.fromstring(str(validator.validation_report))
+    return rules.NativeSchema(schematron.readAsLXMLElt(schema).getroot(), reportFrame)
+
+
+def testNativeEngineMatchesIsoschematron(tmp_path, monkeypatch):
+    """Reports of the native rule engine are identical to those of
+    isoschematron, also if memoized results are used, and when memoization
+    is switched off or the memo is cleared"""
+    monkeypatch.setattr(rules.Rule, "minLookups", 8)
+    monkeypatch.setattr(rules.Rule, "maxResultBytes", 4096)
+    PDFs = makeBatch(str(tmp_path))
+    nativeSchemas = {}
+    noFailed = 0
+
+    # Second round uses memoized results
+    for i in range(2):
+        for PDF, schema in PDFs:
+            propertiesElt = properties.getProperties(PDF).toElt()
+            nativeSchema = nativeSchemas.setdefault(schema, newNativeSchema(schema))
+            validationResult, report = nativeSchema.validate(propertiesElt, False)
+
+            validator = schematron.getSchematron(schema)
+            expectedResult = validator.validate(propertiesElt)
+            expectedReport = schematron.summariseSchematron(etree.fromstring(str(validator.validation_report)))
+
+            assert validationResult == expectedResult
+            assert etree.tostring(report) == etree.tostring(expectedReport)
+            noFailed += not validationResult
+
+    # The batch covers both outcomes
+    assert 0 < noFailed < 2 * len(PDFs)
+
+    # Elements that occur only once in a document are never memoized, and
+    # contexts that contain the page number never repeat, so memoization
+    # is switched off for the rule at the page level, but not for the rule
+    # at the image stream level
+    for nativeSchema in nativeSchemas.values():
+        rulesByPath = {"/".join(rule.path): rule for rulesOfPattern in nativeSchema.patterns
+                       for rule in rulesOfPattern}
+        for path in ("properties", "properties/meta", "properties/annotations"):
+            assert rulesByPath[path].noLookups == 0
+        assert not rulesByPath["properties/pages/page"].memoFlag
+        streamRule = rulesByPath["properties/pages/page/image/stream"]
+        assert streamRule.memoFlag and streamRule.noHits > 0
+        assert streamRule.resultBytes <= rules.Rule.maxResultBytes
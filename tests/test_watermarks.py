@@ -0,0 +1,95 @@
+#! /usr/bin/env python3
+
+"""PDF Quality Assessment for Digitisation batches
+
+Johan van der Knijff
+
+Copyright 2024, KB/National Library of the Netherlands
+
+Tests for the detection of marked-content watermarks
+
+"""
+
+import pymupdf
+import pytest
+from pdfquad import watermarks
+
+watermarkContent = b"/Artifact <</Subtype /Watermark>> BDC 0 0 m 10 10 l S EMC"
+otherContent = b"/Artifact <</Subtype /Footer>> BDC 0 0 m 10 10 l S EMC"
+
+
+def makeForm(doc, content, resources=None):
+    """Add form XObject with content stream content to doc, and return
+    its xref. If resources is not None, it is the source of the resource
+    dictionary of the form"""
+    xref = doc.get_new_xref()
+    if resources is None:
+        doc.update_object(xref, "<</Type/XObject/Subtype/Form/BBox[0 0 100 100]>>")
+    else:
+        doc.update_object(xref, "<</Type/XObject/Subtype/Form/BBox[0 0 100 100]/Resources{}>>".format(resources))
+    doc.update_stream(xref, content)
+    return xref
+
+
+def makePage(doc, content, forms=(), resources=""):
+    """Add page with content stream content to doc, and return its page
+    number. Forms is a list of (name, xref) tuples of form XObjects in the
+    page resources, and resources the source of any other entries of the
+    resource dictionary"""
+    page = doc.new_page(width=100, height=100)
+    xref = doc.get_new_xref()
+    doc.update_object(xref, "<<>>")
+    doc.update_stream(xref, content)
+    doc.xref_set_key(page.xref, "Contents", "{} 0 R".format(xref))
+    references = "".join("/{} {} 0 R".format(name, xref) for name, xref in forms)
+    doc.xref_set_key(page.xref, "Resources", "<</XObject<<{}>>{}>>".format(references, resources))
+    return page.number
+
+
+@pytest.mark.parametrize("content, forms, expected", [
+    (watermarkContent, [], True),
+    (otherContent, [], False),
+    (b"/Watermark /MC0 DP q Q", [], False),
+    # Form XObject that is invoked by the page
+    (b"q /Fm0 Do Q", [("Fm0", watermarkContent)], True),
+    (b"q /Fm0 Do Q", [("Fm0", otherContent)], False),
+    # Form XObject in the resources that isn't used
+    (b"q Q", [("Fm0", watermarkContent)], False),
+    (b"q /Fm1 Do Q", [("Fm0", watermarkContent), ("Fm1", otherContent)], False),
+    # Watermark in a string, comment or inline image isn't a mark
+    (b"BT (<</Subtype /Watermark>> BDC) Tj ET % /Fm0 Do", [("Fm0", watermarkContent)], False),
+    (b"BI /W 1 /H 1 /BPC 8 /CS /G ID \x00 Watermark BDC EI q Q", [], False),
+])
+def testHasWatermark(content, forms, expected):
+    doc = pymupdf.open()
+    forms = [(name, makeForm(doc, formContent)) for name, formContent in forms]
+    pageNo = makePage(doc, content, forms)
+    assert watermarks.WatermarkScanner(doc).hasWatermark(doc[pageNo]) is expected
+
+
+def testSharedForm():
+    """Results of forms with resources are shared by the pages of a
+    document, and each form is only scanned once"""
+    doc = pymupdf.open()
+    forms = [("Fm0", makeForm(doc, watermarkContent, "<<>>"))]
+    pageNos = [makePage(doc, b"q /Fm0 Do Q", forms),
+               makePage(doc, b"q Q", forms),
+               makePage(doc, b"/Fm0 Do", forms)]
+    scanner = watermarks.WatermarkScanner(doc)
+    assert [scanner.hasWatermark(doc[pageNo]) for pageNo in pageNos] == [True, False, True]
+    assert scanner.formResults == {(forms[0][1], forms[0][1]): True}
+
+
+def testFormWithoutResources():
+    """Forms without resources use those of the page that invokes them, so
+    the same form can contain a watermark on one page but not on another"""
+    doc = pymupdf.open()
+    forms = [("Fm0", makeForm(doc, b"/Artifact /MC0 BDC 0 0 m 10 10 l S EMC"))]
+    pageNos = [makePage(doc, b"/Fm0 Do", forms, "/Properties<</MC0<</Subtype/Watermark>>>>"),
+               makePage(doc, b"/Fm0 Do", forms, "/Properties<</MC0<</Subtype/Footer>>>>"),
+               makePage(doc, b"/Fm0 Do", forms, "/Properties<</MC0<</Subtype/Watermark>>>>")]
+    for order in (pageNos, pageNos[::-1]):
+        scanner = watermarks.WatermarkScanner(doc)
+        results = {pageNo: scanner.hasWatermark(doc[pageNo]) for pageNo in order}
+        assert [results[pageNo] for pageNo in pageNos] == [True, False, True]
+        assert len(scanner.formResults) == 3